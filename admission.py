@@ -0,0 +1,178 @@
+# admission.py
+import math
+import os
+import threading
+import time
+import redis
+from kombu.exceptions import OperationalError
+from task_queues import TASK_ROUTES, TITLES_QUEUE, BANNERS_QUEUE, IMAGES_QUEUE, queue_depths
+
+
+class AdmissionController:
+    """
+    Контроль допуска задач по глубине очередей и скорости обслуживания.
+
+    Воркеры после каждой задачи увеличивают счетчик admission:done:<очередь>:<окно>,
+    API делит глубину очереди на скорость обслуживания за последние WINDOW секунд
+    и получает ожидаемое время ожидания. Если оно больше max_wait — 429 с Retry-After.
+
+    Сброс нагрузки (shed_wait > 0): баннеры отклоняются уже при shed_wait,
+    а заголовки — только при max_wait, так что быстрые задачи проходят дольше.
+    """
+
+    KEY_PREFIX = "admission"
+    # Окно измерения скорости и шаг счетчиков, секунды
+    WINDOW = 60
+    BUCKET = 10
+    # Какие очереди проходит задача каждого типа
+    JOB_QUEUES = {
+        "title": (TITLES_QUEUE,),
+        "banner": (BANNERS_QUEUE, IMAGES_QUEUE),
+    }
+    # Скорость (задач/с), пока статистики нет: холодный старт не должен отклонять запросы
+    DEFAULT_RATES = {TITLES_QUEUE: 1.0, BANNERS_QUEUE: 0.5, IMAGES_QUEUE: 0.5}
+    # Меньше завершений в окне — оценке скорости не доверяем
+    MIN_COMPLETIONS = 5
+
+    def __init__(self, celery_app, max_wait: float = None, shed_wait: float = None,
+                 refresh_interval: float = 1.0, client=None):
+        if max_wait is None:
+            max_wait = float(os.environ.get("ADMISSION_MAX_WAIT", "60"))
+        if shed_wait is None:
+            shed_wait = float(os.environ.get("ADMISSION_SHED_WAIT", "0"))
+        self.celery_app = celery_app
+        self.max_wait = max_wait
+        self.shed_wait = shed_wait
+        # Глубины и скорости кэшируются на refresh_interval: во время всплеска не опрашиваем Redis на каждый запрос
+        self.refresh_interval = refresh_interval
+        self._client = client
+        self._snapshot = None
+        self._snapshot_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("ADMISSION_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать ни воркер, ни API
+                retry=None,
+            )
+        return self._client
+
+    def _done_key(self, queue: str, bucket: int) -> str:
+        return f"{self.KEY_PREFIX}:done:{queue}:{bucket}"
+
+    # ------------------------------------------------------------------
+    # Сторона воркера
+    # ------------------------------------------------------------------
+
+    def record_completion(self, task_name: str):
+        """Вызывается воркером после задачи (успех, ошибка или replace — она покинула очередь)."""
+        route = TASK_ROUTES.get(task_name)
+        if route is None:
+            return
+        key = self._done_key(route["queue"], int(time.time() // self.BUCKET))
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, self.WINDOW + self.BUCKET)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Admission: не удалось учесть завершение {task_name}: {e} ---")
+
+    # ------------------------------------------------------------------
+    # Сторона API
+    # ------------------------------------------------------------------
+
+    def _service_rates(self, queues) -> dict:
+        """Задач в секунду по каждой очереди за последние WINDOW секунд."""
+        now = time.time()
+        current = int(now // self.BUCKET)
+        buckets = range(current - self.WINDOW // self.BUCKET + 1, current + 1)
+        pipe = self.client.pipeline()
+        for queue in queues:
+            for bucket in buckets:
+                pipe.get(self._done_key(queue, bucket))
+        counts = iter(pipe.execute())
+        # Текущее окно заполнено не целиком — делим на реально прошедшее время
+        elapsed = self.WINDOW - self.BUCKET + (now - current * self.BUCKET)
+        rates = {}
+        for queue in queues:
+            done = sum(int(next(counts) or 0) for _ in buckets)
+            rates[queue] = done / elapsed if done >= self.MIN_COMPLETIONS else self.DEFAULT_RATES[queue]
+        return rates
+
+    def snapshot(self) -> dict:
+        """{очередь: {"depth", "rate", "wait"}} — кэшируется на refresh_interval."""
+        with self._lock:
+            if self._snapshot is not None and time.monotonic() - self._snapshot_at < self.refresh_interval:
+                return self._snapshot
+        depths = queue_depths(self.celery_app)
+        rates = self._service_rates(list(depths))
+        snapshot = {
+            queue: {"depth": depth, "rate": rates[queue], "wait": depth / rates[queue]}
+            for queue, depth in depths.items()
+        }
+        with self._lock:
+            self._snapshot, self._snapshot_at = snapshot, time.monotonic()
+        return snapshot
+
+    def _reserve(self, snapshot: dict, job_type: str, n_images: int):
+        # Допущенная задача сразу учитывается в закэшированной глубине,
+        # иначе весь всплеск внутри refresh_interval прошел бы по одной старой оценке
+        with self._lock:
+            for queue in self.JOB_QUEUES[job_type]:
+                stats = snapshot[queue]
+                stats["depth"] += n_images if queue == IMAGES_QUEUE else 1
+                stats["wait"] = stats["depth"] / stats["rate"]
+
+    def _limit(self, job_type: str) -> tuple:
+        """(порог ожидания, причина отказа) для типа задачи."""
+        if job_type != "title" and self.shed_wait > 0 and self.shed_wait < self.max_wait:
+            return self.shed_wait, "shedding"
+        return self.max_wait, "overloaded"
+
+    def _wait(self, snapshot: dict, job_type: str) -> float:
+        return sum(snapshot[queue]["wait"] for queue in self.JOB_QUEUES[job_type])
+
+    def check(self, job_type: str, n_images: int = 1) -> dict:
+        """
+        Решение о допуске задачи типа "title" или "banner":
+        {"admitted", "estimated_wait", "retry_after", "reason"}.
+        При недоступном Redis задачи допускаются (оценки нет).
+        """
+        decision = self.check_many(job_type, [n_images])
+        decision["admitted"] = decision["admitted"] == 1
+        return decision
+
+    def check_many(self, job_type: str, n_images: list) -> dict:
+        """
+        Допуск пачки задач одного типа (n_images — по задаче): задачи допускаются по очереди,
+        каждая допущенная сразу учитывается в глубине, поэтому пачка не проходит целиком
+        по одной старой оценке. {"admitted": сколько первых задач допущено, "estimated_wait",
+        "retry_after", "reason"} — при отказе для первой отклоненной задачи.
+        """
+        try:
+            snapshot = self.snapshot()
+        except (redis.RedisError, OperationalError, OSError) as e:
+            print(f"--- Admission: нет данных об очередях, пропускаем задачи: {e} ---")
+            return {"admitted": len(n_images), "estimated_wait": None, "retry_after": None, "reason": None}
+
+        limit, reason = self._limit(job_type)
+        admitted, wait = 0, self._wait(snapshot, job_type)
+        for count in n_images:
+            wait = self._wait(snapshot, job_type)
+            if wait > limit:
+                # Через сколько секунд очередь при текущей скорости опустится до порога
+                return {"admitted": admitted, "estimated_wait": round(wait, 1),
+                        "retry_after": max(1, math.ceil(wait - limit)), "reason": reason}
+            self._reserve(snapshot, job_type, count)
+            admitted += 1
+        # Ожидание последней допущенной задачи (для одной задачи — как у check до постановки)
+        return {"admitted": admitted, "estimated_wait": round(wait, 1), "retry_after": None, "reason": None}
@@ -0,0 +1,91 @@
+# batch_store.py
+import os
+import time
+import uuid
+import redis
+
+
+class BatchStore:
+    """
+    Учет пакетных (batch) загрузок в Redis.
+
+    batch:<id>        — hash с метаданными (total, invalid, created_at);
+    batch:<id>:tasks  — список task_id в порядке строк входного JSONL.
+    """
+
+    KEY_PREFIX = "batch"
+
+    def __init__(self, ttl: int = None, client=None):
+        if ttl is None:
+            ttl = int(os.environ.get("BATCH_TTL", str(7 * 24 * 3600)))
+        self.ttl = ttl
+        self._client = client
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("BATCH_DB", "2")),
+                decode_responses=True,
+            )
+        return self._client
+
+    def _meta_key(self, batch_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{batch_id}"
+
+    def _tasks_key(self, batch_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{batch_id}:tasks"
+
+    def create(self) -> str:
+        batch_id = uuid.uuid4().hex
+        pipe = self.client.pipeline()
+        pipe.hset(self._meta_key(batch_id), mapping={"total": 0, "invalid": 0, "created_at": time.time()})
+        pipe.expire(self._meta_key(batch_id), self.ttl)
+        pipe.execute()
+        return batch_id
+
+    def add_tasks(self, batch_id: str, task_ids: list, invalid: int = 0):
+        """Добавляет чанк task_id одним пайплайном."""
+        pipe = self.client.pipeline()
+        if task_ids:
+            pipe.rpush(self._tasks_key(batch_id), *task_ids)
+            pipe.expire(self._tasks_key(batch_id), self.ttl)
+        pipe.hincrby(self._meta_key(batch_id), "total", len(task_ids))
+        if invalid:
+            pipe.hincrby(self._meta_key(batch_id), "invalid", invalid)
+        pipe.execute()
+
+    def get_meta(self, batch_id: str):
+        meta = self.client.hgetall(self._meta_key(batch_id))
+        if not meta:
+            return None
+        return {
+            "total": int(meta.get("total", 0)),
+            "invalid": int(meta.get("invalid", 0)),
+            "created_at": float(meta.get("created_at", 0)),
+        }
+
+    def get_task_ids(self, batch_id: str, offset: int = 0, limit: int = None) -> list:
+        """Страница task_id; без limit — все id пакета (не больше BATCH_MAX_LINES)."""
+        end = -1 if limit is None else offset + limit - 1
+        return self.client.lrange(self._tasks_key(batch_id), offset, end)
+
+
+def fetch_task_states(celery_app, task_ids: list) -> dict:
+    """Статусы многих задач за один MGET к result backend вместо AsyncResult на каждую."""
+    if not task_ids:
+        return {}
+    backend = celery_app.backend
+    raw_values = backend.client.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    states = {}
+    for task_id, raw in zip(task_ids, raw_values):
+        if raw is None:
+            # Нет записи в backend — задача еще в очереди или выполняется
+            states[task_id] = {"status": "PENDING"}
+        else:
+            meta = backend.decode_result(raw)
+            states[task_id] = {"status": meta.get("status"), "result": meta.get("result")}
+    return states
@@ -0,0 +1,95 @@
+# benchmarks/bench_api_startup.py
+"""
+Холодный старт и память процесса API (контейнер web).
+
+import  — время `import main` в чистом интерпретаторе, RSS после импорта
+          и какие тяжелые модули (генераторы, g4f, transformers/torch) попали в процесс;
+uvicorn — время от запуска `uvicorn main:app` до первого ответа и RSS процесса после него.
+
+Каждый замер — новый процесс, итог — медиана по --runs. Нужен Linux (RSS из /proc).
+
+Запуск из корня проекта:
+    python benchmarks/bench_api_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которым не место в процессе API
+HEAVY_MODULES = ["celery_worker", "text_generator", "image_generator", "composition_module",
+                 "g4f", "transformers", "torch", "numpy"]
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+with open("/proc/self/status") as f:
+    rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+print(json.dumps({"seconds": elapsed, "rss": rss, "heavy": [m for m in %r if m in sys.modules],
+                  "modules": len(sys.modules)}))
+""" % (HEAVY_MODULES,)
+
+
+def rss_of(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+
+
+def measure_import() -> dict:
+    output = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_uvicorn() -> dict:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("uvicorn завершился при старте")
+            try:
+                requests.get(f"http://127.0.0.1:{port}/openapi.json", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.02)
+        return {"seconds": time.perf_counter() - started, "rss": rss_of(process.pid)}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    servers = [measure_uvicorn() for _ in range(args.runs)]
+
+    print(f"{'замер':10} {'время, с':>9} {'RSS, МБ':>8}")
+    for name, runs in (("import", imports), ("uvicorn", servers)):
+        seconds = statistics.median(run["seconds"] for run in runs)
+        rss = statistics.median(run["rss"] for run in runs)
+        print(f"{name:10} {seconds:9.3f} {rss / 1024 ** 2:8.1f}")
+    print(f"модулей после import main: {imports[0]['modules']}, тяжелые: {', '.join(imports[0]['heavy']) or 'нет'}")
+
+
+if __name__ == "__main__":
+    main()
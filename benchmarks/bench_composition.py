@@ -0,0 +1,131 @@
+# benchmarks/bench_composition.py
+"""
+Микро-бенчмарк CompositionModule.compose_banner.
+
+Сравнивает старую схему (шрифт с диска на каждый вызов + 9 вызовов draw.text)
+с текущей (кэш шрифта и масок, тень одним проходом NumPy).
+
+Запуск из корня проекта:
+    python benchmarks/bench_composition.py --font /path/to/font.ttf --runs 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import textwrap
+import time
+import uuid
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from composition_module import CompositionModule
+
+
+def legacy_draw_title(img, title: str, font_path: str):
+    """Прежнее наложение текста: шрифт с диска + 8 проходов тени + текст."""
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype(font_path, 90)
+    except IOError:
+        font = ImageFont.load_default()
+    wrapped_text = textwrap.fill(title, width=20)
+    x, y = 70, 50
+    shadow_offset = 5
+    for dx in [-shadow_offset, 0, shadow_offset]:
+        for dy in [-shadow_offset, 0, shadow_offset]:
+            if dx != 0 or dy != 0:
+                draw.text((x + dx, y + dy), wrapped_text, font=font, fill=(0, 0, 0))
+    draw.text((x, y), wrapped_text, font=font, fill=(255, 255, 255))
+
+
+def legacy_compose_banner(image_path: str, title: str, output_dir: str, font_path: str) -> str:
+    """Копия прежней реализации — точка отсчета для сравнения."""
+    img = Image.open(image_path)
+    if img.size != (1920, 1080):
+        img = img.resize((1920, 1080), Image.Resampling.LANCZOS)
+    legacy_draw_title(img, title, font_path)
+    save_path = os.path.join(output_dir, f"final_banner_{uuid.uuid4()}.png")
+    img.save(save_path)
+    return save_path
+
+
+def separate_variants(image_path: str, title: str, output_dir: str) -> list:
+    """Старый путь для нескольких форматов: отдельный цикл открытия/ресайза/PNG на каждый."""
+    paths = []
+    for name in CompositionModule.PRESETS:
+        paths.extend(CompositionModule.compose_variants(image_path, title, [name], output_dir).values())
+    return paths
+
+
+def total_size(paths) -> int:
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def measure(fn, runs: int) -> float:
+    """Среднее время одного вызова в миллисекундах (первый прогон — прогрев)."""
+    fn()
+    started = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - started) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--font", default=CompositionModule.FONT_PATH, help="Путь к .ttf шрифту")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--title", default="Новая кофемашина для вашего офиса: бодрость каждый день")
+    args = parser.parse_args()
+
+    CompositionModule.FONT_PATH = args.font
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.png")
+        # Похожий на фото исходник: плавные пятна цвета + шум (заливка одним цветом сжимается нереально хорошо)
+        rng = np.random.default_rng(0)
+        blobs = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((1024, 1024), Image.BICUBIC)
+        noise = rng.normal(0, 12, (1024, 1024, 3))
+        photo = np.clip(np.asarray(blobs, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(photo).save(source)
+
+        before = measure(lambda: legacy_compose_banner(source, args.title, tmp, args.font), args.runs)
+        after = measure(lambda: CompositionModule.compose_banner(source, args.title, tmp), args.runs)
+
+        # Все форматы размещения: N отдельных циклов против одного compose_variants
+        variants_runs = max(1, args.runs // 4)
+        separate = measure(lambda: separate_variants(source, args.title, tmp), variants_runs)
+        one_pass = measure(lambda: CompositionModule.compose_variants(source, args.title, output_dir=tmp),
+                           variants_runs)
+        webp = measure(lambda: CompositionModule.compose_variants(source, args.title, output_dir=tmp,
+                                                                   output_format="WEBP"), variants_runs)
+        png_bytes = total_size(CompositionModule.compose_variants(source, args.title, output_dir=tmp).values())
+        webp_bytes = total_size(CompositionModule.compose_variants(source, args.title, output_dir=tmp,
+                                                                   output_format="WEBP").values())
+        jpeg_bytes = total_size(CompositionModule.compose_variants(source, args.title, output_dir=tmp,
+                                                                   output_format="JPEG").values())
+
+    # Только стадия текста (без декодирования, ресайза и PNG-кодирования)
+    canvas = Image.new("RGB", (1920, 1080), color=(73, 109, 137))
+    text_before = measure(lambda: legacy_draw_title(canvas.copy(), args.title, args.font), args.runs)
+    text_after = measure(lambda: CompositionModule._draw_title(canvas.copy(), args.title), args.runs)
+
+    # Насколько результат нового способа отличается от старого
+    old_img, new_img = canvas.copy(), canvas.copy()
+    legacy_draw_title(old_img, args.title, args.font)
+    CompositionModule._draw_title(new_img, args.title)
+    diff = np.abs(np.asarray(old_img, dtype=np.int16) - np.asarray(new_img, dtype=np.int16))
+
+    print(f"Шрифт: {args.font}, прогонов: {args.runs}")
+    print(f"баннер целиком   до: {before:8.1f} мс   после: {after:8.1f} мс ({before / after:.2f}x)")
+    print(f"только заголовок до: {text_before:8.1f} мс   после: {text_after:8.1f} мс ({text_before / text_after:.2f}x)")
+    print(f"{len(CompositionModule.PRESETS)} форматов: отдельно {separate:8.1f} мс, "
+          f"compose_variants PNG {one_pass:8.1f} мс, WEBP {webp:8.1f} мс")
+    print(f"размер всех форматов: PNG {png_bytes / 1024:.0f} КБ, WEBP {webp_bytes / 1024:.0f} КБ, "
+          f"JPEG {jpeg_bytes / 1024:.0f} КБ")
+    print(f"макс. отличие пикселя: {diff.max()}, отличается пикселей: {(diff.max(axis=2) > 8).mean():.4%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# benchmarks/bench_connection_pool.py
+"""
+Пул соединений ImageGenerator против соединения на каждый запрос.
+
+pooled   — общая requests.Session с пулом IMAGE_MAX_CONNECTIONS keep-alive соединений;
+unpooled — прежний путь: requests.get на каждую картинку (новое TCP-соединение).
+
+Вместо image.pollinations.ai поднимается локальный HTTP/1.1-сервер. Он считает принятые
+соединения и на каждом новом ждет --handshake-ms (имитация TCP+TLS рукопожатия до
+удаленного хоста), на каждом запросе — --latency-ms (генерация на стороне API).
+Оба режима качают --rounds раз по --images картинок через generate_images.
+
+Скрипт завершается с ошибкой, если пул не уменьшил число соединений и время.
+
+Запуск из корня проекта:
+    python benchmarks/bench_connection_pool.py --images 4 --rounds 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def start_server(body: bytes, handshake: float, latency: float):
+    stats = {"connections": 0, "requests": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with lock:
+                stats["connections"] += 1
+            time.sleep(handshake)
+
+        def do_GET(self):
+            with lock:
+                stats["requests"] += 1
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def run_mode(mode: str, images: int, rounds: int, stats: dict) -> dict:
+    from image_generator import ImageGenerator
+
+    generator = ImageGenerator()
+    if mode == "unpooled":
+        # requests.get создает и закрывает сессию на каждый вызов — как до пула
+        generator.session = SimpleNamespace(get=requests.get)
+    stats["connections"] = stats["requests"] = 0
+    started = time.perf_counter()
+    for round_no in range(rounds):
+        paths = generator.generate_images([f"coffee machine {round_no}"] * images, "Photorealistic", "1:1")
+        if any(os.path.basename(path).startswith("error_") for path in paths):
+            raise RuntimeError(f"{mode}: стенд вернул ошибку")
+    elapsed = time.perf_counter() - started
+    return {"seconds": elapsed, "connections": stats["connections"], "requests": stats["requests"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=4, help="Картинок за один вызов generate_images")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--handshake-ms", type=float, default=60, help="Задержка на новое соединение")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Задержка на запрос")
+    parser.add_argument("--body-kb", type=int, default=256)
+    args = parser.parse_args()
+
+    server, stats = start_server(os.urandom(args.body_kb * 1024), args.handshake_ms / 1000, args.latency_ms / 1000)
+    os.environ["POLLINATIONS_URL"] = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        for mode in ("unpooled", "pooled"):
+            results[mode] = run_mode(mode, args.images, args.rounds, stats)
+    server.shutdown()
+
+    print(f"{'режим':10} {'соединений':>11} {'запросов':>9} {'время, с':>9} {'мс/картинка':>12}")
+    for mode, result in results.items():
+        per_image = result["seconds"] / result["requests"] * 1000
+        print(f"{mode:10} {result['connections']:11} {result['requests']:9} {result['seconds']:9.3f} {per_image:12.1f}")
+
+    pooled, unpooled = results["pooled"], results["unpooled"]
+    if pooled["connections"] >= unpooled["connections"] or pooled["seconds"] >= unpooled["seconds"]:
+        sys.exit("Пул соединений не дал выигрыша")
+    print(f"соединений в {unpooled['connections'] / pooled['connections']:.1f} раза меньше, "
+          f"время x{pooled['seconds'] / unpooled['seconds']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
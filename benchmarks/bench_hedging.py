@@ -0,0 +1,121 @@
+# benchmarks/bench_hedging.py
+"""
+Проверка гонки моделей заголовка (TextGenerator._generate_hedged) на локальных
+фальшивых провайдерах с заданными задержками — без g4f и сети.
+
+slow_leader — лидер отвечает за --slow-s, запасная модель стартует через p95 лидера
+              и ее ответ (первый хороший) возвращается сразу;
+bad_answer  — лидер быстро вернул пустой ответ: запасная стартует, не дожидаясь p95;
+ranking     — после ошибок модель уходит в конец ModelStats.ranked();
+bounded     — зависшие запросы не плодят потоки сверх HEDGE_MAX_THREADS.
+
+Скрипт завершается с ошибкой при первом нарушенном ожидании.
+
+Запуск из корня проекта:
+    python benchmarks/bench_hedging.py
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from text_generator import TextGenerator, ModelStats  # noqa: E402
+
+
+class FakeProviders(TextGenerator):
+    """_complete отвечает по сценарию {модель: (задержка, ответ или исключение)}."""
+
+    def __init__(self, script: dict, stats: ModelStats = None):
+        super().__init__(stats=stats if stats is not None else ModelStats())
+        self.script = script
+        self.started = {}
+        self._origin = time.monotonic()
+
+    def _complete(self, model_name: str, messages: list, timeout: float) -> str:
+        self.started[model_name] = time.monotonic() - self._origin
+        delay, answer = self.script[model_name]
+        # Провайдер соблюдает переданный таймаут, как g4f/requests
+        time.sleep(min(delay, timeout))
+        if delay > timeout:
+            raise TimeoutError(f"{model_name}: timeout {timeout:.2f}s")
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def race(self, models: list):
+        self.started.clear()
+        self._origin = time.monotonic()
+        title = self._generate_hedged("кофемашина для офиса", models)
+        return title, time.monotonic() - self._origin
+
+
+def check(condition: bool, message: str):
+    if not condition:
+        sys.exit(f"ОШИБКА: {message}")
+    print(f"ok  {message}")
+
+
+def seeded_stats(model_name: str, latency: float, samples: int = 20) -> ModelStats:
+    stats = ModelStats()
+    for _ in range(samples):
+        stats.record(model_name, latency, ok=True)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slow-s", type=float, default=2.0, help="Задержка медленного лидера")
+    parser.add_argument("--p95-s", type=float, default=0.3, help="p95 лидера по прошлой статистике")
+    parser.add_argument("--fast-s", type=float, default=0.1, help="Задержка запасной модели")
+    args = parser.parse_args()
+    TextGenerator.HEDGE_MIN_DELAY = 0.05
+    tolerance = 0.15
+
+    # 1. Медленный лидер: запасная модель стартует по p95, побеждает первый хороший ответ
+    generator = FakeProviders({"leader": (args.slow_s, "Заголовок лидера"),
+                               "backup": (args.fast_s, "Заголовок запасной")},
+                              stats=seeded_stats("leader", args.p95_s))
+    title, elapsed = generator.race(["leader", "backup"])
+    hedge_at = generator.started["backup"] - generator.started["leader"]
+    print(f"slow_leader: запасная через {hedge_at:.3f} с, ответ за {elapsed:.3f} с "
+          f"(последовательно было бы {args.slow_s + args.fast_s:.1f} с)")
+    check(args.p95_s <= hedge_at < args.p95_s + tolerance, "запасная стартует через p95 лидера")
+    check(title == "Заголовок запасной", "возвращается первый хороший ответ")
+    check(elapsed < args.p95_s + args.fast_s + tolerance, "ответ не ждет медленного лидера")
+
+    # 2. Пустой ответ лидера: ждать p95 незачем
+    generator = FakeProviders({"leader": (0.02, ""), "backup": (args.fast_s, "Заголовок запасной")},
+                              stats=seeded_stats("leader", args.p95_s))
+    title, elapsed = generator.race(["leader", "backup"])
+    hedge_at = generator.started["backup"] - generator.started["leader"]
+    print(f"bad_answer: запасная через {hedge_at:.3f} с")
+    check(hedge_at < args.p95_s and title == "Заголовок запасной", "плохой ответ сразу запускает запасную")
+
+    # 3. Ранжирование: ошибки отправляют модель в конец
+    stats = ModelStats()
+    generator = FakeProviders({"flaky": (0.01, RuntimeError("provider down")), "stable": (0.05, "Заголовок")},
+                              stats=stats)
+    check(stats.ranked(["flaky", "stable"]) == ["flaky", "stable"], "без статистики порядок исходный")
+    for _ in range(5):
+        generator.race(stats.ranked(["flaky", "stable"]))
+    print(f"ranking: {stats.summary(['flaky', 'stable'])}")
+    check(stats.ranked(["flaky", "stable"]) == ["stable", "flaky"], "после ошибок модель уходит в конец")
+
+    # 4. Зависшие провайдеры: потоки гонки общие и ограничены
+    TextGenerator.TOTAL_TIMEOUT = 1.0
+    generator = FakeProviders({"hung": (30.0, "никогда"), "backup": (0.01, "Заголовок")},
+                              stats=seeded_stats("hung", 0.05))
+    before = threading.active_count()
+    for _ in range(TextGenerator.HEDGE_MAX_THREADS * 2):
+        generator.race(["hung", "backup"])
+    extra = threading.active_count() - before
+    print(f"bounded: {TextGenerator.HEDGE_MAX_THREADS * 2} гонок с зависшим лидером, потоков добавилось {extra}")
+    check(extra <= TextGenerator.HEDGE_MAX_THREADS, "потоков не больше HEDGE_MAX_THREADS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,590 @@
+# benchmarks/bench_load.py
+"""
+Нагрузочный тест API: задержки от запроса до готового баннера и пропускная способность.
+
+Вместо g4f и image.pollinations.ai поднимаются локальные стенды с настраиваемым
+распределением задержек (логнормальное: медиана и sigma) и долей ошибок, RNG с seed —
+прогоны воспроизводимы. Нагрузка — JSONL в формате пакетной загрузки
+({"prompt", "style", "aspect_ratio", "n_images"}, опционально "type": "title"),
+либо синтетическая из --requests строк. Запросы идут с заданной конкурентностью (closed loop),
+готовность отслеживается через POST /api/v1/status:batch.
+
+Итог: p50/p95/p99 от запроса до результата, по стадиям (из трасс /api/v1/traces)
+и ожидания в очередях, задач/с. JSON с результатом сохраняется для сравнения прогонов.
+
+Запуск из корня проекта (нужен Redis на REDIS_HOST; API и воркер стартуют сами):
+    python benchmarks/bench_load.py --workload benchmarks/workload.jsonl --concurrency 8
+    python benchmarks/bench_load.py --requests 100 --image-latency 2 --llm-error-rate 0.1
+Против уже запущенного стека (его воркеру нужны POLLINATIONS_URL и LLM_API_URL стендов):
+    python benchmarks/bench_load.py --api-url http://localhost:8000 --fake-host 0.0.0.0
+Сравнение двух прогонов:
+    python benchmarks/bench_load.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import requests
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Синтетическая нагрузка: повторы промптов дают реалистичную долю попаданий в кэш и склеек
+PROMPTS = [
+    "Новая кофемашина для вашего офиса",
+    "Летняя распродажа кроссовок",
+    "Доставка пиццы за 30 минут",
+    "Курсы английского для детей",
+    "Фитнес-клуб рядом с домом",
+    "Скидки на ноутбуки для студентов",
+    "Туры на море всей семьей",
+    "Органические овощи с фермы",
+]
+STYLES = ["Photorealistic", "Cyberpunk", "Watercolor", "Anime"]
+ASPECT_RATIOS = ["1:1", "16:9", "4:3"]
+TERMINAL_STATUSES = ("SUCCESS", "FAILURE")
+
+
+# ==========================================================
+# Локальные стенды внешних API
+# ==========================================================
+
+class LatencyModel:
+    """Задержка ответа ~ логнормальное распределение с медианой median; доля ошибок error_rate."""
+
+    def __init__(self, median: float, sigma: float, error_rate: float, seed: int):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> tuple:
+        with self._lock:
+            delay = self.median * math.exp(self.sigma * self._rng.gauss(0, 1)) if self.median > 0 else 0.0
+            return delay, self._rng.random() < self.error_rate
+
+
+@lru_cache(maxsize=8)
+def make_jpeg(size: int) -> bytes:
+    """Похожая на фото картинка (плавные пятна цвета + шум) — кодирование как у настоящих ответов."""
+    rng = np.random.default_rng(0)
+    blobs = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((size, size), Image.BICUBIC)
+    photo = np.clip(np.asarray(blobs, dtype=np.float32) + rng.normal(0, 12, (size, size, 3)), 0, 255)
+    buffer = BytesIO()
+    Image.fromarray(photo.astype(np.uint8)).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def start_image_server(host: str, latency: LatencyModel):
+    """Стенд image.pollinations.ai: GET /prompt/<текст>?width=&height= -> JPEG."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            delay, error = latency.sample()
+            time.sleep(delay)
+            if error:
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            query = parse_qs(urlparse(self.path).query)
+            body = make_jpeg(int(query.get("width", ["1024"])[0]))
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_llm_server(host: str, latency: LatencyModel):
+    """Стенд LLM: OpenAI-совместимый POST /v1/chat/completions (см. LLM_API_URL в text_generator.py)."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            delay, error = latency.sample()
+            time.sleep(delay)
+            if error:
+                body = b'{"error": "fake upstream error"}'
+                self.send_response(500)
+            else:
+                prompt = request.get("messages", [{}])[-1].get("content", "")
+                digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:6]
+                body = json.dumps({
+                    "model": request.get("model"),
+                    "choices": [{"message": {"role": "assistant", "content": f"Лучшее предложение {digest}"}}],
+                }, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server, host: str) -> str:
+    # 0.0.0.0 слушает все интерфейсы, но ходить на него нужно по конкретному адресу
+    public_host = socket.gethostname() if host == "0.0.0.0" else host
+    return f"http://{public_host}:{server.server_port}"
+
+
+# ==========================================================
+# API и воркер
+# ==========================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stack(args, env_overrides: dict, log_dir: str) -> tuple:
+    """uvicorn main:app и celery-воркер в отдельных процессах; логи — в log_dir."""
+    env = dict(os.environ, **env_overrides)
+    port = free_port()
+    api_log = open(os.path.join(log_dir, "api.log"), "w")
+    worker_log = open(os.path.join(log_dir, "worker.log"), "w")
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=api_log, stderr=subprocess.STDOUT,
+    )
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "celery", "-A", "celery_worker.celery_app", "worker",
+         "-Q", "titles,banners,images", "-P", args.worker_pool, "-c", str(args.worker_concurrency),
+         "--loglevel", "WARNING"],
+        cwd=ROOT, env=env, stdout=worker_log, stderr=subprocess.STDOUT,
+    )
+    api_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if api.poll() is not None:
+            raise RuntimeError(f"API завершился при старте, см. {api_log.name}")
+        try:
+            requests.get(f"{api_url}/openapi.json", timeout=1)
+            return api_url, [api, worker]
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"API не поднялся за 60 секунд, см. {api_log.name}")
+
+
+def stop_stack(processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ==========================================================
+# Нагрузка
+# ==========================================================
+
+def load_workload(path: str) -> list:
+    jobs, skipped = [], 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(item, dict) or not item.get("prompt"):
+                skipped += 1
+                continue
+            jobs.append(item)
+    if skipped:
+        print(f"Пропущено некорректных строк нагрузки: {skipped}")
+    return jobs
+
+
+def synthetic_workload(count: int, title_share: float, seed: int) -> list:
+    rng = random.Random(seed)
+    jobs = []
+    for _ in range(count):
+        if rng.random() < title_share:
+            jobs.append({"type": "title", "prompt": rng.choice(PROMPTS)})
+        else:
+            jobs.append({
+                "prompt": rng.choice(PROMPTS),
+                "style": rng.choice(STYLES),
+                "aspect_ratio": rng.choice(ASPECT_RATIOS),
+                "n_images": rng.choice([1, 1, 2, 4]),
+            })
+    return jobs
+
+
+class StatusTracker:
+    """Один поток опрашивает POST /api/v1/status:batch за всех ожидающих клиентов."""
+
+    def __init__(self, api_url: str, interval: float):
+        self.api_url = api_url
+        self.interval = interval
+        self.session = requests.Session()
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def wait(self, task_id: str, timeout: float) -> tuple:
+        """(статус, время готовности по time.perf_counter) или (None, None) по таймауту."""
+        done = threading.Event()
+        entry = {"event": done, "status": None, "finished": None}
+        with self._lock:
+            self._waiting.setdefault(task_id, []).append(entry)
+        if not done.wait(timeout):
+            with self._lock:
+                entries = self._waiting.get(task_id, [])
+                if entry in entries:
+                    entries.remove(entry)
+                if not entries:
+                    self._waiting.pop(task_id, None)
+            return None, None
+        return entry["status"], entry["finished"]
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                task_ids = list(self._waiting)
+            for start in range(0, len(task_ids), 1000):
+                chunk = task_ids[start:start + 1000]
+                try:
+                    response = self.session.post(f"{self.api_url}/api/v1/status:batch",
+                                                 json={"task_ids": chunk}, timeout=10)
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    print(f"--- Опрос статусов не удался: {e} ---")
+                    continue
+                finished = time.perf_counter()
+                for state in response.json()["tasks"]:
+                    if state["status"] not in TERMINAL_STATUSES:
+                        continue
+                    with self._lock:
+                        entries = self._waiting.pop(state["task_id"], [])
+                    for entry in entries:
+                        entry["status"], entry["finished"] = state["status"], finished
+                        entry["event"].set()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def submit(session, api_url: str, job: dict):
+    if job.get("type") == "title":
+        return session.post(f"{api_url}/api/v1/generate_title/", json={"prompt": job["prompt"]}, timeout=30)
+    payload = {key: job[key] for key in ("prompt", "style", "aspect_ratio", "n_images", "reuse") if key in job}
+    return session.post(f"{api_url}/api/v1/generate/", json=payload, timeout=30)
+
+
+def run_job(session, api_url: str, tracker: StatusTracker, job: dict, job_timeout: float) -> dict:
+    record = {"type": job.get("type", "banner"), "n_images": job.get("n_images", 1)}
+    started = time.perf_counter()
+    try:
+        response = submit(session, api_url, job)
+    except requests.RequestException as e:
+        record.update(outcome="error", error=str(e))
+        return record
+    record["submit"] = time.perf_counter() - started
+    if response.status_code == 429:
+        record.update(outcome="rejected", retry_after=response.headers.get("Retry-After"))
+        return record
+    if response.status_code != 200:
+        record.update(outcome="error", error=f"HTTP {response.status_code}")
+        return record
+
+    body = response.json()
+    record.update(task_id=body["task_id"], trace_id=body.get("trace_id"), coalesced=body.get("coalesced", False))
+    status, finished = tracker.wait(body["task_id"], job_timeout)
+    if status is None:
+        record["outcome"] = "timeout"
+        return record
+    record["outcome"] = "ok" if status == "SUCCESS" else "failed"
+    record["e2e"] = finished - started
+    return record
+
+
+def run_load(api_url: str, jobs: list, concurrency: int, poll_interval: float, job_timeout: float) -> tuple:
+    """Closed loop: concurrency клиентов, каждый берет следующую задачу, когда закончилась своя."""
+    tracker = StatusTracker(api_url, poll_interval)
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    records = []
+    records_lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                return
+            record = run_job(session, api_url, tracker, job, job_timeout)
+            with records_lock:
+                records.append(record)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    tracker.stop()
+    return records, duration
+
+
+# ==========================================================
+# Отчет
+# ==========================================================
+
+def latency_stats(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    data = np.asarray(values, dtype=np.float64)
+    p50, p95, p99 = np.percentile(data, [50, 95, 99])
+    return {
+        "count": len(values),
+        "mean": round(float(data.mean()), 4),
+        "p50": round(float(p50), 4),
+        "p95": round(float(p95), 4),
+        "p99": round(float(p99), 4),
+        "max": round(float(data.max()), 4),
+    }
+
+
+def collect_traces(api_url: str, trace_ids: list) -> tuple:
+    """Длительности спанов по имени и ожидание в очереди по задачам из трасс запросов."""
+    session = requests.Session()
+
+    def fetch(trace_id):
+        try:
+            response = session.get(f"{api_url}/api/v1/traces/{trace_id}", timeout=10)
+            return response.json()["spans"] if response.status_code == 200 else []
+        except requests.RequestException:
+            return []
+
+    stages, queue_wait = {}, {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for spans in executor.map(fetch, trace_ids):
+            for span in spans:
+                name = span["name"].rpartition(".")[2] if span["name"].startswith("celery_worker.") else span["name"]
+                stages.setdefault(name, []).append(span["duration"])
+                if "queue_wait" in span["attrs"]:
+                    queue_wait.setdefault(name, []).append(span["attrs"]["queue_wait"])
+    return stages, queue_wait
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(args, workload_info: dict, records: list, duration: float, stages: dict, queue_wait: dict) -> dict:
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    ok = [record for record in records if record["outcome"] == "ok"]
+    images = sum(record["n_images"] for record in ok if record["type"] == "banner")
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("compare", "output", "api_url")
+        },
+        "workload": workload_info,
+        "summary": {
+            "jobs": len(records),
+            "outcomes": outcomes,
+            "coalesced": sum(1 for record in records if record.get("coalesced")),
+            "duration_s": round(duration, 3),
+            "jobs_per_sec": round(len(ok) / duration, 3) if duration else 0.0,
+            "images_per_sec": round(images / duration, 3) if duration else 0.0,
+        },
+        "latency": {
+            "e2e": latency_stats([record["e2e"] for record in ok]),
+            "e2e_banner": latency_stats([record["e2e"] for record in ok if record["type"] == "banner"]),
+            "e2e_title": latency_stats([record["e2e"] for record in ok if record["type"] == "title"]),
+            "submit": latency_stats([record["submit"] for record in records if "submit" in record]),
+        },
+        "stages": {name: latency_stats(values) for name, values in sorted(stages.items())},
+        "queue_wait": {name: latency_stats(values) for name, values in sorted(queue_wait.items())},
+    }
+
+
+def print_report(report: dict):
+    summary = report["summary"]
+    print(f"задач: {summary['jobs']} {summary['outcomes']}, склеено: {summary['coalesced']}, "
+          f"время: {summary['duration_s']} с, задач/с: {summary['jobs_per_sec']}, "
+          f"картинок/с: {summary['images_per_sec']}")
+    print(f"{'метрика':34} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    rows = [(name, stats) for name, stats in report["latency"].items()]
+    rows += [(f"стадия {name}", stats) for name, stats in report["stages"].items()]
+    rows += [(f"очередь {name}", stats) for name, stats in report["queue_wait"].items()]
+    for name, stats in rows:
+        if stats["count"]:
+            print(f"{name:34} {stats['count']:6d} {stats['p50']:8.3f} {stats['p95']:8.3f} "
+                  f"{stats['p99']:8.3f} {stats['max']:8.3f}")
+
+
+def compare_reports(old_path: str, new_path: str):
+    """Изменение p50/p95/p99 и пропускной способности между двумя JSON-отчетами."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def delta(before, after):
+        if not before:
+            return "   —  "
+        return f"{(after - before) / before:+7.1%}"
+
+    print(f"{old_path} ({(old.get('git_commit') or '')[:8]}) -> {new_path} ({(new.get('git_commit') or '')[:8]})")
+    before, after = old["summary"]["jobs_per_sec"], new["summary"]["jobs_per_sec"]
+    print(f"задач/с: {before} -> {after} {delta(before, after)}")
+    print(f"{'метрика':34} {'p50':>22} {'p95':>22} {'p99':>22}")
+    sections = [("", "latency"), ("стадия ", "stages"), ("очередь ", "queue_wait")]
+    for prefix, section in sections:
+        for name, stats in new[section].items():
+            previous = old[section].get(name, {})
+            if not stats.get("count") or not previous.get("count"):
+                continue
+            cells = [f"{previous[q]:7.3f}->{stats[q]:7.3f} {delta(previous[q], stats[q])}" for q in ("p50", "p95", "p99")]
+            print(f"{prefix + name:34} " + " ".join(f"{cell:>22}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", help="JSONL с запросами (формат пакетной загрузки)")
+    parser.add_argument("--requests", type=int, default=50, help="Размер синтетической нагрузки без --workload")
+    parser.add_argument("--title-share", type=float, default=0.2, help="Доля задач только заголовка в синтетике")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--job-timeout", type=float, default=300)
+    parser.add_argument("--warmup", type=int, default=1, help="Задач заголовка до старта замера")
+    parser.add_argument("--cold", action="store_true",
+                        help="Метка прогона в каждом промпте и reuse=false: кэш заголовков и индекс похожих "
+                             "промптов от прошлых прогонов не срабатывают")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="Медиана задержки стенда картинок, с")
+    parser.add_argument("--image-sigma", type=float, default=0.5)
+    parser.add_argument("--image-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Медиана задержки стенда LLM, с")
+    parser.add_argument("--llm-sigma", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--fake-host", default="127.0.0.1", help="Адрес стендов (0.0.0.0 для воркера в docker)")
+    parser.add_argument("--api-url", help="Уже запущенный API; без него API и воркер стартуют здесь")
+    parser.add_argument("--worker-pool", default="threads", help="Пул celery-воркера: threads, prefork, gevent")
+    parser.add_argument("--worker-concurrency", type=int, default=8)
+    parser.add_argument("--output", help="Куда сохранить JSON (по умолчанию benchmarks/results/load_<время>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Сравнить два JSON-отчета")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(*args.compare)
+        return
+
+    if args.workload:
+        jobs = load_workload(args.workload)
+        with open(args.workload, "rb") as f:
+            workload_info = {"source": args.workload, "sha256": hashlib.sha256(f.read()).hexdigest(), "jobs": len(jobs)}
+    else:
+        jobs = synthetic_workload(args.requests, args.title_share, args.seed)
+        workload_info = {"source": "synthetic", "seed": args.seed, "jobs": len(jobs)}
+    if args.cold:
+        run_tag = uuid.uuid4().hex[:8]
+        # Метка не спасает от индекса похожих промптов (одно слово почти не меняет сходство)
+        jobs = [dict(job, prompt=f"{job['prompt']} [{run_tag}]", reuse=False) for job in jobs]
+
+    image_server = start_image_server(args.fake_host, LatencyModel(
+        args.image_latency, args.image_sigma, args.image_error_rate, args.seed))
+    llm_server = start_llm_server(args.fake_host, LatencyModel(
+        args.llm_latency, args.llm_sigma, args.llm_error_rate, args.seed + 1))
+    env = {
+        "POLLINATIONS_URL": server_url(image_server, args.fake_host),
+        "LLM_API_URL": server_url(llm_server, args.fake_host),
+    }
+    print(f"Стенды: POLLINATIONS_URL={env['POLLINATIONS_URL']} LLM_API_URL={env['LLM_API_URL']}")
+
+    processes = []
+    log_dir = tempfile.mkdtemp(prefix="bench_load_")
+    try:
+        api_url = args.api_url
+        if not api_url:
+            api_url, processes = start_stack(args, env, log_dir)
+            print(f"API и воркер запущены, логи: {log_dir}")
+
+        # Прогрев: воркер подключился к брокеру и загрузил модули до начала замера
+        warmup = [{"type": "title", "prompt": f"Прогрев стенда {i} {time.time()}"} for i in range(args.warmup)]
+        warmup_records, _ = run_load(api_url, warmup, 1, args.poll_interval, args.job_timeout)
+        if any(record["outcome"] != "ok" for record in warmup_records):
+            raise RuntimeError(f"Прогрев не удался: {warmup_records}")
+
+        records, duration = run_load(api_url, jobs, args.concurrency, args.poll_interval, args.job_timeout)
+        stages, queue_wait = collect_traces(api_url, [record["trace_id"] for record in records
+                                                      if record.get("trace_id") and record["outcome"] == "ok"])
+    finally:
+        stop_stack(processes)
+        image_server.shutdown()
+        llm_server.shutdown()
+
+    report = build_report(args, workload_info, records, duration, stages, queue_wait)
+    print_report(report)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Отчет: {output}")
+
+
+if __name__ == "__main__":
+    main()
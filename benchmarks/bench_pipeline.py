@@ -0,0 +1,112 @@
+# benchmarks/bench_pipeline.py
+"""
+Бенчмарк пути "скачивание -> композиция баннера".
+
+file   — прежний путь: generate_image пишет banner_*.png, compose_banner читает его снова;
+memory — потоковый путь: fetch_image декодирует ответ из буфера, на диск пишется только баннер.
+
+Вместо image.pollinations.ai поднимается локальный HTTP-сервер с JPEG 1024x1024.
+Каждый режим запускается в отдельном процессе, чтобы пиковый RSS не смешивался.
+
+Запуск из корня проекта:
+    python benchmarks/bench_pipeline.py --banners 10
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_jpeg() -> bytes:
+    """Похожая на фото картинка: плавные пятна цвета + шум."""
+    rng = np.random.default_rng(0)
+    blobs = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((1024, 1024), Image.BICUBIC)
+    photo = np.clip(np.asarray(blobs, dtype=np.float32) + rng.normal(0, 12, (1024, 1024, 3)), 0, 255)
+    buffer = BytesIO()
+    Image.fromarray(photo.astype(np.uint8)).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def start_server(body: bytes):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dir_bytes(path: str) -> int:
+    # Баннеры лежат в шардах generated_media/<xx>/, считаем рекурсивно
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run_mode(mode: str, url: str, banners: int, results):
+    os.environ["POLLINATIONS_URL"] = url
+    from composition_module import CompositionModule
+    from image_generator import ImageGenerator
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        generator = ImageGenerator()
+        started = time.perf_counter()
+        for i in range(banners):
+            if mode == "file":
+                source = generator.generate_image("coffee machine", "Photorealistic", "1:1")
+            else:
+                source = generator.fetch_image("coffee machine", "Photorealistic", "1:1")
+            CompositionModule.compose_banner(source, "Новая кофемашина", output_dir=generator.output_dir)
+        elapsed = time.perf_counter() - started
+        written = dir_bytes(generator.output_dir)
+
+    # ru_maxrss в Linux — в килобайтах
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put((mode, elapsed / banners * 1000, written / banners, peak_rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--banners", type=int, default=10)
+    args = parser.parse_args()
+
+    server = start_server(make_jpeg())
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    for mode in ("file", "memory"):
+        process = ctx.Process(target=run_mode, args=(mode, url, args.banners, results))
+        process.start()
+        process.join()
+
+    print(f"{'режим':8} {'мс/баннер':>10} {'записано/баннер':>16} {'пиковый RSS':>12}")
+    for _ in range(2):
+        mode, ms, written, rss = results.get()
+        print(f"{mode:8} {ms:10.1f} {written / 1024:13.0f} КБ {rss / 1024 ** 2:9.1f} МБ")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
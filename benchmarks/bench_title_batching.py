@@ -0,0 +1,93 @@
+# benchmarks/bench_title_batching.py
+"""
+Пропускная способность локальной LLM заголовков: без батчинга и с микро-батчингом.
+
+Запросы идут из --concurrency потоков одного процесса — так же, как задачи воркера
+с пулом threads (-P threads -c N, см. docker-compose.yml). В prefork каждый дочерний
+процесс выполняет одну задачу за раз, и батчеру нечего объединять.
+
+Для каждого размера из --batch-sizes: TITLE_BATCH_MAX_SIZE = размер (1 — без батчинга),
+--prompts вызовов TextGenerator.generate_title (с --stream — generate_title_stream, как
+задача generate_title_task), итог — заголовков/с и p50/p99 задержки.
+
+Запуск из корня проекта (нужна модель в ./my_llm_manual или --model):
+    python benchmarks/bench_title_batching.py --concurrency 8 --batch-sizes 1,8
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch  # noqa: E402
+from text_generator import TextGenerator  # noqa: E402
+
+TOPICS = ["кофемашина для офиса", "зимние шины", "курсы английского", "доставка пиццы", "фитнес-клуб",
+          "ремонт квартир", "детские игрушки", "туры на море"]
+
+
+def run(batch_size: int, prompts: list, concurrency: int, max_wait_ms: float, stream: bool) -> dict:
+    TextGenerator.BATCH_MAX_SIZE = batch_size
+    TextGenerator.BATCH_MAX_WAIT_MS = max_wait_ms
+    # Новый батчер с новыми параметрами (поток прошлого прогона просто простаивает)
+    TextGenerator._batcher = None
+
+    def timed(prompt: str) -> float:
+        started = time.perf_counter()
+        if stream:
+            TextGenerator.finalize_title(prompt, "".join(TextGenerator.generate_title_stream(prompt)))
+        else:
+            TextGenerator.generate_title(prompt)
+        return time.perf_counter() - started
+
+    torch.manual_seed(0)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, prompts))
+    elapsed = time.perf_counter() - started
+    return {
+        "titles_per_s": len(prompts) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=TextGenerator.LOCAL_MODEL_PATH)
+    parser.add_argument("--prompts", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8, help="Потоков, как -c у пула threads")
+    parser.add_argument("--batch-sizes", default="1,8")
+    parser.add_argument("--max-wait-ms", type=float, default=TextGenerator.BATCH_MAX_WAIT_MS)
+    parser.add_argument("--stream", action="store_true", help="Потоковая генерация, как generate_title_task")
+    args = parser.parse_args()
+
+    TextGenerator.LOCAL_MODEL_PATH = args.model
+    TextGenerator.initialize()
+    if TextGenerator._generator is True:
+        sys.exit(f"Модель не загружена из {args.model}")
+
+    prompts = [f"{TOPICS[i % len(TOPICS)]} #{i}" for i in range(args.prompts)]
+    # Прогрев: первый generate заметно дольше остальных
+    TextGenerator.BATCH_MAX_SIZE = 1
+    TextGenerator.generate_title(prompts[0])
+
+    results = {size: run(size, prompts, args.concurrency, args.max_wait_ms, args.stream)
+               for size in (int(value) for value in args.batch_sizes.split(","))}
+
+    print(f"{'батч':>5} {'заголовков/с':>13} {'p50, мс':>9} {'p99, мс':>9}")
+    for size, result in results.items():
+        print(f"{size:5} {result['titles_per_s']:13.1f} {result['p50_ms']:9.0f} {result['p99_ms']:9.0f}")
+    baseline = results.get(1)
+    if baseline:
+        for size, result in results.items():
+            if size != 1:
+                print(f"батч {size}: x{result['titles_per_s'] / baseline['titles_per_s']:.1f} к размеру 1")
+
+
+if __name__ == "__main__":
+    main()
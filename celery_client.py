@@ -0,0 +1,75 @@
+# celery_client.py
+"""
+Тонкий клиент Celery: приложение, очереди и постановка задач по имени.
+
+API импортирует только этот модуль, а не celery_worker: генераторы (g4f, локальная LLM,
+композиция) и их зависимости загружаются лишь в процессе воркера.
+Воркер использует это же приложение, поэтому брокер, backend и маршруты описаны один раз.
+"""
+import os
+from contextlib import contextmanager
+from celery import Celery
+from kombu.utils.json import dumps
+from result_store import ResultStore
+from telemetry import telemetry
+import task_queues
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+celery_app = Celery('tasks',
+                    broker=f'redis://{REDIS_HOST}:6379/0',
+                    backend=f'redis://{REDIS_HOST}:6379/1')
+# Отдельные очереди для заголовков, баннеров и картинок (см. task_queues.py)
+task_queues.configure(celery_app)
+# Конверты, которые Celery все же хранит (подзадачи chord'а), живут столько же, сколько записи ResultStore
+celery_app.conf.result_expires = ResultStore().ttl
+# Трасса запроса идет в заголовках сообщений, стадии и ожидание в очереди — в метрики
+telemetry.instrument_celery()
+
+# Имена задач воркера: маршруты к ним — в task_queues.TASK_ROUTES
+BANNER_TASK = "celery_worker.placeholder_generation_task"
+TITLE_TASK = "celery_worker.generate_title_task"
+
+
+def send_banner_task(prompt: str, style: str, aspect_ratio: str, n_images: int, **options):
+    """Ставит генерацию баннера. options — как у apply_async (task_id, producer, headers)."""
+    return celery_app.send_task(BANNER_TASK, args=(prompt, style, aspect_ratio, n_images), **options)
+
+
+@contextmanager
+def pipelined_producer():
+    """
+    Producer, чьи сообщения копятся в одном пайплайне Redis и уходят одним обращением к брокеру
+    при выходе из блока. Транспорт Redis kombu кладет каждое сообщение отдельным LPUSH и перед
+    ним читает привязки exchange (SMEMBERS): здесь привязки читаются один раз на exchange,
+    а LPUSH'и идут пайплайном. Для другого брокера — обычный producer.
+    """
+    with celery_app.producer_or_acquire() as producer:
+        channel = producer.channel
+        if not hasattr(channel, "_q_for_pri"):
+            yield producer
+            return
+        pipe = channel.client.pipeline(transaction=False)
+        tables = {}
+        get_table = channel.get_table
+
+        def cached_table(exchange):
+            if exchange not in tables:
+                tables[exchange] = get_table(exchange)
+            return tables[exchange]
+
+        def put(queue, message, **kwargs):
+            # То же, что Channel._put, но в пайплайн
+            priority = channel._get_message_priority(message, reverse=False)
+            pipe.lpush(channel._q_for_pri(queue, priority), dumps(message))
+
+        channel.get_table, channel._put = cached_table, put
+        try:
+            yield producer
+            pipe.execute()
+        finally:
+            del channel.get_table, channel._put
+
+
+def send_title_task(prompt: str, **options):
+    """Ставит генерацию только заголовка."""
+    return celery_app.send_task(TITLE_TASK, args=(prompt,), **options)
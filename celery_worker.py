@@ -84,60 +84,186 @@
 #    return {'title': generated_title}
 
 
-from celery import Celery, shared_task
+from celery import shared_task, group, chord
+from celery.signals import worker_ready, task_postrun
+import base64
 import os
 import uuid
 import time
+from io import BytesIO
 from text_generator import TextGenerator # Убедитесь, что импорт правильный
 from image_generator import ImageGenerator # Импортируем ваш новый генератор
+from composition_module import CompositionModule
+from job_events import JobEvents
+from media_index import MediaIndex
+from admission import AdmissionController
+from singleflight import SingleFlight
+from result_store import ResultStore
+from celery_client import celery_app
+from telemetry import telemetry
+from prompt_index import PromptIndex
+import contextvars
+import sys
 
 # --- Инициализация реальных генераторов ---
 # Если вы уже обновили text_generator.py для GigaChat/OpenAI, используйте его здесь
 text_gen = TextGenerator()
 img_gen = ImageGenerator()
+# События прогресса для SSE-эндпоинта API
+job_events = JobEvents()
+# Индекс generated_media: файлы живых задач защищены от GC
+media_index = MediaIndex(img_gen.output_dir)
 
 # --- Настройка Celery ---
-REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
-celery_app = Celery('tasks',
-                     broker=f'redis://{REDIS_HOST}:6379/0',
-                     backend=f'redis://{REDIS_HOST}:6379/1')
+# Приложение, очереди и трассировка общие с API — см. celery_client.py.
+# Счетчики завершенных задач: по ним API оценивает скорость обслуживания очередей
+admission = AdmissionController(celery_app)
+# Аренды склейки одинаковых запросов снимаются, когда задача завершилась
+singleflight = SingleFlight()
+# Компактные записи результатов (title, пути, время) вместо конвертов Celery
+result_store = ResultStore()
+# Готовые баннеры для почти одинаковых промптов: API отдает их без новой генерации
+prompt_index = PromptIndex()
+
+@task_postrun.connect
+def record_task_completion(sender=None, task_id=None, state=None, retval=None, **kwargs):
+    admission.record_completion(sender.name)
+    if state == "FAILURE":
+        singleflight.release(task_id)
+        result_store.fail(task_id, str(retval))
+        # Подписчики SSE ждут конечное событие: без него клиент висит до своего таймаута
+        job_events.publish(task_id, "failed", error=str(retval))
+        # Упавшая основная задача не держит аренду своих файлов до MEDIA_LIVE_TTL
+        media_index.release(task_id)
+
+def _run_cpu(func, *args, **kwargs):
+    """
+    CPU-работа (композиция, PNG) на gevent-воркере уходит в настоящий поток,
+    иначе она блокирует цикл событий и все остальные скачивания. В prefork — обычный вызов.
+    """
+    if "gevent" in sys.modules:
+        import gevent
+        from gevent import monkey
+        if monkey.is_module_patched("socket"):
+            # Контекст (текущий спан трассы) переносим в поток пула вместе с вызовом
+            context = contextvars.copy_context()
+            return gevent.get_hub().threadpool.apply(context.run, (func,) + args, kwargs)
+    return func(*args, **kwargs)
+
+@worker_ready.connect
+def start_media_gc(**kwargs):
+    # Поток GC живет в главном процессе воркера; между воркерами проход делит блокировка в Redis
+    media_index.start_background_gc()
 
 @shared_task(bind=True)
 def placeholder_generation_task(self, prompt: str, style: str, aspect_ratio: str, n_images: int):
-    """Основная задача: LLM заголовок + Реальное изображение через API."""
+    """Основная задача: LLM заголовок + N изображений параллельно (chord)."""
     
-    print(f"--- Задача получена: '{prompt}' (Стиль: {style}) ---")
+    print(f"--- Задача получена: '{prompt}' (Стиль: {style}, Изображений: {n_images}) ---")
+    # Пока задача выполняется, ее файлы не трогает сборщик мусора
+    media_index.mark_live(self.request.id)
+    result_store.mark_started(self.request.id)
     
-    # 1. Генерация Заголовка (Реальный API или Stub)
-    generated_title = text_gen.generate_title(prompt)
+    # 1. Генерация Заголовка (Реальный API или Stub) — один раз на всю задачу
+    with telemetry.span("title", stage="title"):
+        generated_title = text_gen.generate_title(prompt)
     print(f"--- Заголовок сгенерирован: '{generated_title}' ---")
+    job_id = self.request.id
+    result_store.set_title(job_id, generated_title)
+    job_events.publish(job_id, "title_ready", title=generated_title, n_images=n_images)
+
+    # 2. Раздаем N изображений по воркерам: group из подзадач + финальная агрегация.
+    # replace() подменяет текущую задачу chord'ом с тем же task_id,
+    # поэтому /api/v1/status/{task_id} вернет результат агрегации.
+    header = group(
+        generate_image_task.s(generated_title, style, aspect_ratio, variant, job_id)
+        for variant in range(max(1, n_images))
+    )
+    return self.replace(chord(header, aggregate_images_task.s(
+        generated_title, job_id, prompt=prompt, style=style, aspect_ratio=aspect_ratio
+    )))
+
+def _preview_data_uri(image) -> str:
+    """Превью как data URI JPEG (~10 КБ): помещается в событие и состояние задачи без файла на диске."""
+    buffer = BytesIO()
+    image.convert("RGB").save(buffer, "JPEG", quality=70)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
 
-    # 2. Вызов реального генератора изображений (Pollinations.ai)
-    # Передаем заголовок, стиль и пропорции
+@shared_task(bind=True)
+def generate_image_task(self, title: str, style: str, aspect_ratio: str, variant: int = 0, job_id: str = None):
+    """Подзадача: одно изображение через Pollinations.ai + наложение заголовка."""
+
+    def publish_preview(image):
+        # Превью того же seed приходит за секунды, пока полная картинка еще генерируется
+        preview = _preview_data_uri(image)
+        job_events.publish(job_id, "preview_ready", index=variant, preview=preview)
+        # Промежуточное состояние основной задачи: /api/v1/status покажет превью до результата
+        result_store.set_preview(job_id, preview, index=variant)
+
+    # Передаем заголовок, стиль, пропорции и номер варианта (для детерминированного seed)
     try:
-        file_path = img_gen.generate_image(
-            prompt=generated_title,
+        # Картинка декодируется прямо из буфера ответа, на диск пишется только готовый баннер
+        image = img_gen.fetch_image(
+            prompt=title,
             style=style,
-            aspect_ratio=aspect_ratio
+            aspect_ratio=aspect_ratio,
+            variant=variant,
+            nonce=job_id,
+            on_preview=publish_preview
         )
-        print(f"--- Изображение успешно создано: {file_path} ---")
+        # Заглушка вместо недоступной картинки: баннер помечается как ошибочный и не переиспользуется
+        failed = bool(image.info.get("error"))
+        file_path = _run_cpu(CompositionModule.compose_banner, image, title, output_dir=img_gen.output_dir,
+                             file_prefix="error_banner" if failed else "final_banner")
+        media_index.register(file_path, job_id=job_id, kind="error" if failed else "banner")
+        print(f"--- Баннер успешно создан: {file_path} ---")
     except Exception as e:
         print(f"--- Ошибка воркера при генерации фото: {e} ---")
+        job_events.publish(job_id, "failed", error=str(e))
+        singleflight.release(job_id)
+        result_store.fail(job_id, str(e))
+        # chord упадет и aggregate_images_task не выполнится — снимаем аренду задачи здесь
+        media_index.release(job_id)
         raise e
+    job_events.publish(job_id, "image_ready", index=variant, image_path=file_path)
+    return file_path
 
-    # 3. Возврат результата
-    # Возвращаем относительный путь, чтобы FastAPI мог легко построить URL
-    return {
+# Результат хранится в ResultStore, конверт Celery для него не нужен
+@shared_task(bind=True, ignore_result=True)
+def aggregate_images_task(self, image_paths: list, title: str, job_id: str = None,
+                          prompt: str = None, style: str = None, aspect_ratio: str = None):
+    """
+    Финальный шаг chord'а: собирает пути всех изображений в один результат.
+    prompt/style/aspect_ratio — для индекса похожих промптов (нет у сообщений старых версий).
+    """
+    # Возвращаем относительные пути, чтобы FastAPI мог легко построить URL.
+    # 'image_path' оставлен для совместимости со старым фронтендом.
+    result = {
         'status': 'SUCCESS',
-        'title': generated_title,
-        'image_path': file_path
+        'title': title,
+        'image_path': image_paths[0] if image_paths else None,
+        'image_paths': image_paths
     }
+    result_store.complete(job_id, title=title, image_paths=image_paths)
+    job_events.publish(job_id, "done", result=result)
+    if prompt is not None and not any(os.path.basename(path).startswith("error_") for path in image_paths):
+        prompt_index.add(prompt, style, aspect_ratio, title, image_paths)
+    # Дальше файлы живут по обычным правилам: TTL с последнего обращения и общий бюджет
+    media_index.release(job_id)
+    singleflight.release(job_id)
+    return result
 
-@shared_task(bind=True)
+@shared_task(bind=True, ignore_result=True)
 def generate_title_task(self, prompt: str):
     """Задача только для генерации текста."""
-    generated_title = text_gen.generate_title(prompt)
-    return {'title': generated_title}
+    result_store.mark_started(self.request.id)
+    with telemetry.span("title", stage="title"):
+        generated_title = text_gen.generate_title(prompt)
+    result = {'title': generated_title}
+    result_store.complete(self.request.id, title=generated_title)
+    job_events.publish(self.request.id, "done", result=result)
+    singleflight.release(self.request.id)
+    return result
 =======
 #import os
 #import uuid
@@ -255,9 +381,18 @@ def generate_title_task(self, prompt: str):
 #    
 #    return f"Сгенерировано {result['media_count']} баннеров. Заголовок: {result['title']}. Пути: {', '.join(result['paths'])}"
 
-from celery import Celery
+from celery.signals import worker_init, worker_ready, worker_shutdown, task_postrun
 from text_generator import TextGenerator
 from image_generator import ImageGenerator, save_image_as_png
+from composition_module import CompositionModule
+from job_events import JobEvents
+from media_index import MediaIndex
+from admission import AdmissionController
+from singleflight import SingleFlight
+from result_store import ResultStore
+from celery_client import celery_app
+from telemetry import telemetry
+import gc
 import random
 import os
 import uuid
@@ -266,42 +401,110 @@ import uuid
 # 1. КОНФИГУРАЦИЯ CELERY
 # ==========================================================
 
-# Инициализация Celery
-celery_app = Celery(
-    'media_generator',
-    broker='redis://localhost:6379/0',
-    backend='redis://localhost:6379/0'
-)
+# Приложение Celery (брокер, backend, очереди, трассировка) общее с API — см. celery_client.py.
+# Тяжелые зависимости (transformers, torch) импортирует только этот модуль, API их не загружает.
+# Счетчики завершенных задач: по ним API оценивает скорость обслуживания очередей
+admission = AdmissionController(celery_app)
+# Аренды склейки одинаковых запросов снимаются, когда задача завершилась
+singleflight = SingleFlight()
+# Компактные записи результатов (title, пути, время) вместо конвертов Celery
+result_store = ResultStore()
+
+@task_postrun.connect
+def record_task_completion(sender=None, task_id=None, state=None, retval=None, **kwargs):
+    admission.record_completion(sender.name)
+    singleflight.release(task_id)
+    if state == "FAILURE":
+        result_store.fail(task_id, str(retval))
+        # Подписчики SSE ждут конечное событие: без него клиент висит до своего таймаута
+        job_events.publish(task_id, "failed", error=str(retval))
+
+# События прогресса (в т.ч. токены заголовка) для SSE-эндпоинта API
+job_events = JobEvents()
+# Индекс generated_media и фоновый GC по нему
+media_index = MediaIndex("generated_media")
+
+# Файл готовности: появляется, когда модель загружена и воркер начал брать задачи
+WORKER_READY_FILE = os.environ.get("WORKER_READY_FILE", "/tmp/celery_worker_ready")
+
+# ==========================================================
+# 1.1. ПРЕДЗАГРУЗКА МОДЕЛИ ПРИ СТАРТЕ ВОРКЕРА
+# ==========================================================
+
+@worker_init.connect
+def preload_model(**kwargs):
+    """
+    Загружаем LLM в главном процессе до старта consumer'а очереди.
+    В пуле threads (docker-compose) задачи идут в этом же процессе, и TitleBatcher объединяет
+    их заголовки (и потоковые generate_title_stream, и generate_title) в один generate;
+    в prefork веса (mmap safetensors) остаются общими страницами памяти для всех детей.
+    """
+    if os.path.exists(WORKER_READY_FILE):
+        os.remove(WORKER_READY_FILE)
+    TextGenerator.initialize()
+    # Переносим уже созданные объекты в постоянное поколение GC:
+    # сборщик мусора в детях не будет их трогать и копировать страницы (copy-on-write)
+    gc.freeze()
+
+@worker_ready.connect
+def mark_worker_ready(**kwargs):
+    with open(WORKER_READY_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    # Поток GC живет в главном процессе воркера; между воркерами проход делит блокировка в Redis
+    media_index.start_background_gc()
+
+@worker_shutdown.connect
+def clear_worker_ready(**kwargs):
+    if os.path.exists(WORKER_READY_FILE):
+        os.remove(WORKER_READY_FILE)
 
 # ==========================================================
 # 2. ЗАДАЧА ДЛЯ ГЕНЕРАЦИИ ТОЛЬКО ТЕКСТА (LLM)
 # ==========================================================
 
-@celery_app.task(bind=True)
+# Результат хранится в ResultStore, конверт Celery для него не нужен
+@celery_app.task(bind=True, ignore_result=True)
 def generate_title_task(self, user_prompt: str):
     """Задача Celery для генерации только продающего заголовка."""
+    result_store.mark_started(self.request.id)
     
-    # ЭТОТ ВЫЗОВ ПРИНУДИТЕЛЬНО ЗАПУСТИТ TextGenerator.initialize()
-    # и начнет загрузку вашей ЛОКАЛЬНОЙ LLM.
-    title = TextGenerator.generate_title(user_prompt)
+    # Модель уже загружена в preload_model при старте воркера.
+    # Токены публикуем по мере генерации: клиент видит начало заголовка сразу.
+    # Параллельные задачи процесса генерируются одним батчем (TitleBatcher), токены — по строкам батча
+    parts = []
+    with telemetry.span("title", stage="title"):
+        try:
+            for token in TextGenerator.generate_title_stream(user_prompt):
+                parts.append(token)
+                job_events.publish(self.request.id, "title_token", token=token)
+            title = TextGenerator.finalize_title(user_prompt, "".join(parts))
+        except Exception as e:
+            print(f"Ошибка потоковой генерации: {e}. Возврат к заглушке.")
+            title = TextGenerator._dynamic_fallback_title(user_prompt)
     
-    return {"title": title}
+    result = {"title": title}
+    result_store.complete(self.request.id, title=title)
+    job_events.publish(self.request.id, "done", result=result)
+    return result
 
 
 # ==========================================================
 # 3. ЗАДАЧА ДЛЯ ГЕНЕРАЦИИ БАННЕРА (ТЕКСТ + ИЗОБРАЖЕНИЕ)
 # ==========================================================
 
-@celery_app.task(bind=True)
+@celery_app.task(bind=True, ignore_result=True)
 def placeholder_generation_task(self, user_prompt: str, style: str, aspect_ratio: str, n_images: int):
     """
     Задача Celery для генерации баннеров.
     В текущей версии использует заглушку для изображения и вызывает LLM для текста.
     """
+    result_store.mark_started(self.request.id)
     
     # 1. ГЕНЕРАЦИЯ ЗАГОЛОВКА С ПОМОЩЬЮ LLM
-    # Эта функция при первой попытке загрузит вашу LLM с диска
-    title = TextGenerator.generate_title(user_prompt)
+    # Модель уже загружена в preload_model при старте воркера
+    with telemetry.span("title", stage="title"):
+        title = TextGenerator.generate_title(user_prompt)
+    job_events.publish(self.request.id, "title_ready", title=title, n_images=n_images)
     
     # 2. ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЯ (ЗАГЛУШКА)
     
@@ -317,21 +520,17 @@ def placeholder_generation_task(self, user_prompt: str, style: str, aspect_ratio
         output_dir = "generated_media"
         os.makedirs(output_dir, exist_ok=True)
         
-        # Создание уникального имени файла
-        unique_id = uuid.uuid4()
-        temp_path = os.path.join(output_dir, f"placeholder_{unique_id}.png")
-        
-        # Сохранение заглушки
-        placeholder_image.save(temp_path)
-        print(f"--- ЗАГЛУШКА ИЗОБРАЖЕНИЯ сохранена: {temp_path} ---")
-
-        # Создание пути для финального баннера (чисто текстовая заглушка)
-        final_banner_path = os.path.join(output_dir, f"final_banner_{uuid.uuid4()}.png")
-        
-        # В идеале здесь должно быть наложение текста на заглушку
-        # Но для простоты вернем результат и пути
+        # Заглушка передается в композицию прямо из памяти: на диск пишется только финальный баннер
+        final_banner_path = CompositionModule.compose_banner(placeholder_image, title, output_dir=output_dir)
+        media_index.register(final_banner_path, job_id=self.request.id, kind="banner")
+        print(f"--- Баннер по заглушке сохранен: {final_banner_path} ---")
         
         paths = [final_banner_path] # Список путей
+        result_store.complete(self.request.id, title=title, image_paths=paths)
+        # Та же форма результата, что у aggregate_images_task на основной ветке
+        job_events.publish(self.request.id, "done", result={
+            "status": "SUCCESS", "title": title, "image_path": paths[0], "image_paths": paths,
+        })
         
         return (f"Сгенерировано {n_images} баннеров. "
                 f"Заголовок: {title}. "
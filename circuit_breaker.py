@@ -0,0 +1,138 @@
+# circuit_breaker.py
+import os
+import threading
+import time
+from collections import deque
+import redis
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего API, общий для всех воркеров через Redis.
+
+    closed    — запросы идут как обычно, ошибки подряд считаются;
+    open      — после failure_threshold ошибок запросы сразу отклоняются;
+    half-open — через reset_timeout секунд пропускается один пробный запрос:
+                успех закрывает цепь, ошибка снова открывает ее.
+    """
+
+    KEY_PREFIX = "circuit"
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None, client=None):
+        if failure_threshold is None:
+            failure_threshold = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        if reset_timeout is None:
+            reset_timeout = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._client = client
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("CIRCUIT_BREAKER_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать генерацию
+                retry=None,
+            )
+        return self._client
+
+    @property
+    def _key(self) -> str:
+        return f"{self.KEY_PREFIX}:{self.name}"
+
+    @property
+    def _probe_key(self) -> str:
+        return f"{self.KEY_PREFIX}:{self.name}:probe"
+
+    def state(self) -> str:
+        try:
+            opened_at = self.client.hget(self._key, "opened_at")
+        except redis.RedisError:
+            return "closed"
+        if opened_at is None:
+            return "closed"
+        if time.time() - float(opened_at) >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self, state: str = None) -> bool:
+        """
+        Можно ли сейчас обращаться к API. При недоступном Redis цепь считается закрытой.
+        state — уже прочитанное состояние (чтобы не спрашивать Redis второй раз).
+        """
+        if state is None:
+            state = self.state()
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        # half-open: пробный запрос получает только один воркер
+        try:
+            return bool(self.client.set(self._probe_key, "1", nx=True, ex=max(1, int(self.reset_timeout))))
+        except redis.RedisError:
+            return True
+
+    def record_success(self):
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self._key)
+            pipe.delete(self._probe_key)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Circuit breaker: Redis недоступен: {e} ---")
+
+    def record_failure(self):
+        try:
+            was_probe = self.client.delete(self._probe_key)
+            failures = self.client.hincrby(self._key, "failures", 1)
+            if was_probe or failures >= self.failure_threshold:
+                self.client.hset(self._key, "opened_at", time.time())
+                print(f"--- Circuit breaker '{self.name}' открыт ({failures} ошибок подряд) ---")
+        except redis.RedisError as e:
+            print(f"--- Circuit breaker: Redis недоступен: {e} ---")
+
+
+class AdaptiveTimeout:
+    """Таймаут по наблюдаемым задержкам: перцентиль * запас, в пределах [min, max]."""
+
+    def __init__(self, min_timeout: float = None, max_timeout: float = None,
+                 percentile: float = 0.99, factor: float = 2.0, window: int = 100, min_samples: int = 10):
+        if min_timeout is None:
+            min_timeout = float(os.environ.get("IMAGE_TIMEOUT_MIN", "10"))
+        if max_timeout is None:
+            max_timeout = float(os.environ.get("IMAGE_TIMEOUT_MAX", "60"))
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def record_timeout(self, timeout: float):
+        """
+        Запрос не уложился в таймаут: он попадает в окно со значением таймаута.
+        Иначе при росте задержек выше p99 * factor окно не растет, все запросы
+        обрываются по старому таймауту, а цепь открывается и не может закрыться.
+        """
+        self.record(timeout)
+
+    def current(self) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        # Пока данных мало, ждем по максимуму, как раньше
+        if len(latencies) < self.min_samples:
+            return self.max_timeout
+        value = latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile))]
+        return min(max(value * self.factor, self.min_timeout), self.max_timeout)
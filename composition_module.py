@@ -1,8 +1,12 @@
 # composition_module.py
 from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+import numpy as np
 import os
 import textwrap
 import uuid
+from media_index import shard_path
+from telemetry import telemetry
 
 class CompositionModule:
     
@@ -11,70 +15,201 @@ class CompositionModule:
     # Если это не сработает, нужно будет скачать файл .ttf (например, 'arial.ttf')
     FONT_PATH = "Arial.ttf"
 
+    # Смещение тени (черный контур) в пикселях
+    SHADOW_OFFSET = 5
+
+    # Форматы размещения рекламы: имя -> (ширина, высота)
+    PRESETS = {
+        "landscape": (1920, 1080),
+        "square": (1080, 1080),
+        "portrait": (1080, 1920),
+        "thumbnail": (480, 270),
+        "thumbnail_square": (320, 320),
+    }
+
+    # Расширения для поддерживаемых форматов сохранения
+    FORMAT_EXTENSIONS = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg"}
+
     @staticmethod
     def _find_font(size):
         """Пытается загрузить шрифт. В случае ошибки использует шрифт по умолчанию."""
+        # Шрифт читается с диска один раз на (путь, размер), дальше берется из кэша
+        return CompositionModule._load_font(CompositionModule.FONT_PATH, size)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _load_font(font_path, size):
         try:
             # Попытка загрузить шрифт по указанному пути/имени
-            return ImageFont.truetype(CompositionModule.FONT_PATH, size)
+            return ImageFont.truetype(font_path, size)
         except IOError:
-            print(f"ВНИМАНИЕ: Шрифт {CompositionModule.FONT_PATH} не найден. Используется шрифт по умолчанию.")
+            print(f"ВНИМАНИЕ: Шрифт {font_path} не найден. Используется шрифт по умолчанию.")
             # Используем шрифт по умолчанию, который может не поддерживать кириллицу
             return ImageFont.load_default()
 
     @staticmethod
-    def compose_banner(image_path: str, title: str, output_dir: str = "generated_media") -> str:
+    @lru_cache(maxsize=64)
+    def _text_layers(text, font_path, size, shadow_offset):
         """
-        Компоновка баннера: наложение текста на изображение 1920x1080.
+        Маски текста и тени (режим 'L') для заголовка.
+        Текст растеризуется один раз, тень — это 8 сдвигов маски, смешанных векторно.
         """
-        
-        # 1. ЗАГРУЗКА/ПОДГОТОВКА ИЗОБРАЖЕНИЯ
-        try:
-            img = Image.open(image_path)
-            # Изменяем размер до требуемого 1920x1080
-            if img.size != (1920, 1080):
-                 img = img.resize((1920, 1080), Image.Resampling.LANCZOS)
-        except FileNotFoundError:
-            # Запасной вариант, если даже заглушка не была создана (для устойчивости)
-            print(f"Ошибка: Исходный файл изображения {image_path} не найден. Создание серой заглушки.")
-            img = Image.new('RGB', (1920, 1080), color = 'gray')
-            draw_error = ImageDraw.Draw(img)
-            draw_error.text((10,10), "ОШИБКА: Изображение отсутствует", fill=(255,255,255))
-        
-        draw = ImageDraw.Draw(img)
-        
-        # 2. НАСТРОЙКА И КОМПОЗИЦИЯ ТЕКСТА
-        font_size = 90
-        font = CompositionModule._find_font(font_size)
+        font = CompositionModule._load_font(font_path, size)
+        pad = shadow_offset
+
+        # Размер текста с отступом под тень со всех сторон
+        measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+        _, _, right, bottom = measure.multiline_textbbox((0, 0), text, font=font)
+        text_mask = Image.new('L', (right + 2 * pad, bottom + 2 * pad), 0)
+        ImageDraw.Draw(text_mask).multiline_text((pad, pad), text, font=font, fill=255)
+
+        # Отступ равен смещению, поэтому np.roll не переносит текст через край.
+        # Прозрачность перемножается так же, как при 8 последовательных draw.text черным
+        coverage = np.asarray(text_mask, dtype=np.float32) / 255.0
+        transparency = np.ones_like(coverage)
+        for dx in (-pad, 0, pad):
+            for dy in (-pad, 0, pad):
+                if dx != 0 or dy != 0:
+                    transparency *= 1.0 - np.roll(coverage, (dy, dx), axis=(0, 1))
+        shadow = np.rint((1.0 - transparency) * 255.0).astype(np.uint8)
+
+        return text_mask, Image.fromarray(shadow)
+
+    @staticmethod
+    def _draw_title(img, title: str, font_size: int = 90, margin_x: int = 70, margin_y: int = 50,
+                    shadow_offset: int = None):
+        """Накладывает заголовок с тенью на изображение (in-place)."""
         text_color = (255, 255, 255)  # Белый цвет
         
         # Перенос строки (максимум 20 символов на строку для большого заголовка)
         wrapped_text = textwrap.fill(title, width=20)
         
         # Расположение (Верхний левый угол)
-        margin_x = 70
-        margin_y = 50
         x = margin_x
         y = margin_y
 
         # Добавляем тень (черный контур) для читаемости (критерий хакатона)
         shadow_color = (0, 0, 0)
-        shadow_offset = 5 # Смещение тени
+        if shadow_offset is None:
+            shadow_offset = CompositionModule.SHADOW_OFFSET
+        text_mask, shadow_mask = CompositionModule._text_layers(
+            wrapped_text, CompositionModule.FONT_PATH, font_size, shadow_offset
+        )
         
-        # Рисуем тень
-        for dx in [-shadow_offset, 0, shadow_offset]:
-            for dy in [-shadow_offset, 0, shadow_offset]:
-                if dx != 0 or dy != 0:
-                    draw.text((x + dx, y + dy), wrapped_text, font=font, fill=shadow_color)
-                    
-        # Рисуем сам текст
-        draw.text((x, y), wrapped_text, font=font, fill=text_color)
+        # Тень и текст накладываются по готовым маскам: два paste вместо девяти draw.text
+        origin = (x - shadow_offset, y - shadow_offset)
+        img.paste(shadow_color, origin, shadow_mask)
+        img.paste(text_color, origin, text_mask)
+
+    @staticmethod
+    def compose_banner(image_path, title: str, output_dir: str = "generated_media",
+                       file_prefix: str = "final_banner") -> str:
+        """
+        Компоновка баннера: наложение текста на изображение 1920x1080.
+        image_path — путь к файлу или уже декодированное PIL.Image (без повторного чтения с диска).
+        file_prefix — начало имени файла (error_banner — баннер поверх заглушки ошибки).
+        """
+        
+        # 1. ЗАГРУЗКА/ПОДГОТОВКА ИЗОБРАЖЕНИЯ
+        with telemetry.span("composition", stage="composition"):
+            try:
+                img = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
+                # Текст накладывается цветом RGB, поэтому приводим палитру/альфу к RGB
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                # Изменяем размер до требуемого 1920x1080
+                if img.size != (1920, 1080):
+                     img = img.resize((1920, 1080), Image.Resampling.LANCZOS)
+            except FileNotFoundError:
+                # Запасной вариант, если даже заглушка не была создана (для устойчивости)
+                print(f"Ошибка: Исходный файл изображения {image_path} не найден. Создание серой заглушки.")
+                img = Image.new('RGB', (1920, 1080), color = 'gray')
+                draw_error = ImageDraw.Draw(img)
+                draw_error.text((10,10), "ОШИБКА: Изображение отсутствует", fill=(255,255,255))
+        
+            # 2. НАСТРОЙКА И КОМПОЗИЦИЯ ТЕКСТА
+            CompositionModule._draw_title(img, title)
         
         # 3. СОХРАНЕНИЕ ФИНАЛЬНОГО БАННЕРА
         # Используем уникальный идентификатор для имени файла
-        unique_name = f"final_banner_{uuid.uuid4()}.png"
-        save_path = os.path.join(output_dir, unique_name)
+        unique_name = f"{file_prefix}_{uuid.uuid4()}.png"
+        save_path = shard_path(output_dir, unique_name)
         
-        img.save(save_path)
+        CompositionModule._save_atomic(img, save_path, "PNG")
         
         return save_path
+
+    @staticmethod
+    def _save_atomic(img, save_path, output_format, **save_kwargs):
+        # Недописанный файл остается только как *.tmp, его уберет GC generated_media
+        tmp_path = f"{save_path}.{os.getpid()}.tmp"
+        # Стадия disk_write включает кодирование (PNG/WEBP) — именно оно занимает большую часть времени
+        with telemetry.span("disk_write", stage="disk_write", format=output_format):
+            img.save(tmp_path, output_format, **save_kwargs)
+            os.replace(tmp_path, save_path)
+
+    @staticmethod
+    def _fit(img, size):
+        """Масштабирует с обрезкой по центру до size без искажения пропорций."""
+        target_w, target_h = size
+        src_w, src_h = img.size
+        scale = max(target_w / src_w, target_h / src_h)
+        crop_w, crop_h = target_w / scale, target_h / scale
+        left = (src_w - crop_w) / 2
+        top = (src_h - crop_h) / 2
+        # box вырезает нужную область прямо при ресайзе, reducing_gap ускоряет сильное уменьшение
+        return img.resize(size, Image.Resampling.LANCZOS, box=(left, top, left + crop_w, top + crop_h),
+                          reducing_gap=3.0)
+
+    @staticmethod
+    def compose_variants(image, title: str, presets=None, output_dir: str = "generated_media",
+                         output_format: str = "PNG", quality: int = 85) -> dict:
+        """
+        Рендер баннера сразу в нескольких форматах размещения.
+
+        image — путь к файлу или уже открытое PIL.Image: исходник декодируется один раз.
+        presets — список имен из PRESETS (по умолчанию все).
+        output_format — PNG, WEBP или JPEG; quality используется для WEBP/JPEG.
+        Возвращает словарь {имя_пресета: путь}.
+        """
+        if presets is None:
+            presets = list(CompositionModule.PRESETS)
+        output_format = output_format.upper()
+        extension = CompositionModule.FORMAT_EXTENSIONS[output_format]
+
+        # 1. ОДНО ДЕКОДИРОВАНИЕ ИСХОДНИКА
+        source = Image.open(image) if isinstance(image, str) else image
+        if source.mode != 'RGB':
+            source = source.convert('RGB')
+        else:
+            source.load()
+
+        save_kwargs = {} if output_format == "PNG" else {"quality": quality}
+        if output_format == "WEBP":
+            save_kwargs["method"] = 4
+        elif output_format == "JPEG":
+            save_kwargs["optimize"] = True
+
+        batch_id = uuid.uuid4().hex[:8]
+        paths = {}
+        for name in presets:
+            size = CompositionModule.PRESETS[name]
+            canvas = CompositionModule._fit(source, size)
+
+            # 2. РАСКЛАДКА ЗАГОЛОВКА ПОД ПРОПОРЦИИ (эталон — 90px на стороне 1080)
+            scale = min(size) / 1080
+            CompositionModule._draw_title(
+                canvas,
+                title,
+                font_size=max(10, round(90 * scale)),
+                margin_x=round(70 * scale),
+                margin_y=round(50 * scale),
+                shadow_offset=max(1, round(CompositionModule.SHADOW_OFFSET * scale))
+            )
+
+            # 3. КОДИРОВАНИЕ В НУЖНЫЙ ФОРМАТ
+            save_path = shard_path(output_dir, f"final_banner_{batch_id}_{name}.{extension}")
+            CompositionModule._save_atomic(canvas, save_path, output_format, **save_kwargs)
+            paths[name] = save_path
+
+        return paths
@@ -1,6 +1,7 @@
 import streamlit as st
 import requests
-import time
+import base64
+import json
 import os
 
 # Настройка страницы
@@ -9,6 +10,9 @@ st.set_page_config(page_title="AI Banner Generator", page_icon="🎨", layout="w
 st.title("🎨 AI Генератор Баннеров")
 st.markdown("Система на базе FastAPI, Celery и Streamlit")
 
+# Ширина превью в галерее (половина wide-макета); полный размер — по ссылке
+PREVIEW_WIDTH = 960
+
 # Настройки сервера
 with st.sidebar:
     st.header("⚙️ Конфигурация")
@@ -46,49 +50,83 @@ if st.button("🚀 Запустить генерацию", use_container_width=T
                     task_id = response.json().get("task_id")
                     st.info(f"✅ Задача принята! ID: {task_id}")
                     
-                    # 2. Опрос статуса (Polling)
-                    completed = False
-                    while not completed:
-                        st.write("⏳ Ожидание завершения воркера...")
-                        status_res = requests.get(f"{API_URL}/api/v1/status/{task_id}")
-                        data = status_res.json()
-                        
-                        if data.get("status") == "SUCCESS":
-                            status.update(label="✨ Генерация завершена!", state="complete")
-                            result = data.get("result", {})
-                            
-                            st.divider()
-                            col1, col2 = st.columns([1, 1])
+                    # 2. Подписка на события задачи (SSE) вместо опроса статуса каждые 2 секунды
+                    result = None
+                    failed = False
+                    # Место под каждый вариант: сначала превью, потом отметка о готовом изображении
+                    preview_slots = {}
+                    events_url = f"{API_URL}/api/v1/events/{task_id}"
+                    with requests.get(events_url, stream=True, timeout=(5, 120)) as events:
+                        for raw_line in events.iter_lines():
+                            line = raw_line.decode("utf-8")
+                            if not line.startswith("data:"):
+                                continue
+                            event = json.loads(line[len("data:"):])
+                            kind = event.get("event")
                             
-                            with col1:
-                                st.subheader("📝 Сгенерированный заголовок")
-                                # Проверяем, есть ли заголовок в результате
-                                title = result.get("title", "Заголовок успешно создан")
-                                st.success(title)
+                            if kind == "queued":
+                                st.write("⏳ Задача в очереди...")
+                            elif kind == "title_ready":
+                                st.write(f"📝 Заголовок готов: {event.get('title')}")
+                            elif kind == "preview_ready":
+                                index = event.get("index", 0)
+                                if index not in preview_slots:
+                                    preview_slots[index] = st.empty()
+                                # Превью приходит как data URI JPEG
+                                preview_bytes = base64.b64decode(event["preview"].split(",", 1)[1])
+                                preview_slots[index].image(preview_bytes, caption=f"Превью {index + 1}, полное изображение в работе...")
+                            elif kind == "image_ready":
+                                st.write(f"🖼 Изображение {event.get('index', 0) + 1} готово")
+                            elif kind == "done":
+                                result = event.get("result", {})
+                                break
+                            elif kind == "failed":
+                                failed = True
+                                break
+                    
+                    if result is not None:
+                        # Сворачиваем блок с превью: ниже их заменяют готовые баннеры
+                        status.update(label="✨ Генерация завершена!", state="complete", expanded=False)
+                        
+                        st.divider()
+                        col1, col2 = st.columns([1, 1])
+                        
+                        with col1:
+                            st.subheader("📝 Сгенерированный заголовок")
+                            # Проверяем, есть ли заголовок в результате
+                            title = result.get("title", "Заголовок успешно создан")
+                            st.success(title)
+                        
+                        with col2:
+                            st.subheader("🖼 Результат")
+                            # Воркер возвращает список путей (по одному на вариант)
+                            img_paths = result.get("image_paths") or [result.get("image_path")]
+                            img_paths = [p for p in img_paths if p]
+                            # API добавляет неизменяемые URL с хэшем: браузер кэширует их навсегда
+                            # Ссылки есть не у всех путей (файл мог удалить GC) — сопоставляем по имени файла
+                            img_urls = {url.rsplit("/", 1)[-1]: url for url in result.get("image_urls") or [] if url}
                             
-                            with col2:
-                                st.subheader("🖼 Результат")
-                                img_path = result.get("image_path")
-                                
-                                if img_path:
-                                    # Формируем URL для отображения через ваш StaticFiles mount
-                                    # Берем только имя файла из пути 'generated_media/file.png'
-                                    file_name = os.path.basename(img_path)
-                                    full_img_url = f"{API_URL}/media/{file_name}"
+                            if img_paths:
+                                for img_path in img_paths:
+                                    img_url = img_urls.get(os.path.basename(img_path))
+                                    if img_url:
+                                        # Копия под ширину колонки; WebP/AVIF браузер получит сам по Accept
+                                        preview_url = f"{API_URL}{img_url}?w={PREVIEW_WIDTH}"
+                                        full_img_url = f"{API_URL}{img_url}"
+                                    else:
+                                        # Старый путь через StaticFiles mount
+                                        # Берем путь внутри generated_media: 'generated_media/ab/file.png' -> 'ab/file.png'
+                                        file_name = img_path.replace(os.sep, "/").split("generated_media/", 1)[-1]
+                                        preview_url = full_img_url = f"{API_URL}/media/{file_name}"
                                     
-                                    st.image(full_img_url, caption=f"Стиль: {style}", use_container_width=True)
+                                    st.image(preview_url, caption=f"Стиль: {style}", use_container_width=True)
                                     st.caption(f"Ссылка: {full_img_url}")
-                                else:
-                                    st.warning("Путь к изображению не найден в ответе.")
-                            
-                            completed = True
-                        
-                        elif data.get("status") in ["FAILURE", "REVOKED"]:
-                            st.error("❌ Ошибка на стороне воркера.")
-                            break
-                        else:
-                            # Статусы PENDING или STARTED
-                            time.sleep(2)
+                            else:
+                                st.warning("Путь к изображению не найден в ответе.")
+                    elif failed:
+                        st.error("❌ Ошибка на стороне воркера.")
+                    else:
+                        st.error("❌ Поток событий оборвался до завершения задачи.")
                 else:
                     st.error(f"❌ Сервер ответил ошибкой: {response.status_code}")
                     
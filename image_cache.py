@@ -0,0 +1,117 @@
+# image_cache.py
+import hashlib
+import json
+import os
+import threading
+
+
+class ImageCache:
+    """
+    Контентно-адресуемый кэш готовых изображений на диске.
+
+    Ключ — хэш канонического запроса (prompt, style, aspect_ratio, seed).
+    Файлы лежат в generated_media как cache_<hash>.png, время последнего
+    доступа хранится в mtime, поэтому LRU работает и между процессами воркера.
+    """
+
+    FILE_PREFIX = "cache_"
+    FILE_SUFFIX = ".png"
+
+    def __init__(self, output_dir: str = "generated_media", max_bytes: int = None):
+        self.output_dir = output_dir
+        # Бюджет на диске (по умолчанию 1 ГБ)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(1024 ** 3)))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(prompt: str, style: str, aspect_ratio: str, seed: int) -> str:
+        """Хэш канонического представления запроса."""
+        canonical = json.dumps(
+            {
+                "prompt": " ".join(prompt.split()),
+                "style": style,
+                "aspect_ratio": aspect_ratio,
+                "seed": int(seed),
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.output_dir, f"{self.FILE_PREFIX}{key}{self.FILE_SUFFIX}")
+
+    def get(self, key: str):
+        """Возвращает путь к закэшированному файлу или None."""
+        path = self._path(key)
+        try:
+            # Обновляем mtime — это и есть отметка "последний доступ" для LRU
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key: str, content: bytes) -> str:
+        """Сохраняет изображение атомарно и при необходимости вытесняет старые записи."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        """Список (mtime, size, path) всех файлов кэша."""
+        entries = []
+        with os.scandir(self.output_dir) as it:
+            for entry in it:
+                name = entry.name
+                if not (name.startswith(self.FILE_PREFIX) and name.endswith(self.FILE_SUFFIX)):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def _evict(self, keep: str = None):
+        """Удаляет самые давно использованные файлы, пока кэш не уложится в бюджет."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
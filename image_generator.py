@@ -2,43 +2,244 @@
 import requests
 import os
 import uuid
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from PIL import Image
 from io import BytesIO
+from image_cache import ImageCache
+from circuit_breaker import CircuitBreaker, AdaptiveTimeout
+from media_index import MediaIndex, shard_path
+from telemetry import telemetry
 
 class ImageGenerator:
-    def __init__(self):
+    # Адрес API генерации (можно подменить локальным стендом для тестов)
+    BASE_URL = os.environ.get("POLLINATIONS_URL", "https://image.pollinations.ai")
+    # Максимум одновременных keep-alive соединений к одному хосту. Пул общий для всех задач
+    # процесса: в gevent-воркере его размер должен совпадать с -c (см. docker-compose.yml)
+    MAX_CONNECTIONS_PER_HOST = int(os.environ.get("IMAGE_MAX_CONNECTIONS", "4"))
+    # У превью свой пул: они не занимают соединения полных картинок и не ждут за ними
+    PREVIEW_MAX_CONNECTIONS = int(os.environ.get("IMAGE_PREVIEW_MAX_CONNECTIONS", str(MAX_CONNECTIONS_PER_HOST)))
+    # Детерминированный seed: одинаковый запрос -> одинаковая картинка -> попадание в кэш
+    DETERMINISTIC_SEED = os.environ.get("IMAGE_DETERMINISTIC_SEED", "0") == "1"
+    # Таймаут на установку соединения; таймаут чтения адаптивный
+    CONNECT_TIMEOUT = float(os.environ.get("IMAGE_CONNECT_TIMEOUT", "5"))
+    # Размер куска при потоковом чтении ответа и предел размера картинки
+    CHUNK_SIZE = 64 * 1024
+    MAX_IMAGE_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+    # Размер полного изображения и быстрого превью (тот же seed, меньше пикселей)
+    IMAGE_SIZE = 1024
+    PREVIEW_SIZE = int(os.environ.get("IMAGE_PREVIEW_SIZE", "256"))
+    PREVIEW_TIMEOUT = float(os.environ.get("IMAGE_PREVIEW_TIMEOUT", "15"))
+
+    def __init__(self, deterministic_seed: bool = None):
         self.output_dir = "generated_media"
         os.makedirs(self.output_dir, exist_ok=True)
+        self.session = self._create_session(self.MAX_CONNECTIONS_PER_HOST)
+        self.preview_session = self._create_session(self.PREVIEW_MAX_CONNECTIONS)
+        if deterministic_seed is None:
+            deterministic_seed = self.DETERMINISTIC_SEED
+        self.deterministic_seed = deterministic_seed
+        self.cache = ImageCache(self.output_dir)
+        # Индекс файлов generated_media: по нему GC соблюдает бюджет и TTL
+        self.media_index = MediaIndex(self.output_dir)
+        # Общий для всех воркеров предохранитель: при падении API не ждем таймаут
+        self.breaker = CircuitBreaker("pollinations")
+        self.timeout = AdaptiveTimeout()
+
+    @staticmethod
+    def _create_session(max_connections: int) -> requests.Session:
+        """Общая сессия с пулом соединений: TCP+TLS рукопожатие один раз на соединение."""
+        session = requests.Session()
+        # pool_block=True — не открываем больше max_connections соединений,
+        # лишние запросы ждут свободное соединение из пула
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            pool_block=True
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def generate_images(self, prompts: list, style: str, aspect_ratio: str) -> list:
+        """Скачивает несколько изображений одновременно. Порядок путей совпадает с prompts."""
+        if not prompts:
+            return []
+        workers = min(len(prompts), self.MAX_CONNECTIONS_PER_HOST)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda item: self.generate_image(item[1], style, aspect_ratio, variant=item[0]),
+                enumerate(prompts)
+            ))
 
-    def generate_image(self, prompt: str, style: str, aspect_ratio: str) -> str:
+    @staticmethod
+    def _deterministic_seed(prompt: str, style: str, aspect_ratio: str, variant: int = 0) -> int:
+        """Seed, выведенный из самого запроса (стабилен между процессами)."""
+        # variant различает N вариантов одного запроса, иначе все картинки совпадут
+        digest = hashlib.sha256(f"{prompt}|{style}|{aspect_ratio}|{variant}".encode("utf-8")).hexdigest()
+        return int(digest[:8], 16)
+
+    def _prepare_request(self, prompt: str, style: str, aspect_ratio: str, seed: int = None, variant: int = 0,
+                         nonce: str = None, size: int = None):
+        """URL запроса и ключ кэша (None, если seed случайный)."""
         # Убираем лишние символы переноса строки из промпта
         clean_prompt = prompt.replace('\n', ' ').strip()
         full_prompt = f"{clean_prompt}, {style} style, high quality"
         encoded_prompt = requests.utils.quote(full_prompt)
-        
+
+        # Кэшировать имеет смысл только при фиксированном seed
+        if seed is None and self.deterministic_seed:
+            seed = self._deterministic_seed(clean_prompt, style, aspect_ratio, variant)
+        cache_key = None
+        if seed is not None:
+            cache_key = ImageCache.make_key(clean_prompt, style, aspect_ratio, seed)
+        elif nonce is not None:
+            # Seed из id задачи: превью и полная картинка совпадут, но в кэш такой запрос не попадает
+            seed = self._deterministic_seed(clean_prompt, style, aspect_ratio, f"{nonce}/{variant}")
+        else:
+            seed = uuid.uuid4().int
+
+        size = size or self.IMAGE_SIZE
         # Добавляем параметр ?enhance=false (иногда ускоряет) и меняем seed
-        image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width=1024&height=1024&nologo=true&enhance=false&seed={uuid.uuid4().int}"
+        image_url = f"{self.BASE_URL}/prompt/{encoded_prompt}?width={size}&height={size}&nologo=true&enhance=false&seed={seed}"
+        return image_url, cache_key
+
+    def _download(self, image_url: str, read_timeout: float = None):
+        """
+        Потоковое скачивание тела ответа в BytesIO (кусками, без response.content).
+        Возвращает BytesIO или None, если API недоступен или ответил ошибкой.
+        С явным read_timeout (превью) задержки и ошибки не учитываются в статистике.
+        """
+        tracked = read_timeout is None
+        state = self.breaker.state()
+        # Превью идет только при замкнутой цепи и не забирает пробный запрос half-open
+        if not tracked and state != "closed":
+            return None
+        # Цепь разомкнута — API лежит, сразу отдаем заглушку и освобождаем воркер
+        if tracked and not self.breaker.allow_request(state):
+            print("--- Pollinations недоступен (circuit open), возвращаем заглушку ---")
+            telemetry.inc("banner_image_errors_total", reason="circuit_open")
+            return None
 
+        span = telemetry.start_span("download" if tracked else "preview_download")
+        started = time.monotonic()
+        if tracked:
+            # Таймаут чтения подстраивается под наблюдаемые задержки (не больше 60 секунд).
+            # Пробный запрос half-open ждет по максимуму: по короткому таймауту,
+            # из-за которого цепь открылась, он тоже не прошел бы
+            read_timeout = self.timeout.max_timeout if state == "half-open" else self.timeout.current()
+        session = self.session if tracked else self.preview_session
         try:
-            # Увеличиваем время ожидания до 60 секунд
-            response = requests.get(image_url, timeout=60)
-            if response.status_code == 200:
-                file_name = f"banner_{uuid.uuid4().hex[:8]}.png"
-                file_path = os.path.join(self.output_dir, file_name)
-                
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
-                return file_path
-            else:
-                raise Exception(f"Status: {response.status_code}")
-                
+            with session.get(image_url, timeout=(self.CONNECT_TIMEOUT, read_timeout), stream=True) as response:
+                if response.status_code != 200:
+                    raise Exception(f"Status: {response.status_code}")
+                body = BytesIO()
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    body.write(chunk)
+                    if body.tell() > self.MAX_IMAGE_BYTES:
+                        raise Exception(f"Ответ больше {self.MAX_IMAGE_BYTES} байт")
+            if tracked:
+                self.timeout.record(time.monotonic() - started)
+                self.breaker.record_success()
         except Exception as e:
             print(f"Ошибка API: {e}")
-            # Создаем не просто синий квадрат, а хотя бы серый фон с текстом ошибки
-            file_path = os.path.join(self.output_dir, f"error_{uuid.uuid4().hex[:8]}.png")
-            img = Image.new('RGB', (1024, 1024), color=(50, 50, 50))
-            img.save(file_path)
-            return file_path
+            telemetry.end_span(span, error=type(e).__name__)
+            if tracked:
+                elapsed = time.monotonic() - started
+                if isinstance(e, (requests.Timeout, requests.ConnectionError)) or elapsed >= read_timeout:
+                    # Оборванный по таймауту запрос поднимает окно задержек, иначе таймаут не вырастет
+                    self.timeout.record_timeout(max(elapsed, read_timeout))
+                else:
+                    self.timeout.record(elapsed)
+                self.breaker.record_failure()
+                telemetry.inc("banner_image_errors_total", reason="download_failed")
+            return None
+        # В гистограмму стадий идут только полные скачивания, превью — лишь в трассу
+        telemetry.end_span(span, stage="download" if tracked else None, bytes=body.tell())
+
+        body.seek(0)
+        return body
+
+    def fetch_image(self, prompt: str, style: str, aspect_ratio: str, seed: int = None, variant: int = 0,
+                    nonce: str = None, on_preview=None) -> Image.Image:
+        """
+        Изображение в памяти для композиции: ответ декодируется прямо из буфера,
+        промежуточный banner_*.png на диск не пишется (только запись в кэш, если seed фиксирован).
+
+        on_preview(image) — вызывается из фонового потока с превью PREVIEW_SIZE того же seed,
+        если оно пришло раньше полного изображения. nonce (id задачи) делает seed общим
+        для превью и полной картинки, когда детерминированный seed выключен.
+        """
+        image_url, cache_key = self._prepare_request(prompt, style, aspect_ratio, seed, variant, nonce)
+        if cache_key:
+            cached_path = self.cache.get(cache_key)
+            if cached_path:
+                return Image.open(cached_path)
+
+        finished = threading.Event()
+        if on_preview is not None:
+            preview_url, _ = self._prepare_request(prompt, style, aspect_ratio, seed, variant, nonce,
+                                                   size=self.PREVIEW_SIZE)
+            threading.Thread(target=self._fetch_preview, args=(preview_url, finished, on_preview),
+                             daemon=True).start()
+        try:
+            body = self._download(image_url)
+        finally:
+            finished.set()
+        if body is None:
+            return self._error_canvas()
+        if cache_key:
+            self.cache.put(cache_key, body.getbuffer())
+        return Image.open(body)
+
+    def _fetch_preview(self, preview_url: str, finished: threading.Event, on_preview):
+        """Скачивает превью параллельно с полной картинкой; опоздавшее превью не публикуется."""
+        body = self._download(preview_url, read_timeout=self.PREVIEW_TIMEOUT)
+        if body is None or finished.is_set():
+            return
+        try:
+            on_preview(Image.open(body))
+        except Exception as e:
+            print(f"--- Не удалось опубликовать превью: {e} ---")
+
+    def generate_image(self, prompt: str, style: str, aspect_ratio: str, seed: int = None, variant: int = 0) -> str:
+        image_url, cache_key = self._prepare_request(prompt, style, aspect_ratio, seed, variant)
+        if cache_key:
+            cached_path = self.cache.get(cache_key)
+            if cached_path:
+                return cached_path
+
+        body = self._download(image_url)
+        if body is None:
+            return self._error_image()
+
+        if cache_key:
+            return self.cache.put(cache_key, body.getbuffer())
+
+        file_name = f"banner_{uuid.uuid4().hex[:8]}.png"
+        file_path = shard_path(self.output_dir, file_name)
+        
+        with open(file_path, "wb") as f:
+            f.write(body.getbuffer())
+        self.media_index.register(file_path, kind="banner")
+        return file_path
+
+    @staticmethod
+    def _error_canvas() -> Image.Image:
+        # Создаем не просто синий квадрат, а хотя бы серый фон с текстом ошибки
+        image = Image.new('RGB', (1024, 1024), color=(50, 50, 50))
+        # Метка для воркера: баннер из заглушки не попадает в индекс похожих промптов
+        image.info["error"] = True
+        return image
+
+    def _error_image(self) -> str:
+        file_path = shard_path(self.output_dir, f"error_{uuid.uuid4().hex[:8]}.png")
+        self._error_canvas().save(file_path)
+        self.media_index.register(file_path, kind="error")
+        return file_path
 =======
 from PIL import Image
 
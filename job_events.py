@@ -0,0 +1,110 @@
+# job_events.py
+import json
+import os
+import redis
+import redis.asyncio as aioredis
+
+
+class JobEvents:
+    """
+    События прогресса задачи через Redis pub/sub.
+
+    Воркер публикует переходы (queued, title_ready, preview_ready, image_ready, done, failed)
+    в канал job_events:<task_id> и дублирует их в короткоживущий список,
+    чтобы клиент, подключившийся позже, получил уже прошедшие события.
+    """
+
+    KEY_PREFIX = "job_events"
+    # Финальные события, после которых поток закрывается
+    TERMINAL_EVENTS = ("done", "failed")
+
+    def __init__(self, ttl: int = None, client=None, async_client=None):
+        if ttl is None:
+            ttl = int(os.environ.get("JOB_EVENTS_TTL", "3600"))
+        self.ttl = ttl
+        self._client = client
+        self._async_client = async_client
+
+    @staticmethod
+    def _redis_kwargs() -> dict:
+        return {
+            "host": os.environ.get("REDIS_HOST", "localhost"),
+            "port": 6379,
+            "db": int(os.environ.get("JOB_EVENTS_DB", "2")),
+            "decode_responses": True,
+        }
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            # Без повторов: недоступный Redis не должен задерживать генерацию
+            self._client = redis.Redis(socket_timeout=1, retry=None, **self._redis_kwargs())
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = aioredis.Redis(**self._redis_kwargs())
+        return self._async_client
+
+    def _channel(self, task_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{task_id}"
+
+    def _log_key(self, task_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{task_id}:log"
+
+    def _seq_key(self, task_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{task_id}:seq"
+
+    def publish(self, task_id: str, event: str, **data):
+        """Публикует событие. Ошибки Redis не должны ронять генерацию."""
+        if not task_id:
+            return
+        log_key = self._log_key(task_id)
+        seq_key = self._seq_key(task_id)
+        try:
+            # Атомарный порядковый номер: по нему подписчик убирает дубли журнала и канала
+            seq = self.client.incr(seq_key)
+            message = json.dumps({"seq": seq, "event": event, "task_id": task_id, **data}, ensure_ascii=False)
+            pipe = self.client.pipeline()
+            pipe.rpush(log_key, message)
+            pipe.expire(log_key, self.ttl)
+            pipe.expire(seq_key, self.ttl)
+            pipe.publish(self._channel(task_id), message)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Не удалось опубликовать событие {event}: {e} ---")
+
+    async def subscribe(self, task_id: str, keepalive: float = 15.0):
+        """
+        Асинхронный генератор событий задачи: сначала журнал, затем живые сообщения.
+        Отдает None каждые keepalive секунд тишины, чтобы соединение не закрылось.
+        """
+        pubsub = self.async_client.pubsub()
+        # Подписываемся ДО чтения журнала, чтобы не потерять события между шагами
+        await pubsub.subscribe(self._channel(task_id))
+        try:
+            seen = set()
+            for raw in await self.async_client.lrange(self._log_key(task_id), 0, -1):
+                event = json.loads(raw)
+                seen.add(event["seq"])
+                yield event
+                if event["event"] in self.TERMINAL_EVENTS:
+                    return
+
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+                if message is None:
+                    yield None
+                    continue
+                event = json.loads(message["data"])
+                if event["seq"] in seen:
+                    continue
+                seen.add(event["seq"])
+                yield event
+                if event["event"] in self.TERMINAL_EVENTS:
+                    return
+        finally:
+            await pubsub.unsubscribe(self._channel(task_id))
+            await pubsub.aclose()
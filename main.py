@@ -1,7 +1,25 @@
-from fastapi import FastAPI
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from typing import List
+from functools import partial
 from celery.result import AsyncResult
-from celery_worker import celery_app, placeholder_generation_task
+# Только тонкий клиент Celery: генераторы и их зависимости загружаются в воркере, не в API
+from celery_client import celery_app, send_banner_task, send_title_task, pipelined_producer
+from job_events import JobEvents
+from batch_store import BatchStore, fetch_task_states
+from media_store import MediaStore
+from media_index import MediaIndex
+from admission import AdmissionController
+from singleflight import SingleFlight
+from result_store import ResultStore
+from telemetry import telemetry
+from prompt_index import PromptIndex
+import json
+import os
+import uuid
+import redis
 
 
 # ==========================================================
@@ -18,11 +36,111 @@ class GenerationRequest(BaseModel):
     # Количество изображений
     n_images: int = Field(1, ge=1, le=4, description="Количество изображений для генерации (от 1 до 4).")
 
+    # Готовый баннер почти такого же запроса вместо новой генерации
+    reuse: bool = Field(True, description="Разрешить результат похожего запроса (false — всегда генерировать заново).")
+
 # ==========================================================
 # Все остальное ниже
 # ==========================================================
 app = FastAPI(title="AI Media Generator API")
 
+# События прогресса задач (Redis pub/sub) для SSE-эндпоинта
+job_events = JobEvents()
+# Пакетные загрузки JSONL
+batch_store = BatchStore()
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", "500"))
+BATCH_MAX_LINES = int(os.environ.get("BATCH_MAX_LINES", "10000"))
+# Допуск задач по глубине очередей: при долгом ожидании — 429 вместо очереди на минуты
+admission = AdmissionController(celery_app)
+
+def _overloaded(decision: dict) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail={
+            "error": "Сервис перегружен, повторите позже.",
+            "reason": decision["reason"],
+            "estimated_wait": decision["estimated_wait"],
+            "retry_after": decision["retry_after"],
+        },
+        headers={"Retry-After": str(decision["retry_after"])}
+    )
+
+async def _admit(job_type: str, n_images: int = 1) -> dict:
+    decision = await run_in_threadpool(admission.check, job_type, n_images)
+    if not decision["admitted"]:
+        raise _overloaded(decision)
+    return decision
+
+# Склейка одинаковых запросов и Idempotency-Key: дубль получает id уже идущей задачи
+singleflight = SingleFlight()
+# Компактные записи результатов с TTL (вместо конвертов Celery)
+result_store = ResultStore()
+# Индекс похожих промптов: заполняет воркер после успешной генерации баннера
+prompt_index = PromptIndex()
+
+async def _submit(job_type: str, fingerprint: str, idempotency_key: str, enqueue, n_images: int = 1,
+                  traceparent: str = None, reuse=None) -> dict:
+    """
+    Ставит задачу, если такой же запрос еще не выполняется. enqueue(task_id) отправляет ее в Celery.
+    Дубли не проходят контроль допуска: новой работы они не добавляют.
+    reuse() — готовый результат похожего запроса или None (см. _complete_reused).
+    traceparent клиента (W3C) продолжает его трассу; без него трасса начинается здесь.
+    """
+    # Спан запроса — родитель задачи: traceparent уходит в заголовки сообщения Celery
+    span = telemetry.start_span("api.submit", parent=telemetry.parse_traceparent(traceparent), job_type=job_type)
+    error = None
+    try:
+        response = await _submit_traced(job_type, fingerprint, idempotency_key, enqueue, n_images, reuse)
+        span["attrs"].update(task_id=response["task_id"], coalesced=response["coalesced"],
+                             reused=response.get("reused", False))
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        # Запись спана в Redis — не в цикле событий
+        duration = telemetry.close_span(span)
+        await run_in_threadpool(telemetry.record_span, span, duration, error=error)
+    if not response["coalesced"]:
+        response["trace_id"] = span["trace_id"]
+    return response
+
+async def _submit_traced(job_type: str, fingerprint: str, idempotency_key: str, enqueue, n_images: int,
+                         reuse=None) -> dict:
+    existing = await run_in_threadpool(singleflight.lookup, job_type, fingerprint, idempotency_key)
+    match = None
+    if existing is None and reuse is not None:
+        match = await run_in_threadpool(reuse)
+    if existing is None and match is not None:
+        # Готовый результат тоже закрепляется за Idempotency-Key: повтор клиента получит тот же task_id
+        claim = await run_in_threadpool(singleflight.claim, job_type, fingerprint, idempotency_key)
+        if not claim["coalesced"]:
+            return await _complete_reused(claim["task_id"], match)
+        existing = claim
+    elif existing is None:
+        decision = await _admit(job_type, n_images)
+        claim = await run_in_threadpool(singleflight.claim, job_type, fingerprint, idempotency_key)
+        if not claim["coalesced"]:
+            task_id = claim["task_id"]
+            # Запись создается до отправки: воркер может стартовать раньше, чем API вернет ответ
+            await run_in_threadpool(result_store.mark_queued, task_id)
+            try:
+                # Контекст (текущий спан) копируется в поток: traceparent попадает в сообщение
+                await run_in_threadpool(enqueue, task_id)
+            except Exception:
+                # Задача не ушла в брокер — освобождаем ключ, чтобы повтор клиента не склеился с пустотой
+                await run_in_threadpool(singleflight.release, task_id)
+                raise
+            await run_in_threadpool(job_events.publish, task_id, "queued")
+            return {"status": "processing", "task_id": task_id, "events_url": f"/api/v1/events/{task_id}",
+                    "estimated_wait": decision["estimated_wait"], "coalesced": False}
+        existing = claim
+
+    if existing["conflict"]:
+        raise HTTPException(status_code=422, detail="Idempotency-Key уже использован с другим запросом.")
+    task_id = existing["task_id"]
+    return {"status": "processing", "task_id": task_id, "events_url": f"/api/v1/events/{task_id}",
+            "coalesced": True}
+
 from fastapi.middleware.cors import CORSMiddleware
 
 # ... ваш код app = FastAPI(...) ...
@@ -40,17 +158,45 @@ app.add_middleware(
 # если она была между этим и следующим блоком.
 
 @app.post("/api/v1/generate/")
-async def start_generation(request: GenerationRequest):
+async def start_generation(request: GenerationRequest,
+                           idempotency_key: str = Header(None, alias="Idempotency-Key"),
+                           traceparent: str = Header(None)):
+    fingerprint = SingleFlight.fingerprint(
+        prompt=request.prompt, style=request.style, aspect_ratio=request.aspect_ratio, n_images=request.n_images
+    )
+    # Готовый баннер почти такого же запроса вместо новой генерации, если клиент не запретил
+    reuse = None
+    if request.reuse:
+        reuse = partial(prompt_index.lookup, request.prompt, request.style, request.aspect_ratio, request.n_images)
     # Запускаем асинхронную задачу Celery с передачей ВСЕХ параметров
-    task = placeholder_generation_task.delay(
+    return await _submit("banner", fingerprint, idempotency_key, lambda task_id: send_banner_task(
         request.prompt,
         request.style, # Теперь этот атрибут существует!
         request.aspect_ratio,
-        request.n_images
-    )
-    
-    return {"status": "processing", "task_id": task.id}
+        request.n_images,
+        task_id=task_id
+    ), n_images=request.n_images, traceparent=traceparent, reuse=reuse)
     
+async def _complete_reused(task_id: str, match: dict) -> dict:
+    """
+    Ответ готовым баннером почти такого же запроса (регистр, пунктуация, порядок слов, слова-наполнители).
+    Результат оформляется как завершенная задача: статус, события и раздача файлов работают как обычно.
+    """
+    result = {"status": "SUCCESS", "title": match["title"], "image_path": match["image_paths"][0],
+              "image_paths": match["image_paths"]}
+    await run_in_threadpool(result_store.complete, task_id, match["title"], match["image_paths"])
+    await run_in_threadpool(job_events.publish, task_id, "done", result=result)
+    # Выполнять нечего: аренда склейки снимается сразу (ключ идемпотентности остается до своего TTL)
+    await run_in_threadpool(singleflight.release, task_id)
+    for path in match["image_paths"]:
+        # Переиспользование — тоже обращение: файлы не должны уйти в GC сразу после ответа
+        await run_in_threadpool(media_index.touch, path)
+    await run_in_threadpool(telemetry.inc, "banner_prompt_reuse_total")
+    print(f"--- Задача {task_id} отдана из индекса похожих промптов (сходство {match['similarity']}) ---")
+    # Форма ответа та же, что у новой задачи: клиент получает результат через status/events
+    return {"status": "processing", "task_id": task_id, "events_url": f"/api/v1/events/{task_id}",
+            "coalesced": False, "reused": True, "similarity": match["similarity"]}
+
 # Вставьте этот код в main.py
 
 from fastapi.staticfiles import StaticFiles  # 1. Добавить импорт
@@ -65,27 +211,82 @@ if not os.path.exists("generated_media"):
 # 3. "Распириваем" папку в интернет
 app.mount("/media", StaticFiles(directory="generated_media"), name="media")
 
-from celery_worker import generate_title_task
+# Неизменяемые URL с хэшем содержимого и уменьшенные копии в WebP/AVIF
+media_index = MediaIndex("generated_media")
+media_store = MediaStore("generated_media", index=media_index)
+
+def _with_media_urls(result):
+    """Добавляет к результату задачи image_urls — кэшируемые навсегда ссылки на баннеры."""
+    if not isinstance(result, dict):
+        return result
+    paths = result.get("image_paths") or [result.get("image_path")]
+    # Файл, которого уже нет (удалил GC), ссылки не получает: в image_urls не бывает null,
+    # а image_paths остаются как есть. Клиент сопоставляет ссылки с путями по имени файла.
+    urls = [url for url in (media_store.url_for(path) for path in paths if path) if url]
+    if urls:
+        result = {**result, "image_urls": urls}
+    return result
+
+@app.get("/api/v1/media/{digest}/{file_name}")
+async def get_media(digest: str, file_name: str, request: Request, w: int = 0):
+    """
+    Баннер по URL с хэшем содержимого. ?w= задает ширину (округляется до MEDIA_WIDTHS),
+    формат выбирается по Accept (AVIF, WebP, иначе исходный). Поддерживаются ETag/304 и Range.
+    """
+    source = media_store.resolve(file_name)
+    if source is None or await run_in_threadpool(media_store.digest, source) != digest:
+        raise HTTPException(status_code=404, detail="Файл не найден.")
+
+    width = media_store.snap_width(w)
+    fmt = media_store.negotiate_format(request.headers.get("accept"))
+    etag = media_store.etag(digest, width, fmt)
+    headers = {"ETag": etag, "Cache-Control": MediaStore.CACHE_CONTROL, "Vary": "Accept"}
+    if media_store.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # Обращение отодвигает удаление исходника сборщиком мусора
+    await run_in_threadpool(media_index.touch, source)
+    # Копия создается один раз и дальше отдается с диска
+    path = await run_in_threadpool(media_store.variant, source, digest, width, fmt)
+    return FileResponse(path, media_type=media_store.media_type(path), headers=headers)
 
 # --- Модель для запроса на генерацию ТОЛЬКО ТЕКСТА ---
 class TitleRequest(BaseModel):
     prompt: str = Field(..., min_length=5, max_length=500, description="Тема или запрос для генерации продающего заголовка.")
 
 @app.post("/api/v1/generate_title/")
-async def start_title_generation(request: TitleRequest):
+async def start_title_generation(request: TitleRequest,
+                                 idempotency_key: str = Header(None, alias="Idempotency-Key"),
+                                 traceparent: str = Header(None)):
+    fingerprint = SingleFlight.fingerprint(prompt=request.prompt)
     # Запускаем задачу Celery, которая вызывает TextGenerator.generate_title()
-    task = generate_title_task.delay(request.prompt)
-    
-    return {"status": "processing", "task_id": task.id}
+    return await _submit("title", fingerprint, idempotency_key,
+                         lambda task_id: send_title_task(request.prompt, task_id=task_id),
+                         traceparent=traceparent)
     
 @app.get("/api/v1/status/{task_id}")
 async def get_task_status(task_id: str):
+    try:
+        record = await run_in_threadpool(result_store.get, task_id)
+    except redis.RedisError:
+        record = None
+    if record is not None:
+        return await run_in_threadpool(_status_response, task_id, record)
+
+    # Задачи без компактной записи (старые или поставленные в обход API) — через backend Celery
     task_result = AsyncResult(task_id, app=celery_app)
 
     if task_result.ready():
         return {
             "status": task_result.status,
-            "result": task_result.result,
+            "result": await run_in_threadpool(_with_media_urls, task_result.result),
+            "task_id": task_id
+        }
+    elif task_result.status == "PREVIEW":
+        # Полного изображения еще нет — отдаем последнее превью (title, index, preview)
+        return {
+            "status": task_result.status,
+            "preview": task_result.info,
             "task_id": task_id
         }
     else:
@@ -93,3 +294,248 @@ async def get_task_status(task_id: str):
             "status": task_result.status,
             "task_id": task_id
         }
+
+def _status_response(task_id: str, record: dict) -> dict:
+    """Ответ статуса из компактной записи: result — для завершенных, preview — пока идет генерация."""
+    response = {"status": record["status"], "task_id": task_id}
+    if record["status"] in ("SUCCESS", "FAILURE"):
+        response["result"] = _with_media_urls(record["result"])
+    elif record["status"] == "PREVIEW":
+        # Полного изображения еще нет — отдаем последнее превью (title, index, preview)
+        response["preview"] = record["preview"]
+    return response
+
+def _task_states(task_ids: list) -> dict:
+    """Статусы многих задач: один пайплайн к ResultStore, для недостающих — один MGET к backend."""
+    records = result_store.get_many(task_ids)
+    states = {task_id: _status_response(task_id, record) for task_id, record in records.items() if record}
+    missing = [task_id for task_id in task_ids if task_id not in states]
+    for task_id, state in fetch_task_states(celery_app, missing).items():
+        states[task_id] = {"task_id": task_id, **state}
+    return states
+
+class StatusBatchRequest(BaseModel):
+    task_ids: List[str] = Field(..., min_length=1, max_length=1000, description="До 1000 id задач.")
+
+@app.post("/api/v1/status:batch")
+async def get_task_statuses(request: StatusBatchRequest):
+    """Статусы многих задач одним запросом вместо сотен GET /status."""
+    task_ids = list(dict.fromkeys(request.task_ids))
+    states = await run_in_threadpool(_task_states, task_ids)
+    return {"tasks": [states[task_id] for task_id in task_ids]}
+
+@app.get("/api/v1/singleflight/stats")
+async def get_singleflight_stats():
+    """Сколько запросов склеено с уже идущими задачами — сэкономленные вызовы LLM и скачивания."""
+    return {"stats": await run_in_threadpool(singleflight.stats)}
+
+@app.get("/api/v1/queues")
+async def get_queue_depths():
+    """Глубина, скорость обслуживания и ожидание по каждой очереди Celery: по ним масштабируются пулы."""
+    return {"queues": await run_in_threadpool(admission.snapshot)}
+
+def _render_metrics() -> str:
+    gauges = {}
+    try:
+        queues = admission.snapshot()
+        gauges["banner_queue_depth"] = (
+            "Сообщений в очереди Celery (все уровни приоритета).",
+            [({"queue": queue}, stats["depth"]) for queue, stats in queues.items()],
+        )
+        gauges["banner_queue_estimated_wait_seconds"] = (
+            "Оценка ожидания в очереди: глубина / скорость обслуживания.",
+            [({"queue": queue}, round(stats["wait"], 3)) for queue, stats in queues.items()],
+        )
+    except Exception as e:
+        print(f"--- /metrics без глубины очередей: {e} ---")
+    return telemetry.render(gauges)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus: стадии генерации, ожидание в очередях, заглушки и ошибки."""
+    return PlainTextResponse(await run_in_threadpool(_render_metrics), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/v1/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Все спаны одного запроса (API, заголовок, скачивание, композиция, запись) в порядке начала."""
+    spans = await run_in_threadpool(telemetry.get_trace, trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Трасса не найдена или истекла.")
+    return {"trace_id": trace_id, "spans": spans}
+
+@app.get("/api/v1/events/{task_id}")
+async def stream_task_events(task_id: str):
+    """Server-Sent Events: воркер сам присылает переходы состояния вместо опроса /status."""
+    async def event_stream():
+        async for event in job_events.subscribe(task_id):
+            if event is None:
+                # Комментарий-пинг, чтобы прокси не закрыли тихое соединение
+                yield ": keepalive\n\n"
+                continue
+            if event["event"] == "done":
+                event = {**event, "result": await run_in_threadpool(_with_media_urls, event.get("result"))}
+            yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/v1/generate_title/stream/{task_id}")
+async def stream_title_tokens(task_id: str):
+    """Заголовок простым текстом по мере генерации токенов (события title_token)."""
+    async def token_stream():
+        streamed = False
+        async for event in job_events.subscribe(task_id):
+            if event is None:
+                continue
+            if event["event"] == "title_token":
+                streamed = True
+                yield event["token"]
+            elif event["event"] == "done" and not streamed:
+                # Воркер без потоковой генерации — отдаем заголовок целиком
+                yield event.get("result", {}).get("title", "")
+
+    return StreamingResponse(
+        token_stream(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _enqueue_chunk(batch_id: str, requests_chunk: list, invalid: int):
+    """Отправляет чанк задач одним пайплайном Redis (pipelined_producer) и записывает их id в batch."""
+    task_ids = [str(uuid.uuid4()) for _ in requests_chunk]
+    # Записи статусов создаются до отправки, одним пайплайном на чанк
+    result_store.mark_queued_many(task_ids)
+    with pipelined_producer() as producer:
+        for task_id, item in zip(task_ids, requests_chunk):
+            # ignore_result: статусы в ResultStore, без этого Celery подписывается на канал
+            # результата каждой задачи в backend (SUBSCRIBE + UNSUBSCRIBE на задачу)
+            send_banner_task(item.prompt, item.style, item.aspect_ratio, item.n_images,
+                             task_id=task_id, producer=producer, ignore_result=True)
+    batch_store.add_tasks(batch_id, task_ids, invalid=invalid)
+
+@app.post("/api/v1/generate/batch")
+async def start_batch_generation(request: Request):
+    """
+    Пакетная загрузка: тело — JSONL, по одному GenerationRequest на строку.
+    Строки читаются потоком и ставятся в очередь чанками по BATCH_CHUNK_SIZE.
+
+    Каждый чанк проходит контроль допуска, как одиночные запросы (с n_images каждой строки).
+    Если допущена только часть, пакет принимается частично: строки начиная с rejected_from_line
+    не поставлены, их можно отправить повторно через retry_after секунд. Если не допущено
+    ничего — 429, как у /api/v1/generate.
+    """
+    batch_id = await run_in_threadpool(batch_store.create)
+    chunk, chunk_invalid, errors = [], 0, []
+    accepted = invalid = rejected = 0
+    line_no = 0
+    truncated = False
+    # Решение admission, после которого строки больше не принимаются
+    overloaded = None
+    rejected_from_line = None
+    buffer = b""
+
+    async def flush():
+        nonlocal chunk, chunk_invalid, accepted, rejected, overloaded, rejected_from_line
+        admitted = chunk
+        if chunk:
+            decision = await run_in_threadpool(admission.check_many, "banner",
+                                               [item.n_images for _, item in chunk])
+            admitted = chunk[:decision["admitted"]]
+            if len(admitted) < len(chunk):
+                overloaded = decision
+                rejected_from_line = chunk[len(admitted)][0]
+                rejected += len(chunk) - len(admitted)
+        if admitted or chunk_invalid:
+            await run_in_threadpool(_enqueue_chunk, batch_id, [item for _, item in admitted], chunk_invalid)
+            accepted += len(admitted)
+        chunk, chunk_invalid = [], 0
+
+    async def handle_line(raw: bytes):
+        nonlocal line_no, chunk_invalid, invalid, rejected, truncated
+        line = raw.strip()
+        if not line:
+            return
+        if line_no >= BATCH_MAX_LINES:
+            # Лишние строки не принимаем, но уже поставленные задачи остаются в пакете
+            truncated = True
+            return
+        line_no += 1
+        if overloaded is not None:
+            rejected += 1
+            return
+        try:
+            chunk.append((line_no, GenerationRequest(**json.loads(line))))
+        except (ValueError, TypeError, ValidationError) as e:
+            chunk_invalid += 1
+            invalid += 1
+            # Ошибки возвращаем только для первых строк, чтобы ответ не разрастался
+            if len(errors) < 100:
+                errors.append({"line": line_no, "error": str(e)})
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            await flush()
+
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            await handle_line(raw)
+    await handle_line(buffer)
+    await flush()
+    if overloaded is not None and not accepted:
+        raise _overloaded(overloaded)
+
+    return {
+        "status": "processing",
+        "batch_id": batch_id,
+        "accepted": accepted,
+        "invalid": invalid,
+        "rejected": rejected,
+        "rejected_from_line": rejected_from_line,
+        "retry_after": overloaded["retry_after"] if overloaded else None,
+        "truncated": truncated,
+        "errors": errors
+    }
+
+def _batch_status(batch_id: str, offset: int, limit: int):
+    """Метаданные, сводка по всему пакету и статусы страницы; None — пакета нет."""
+    meta = batch_store.get_meta(batch_id)
+    if meta is None:
+        return None
+    # Сводка по всем задачам — один пайплайн HGET status (пакет не больше BATCH_MAX_LINES)
+    all_ids = batch_store.get_task_ids(batch_id)
+    summary = {}
+    for status in result_store.get_statuses(all_ids):
+        # Записи нет — истек RESULT_TTL (пакет живет дольше)
+        status = status or "EXPIRED"
+        summary[status] = summary.get(status, 0) + 1
+    finished = summary.get("SUCCESS", 0) + summary.get("FAILURE", 0)
+
+    page_ids = all_ids[offset:offset + limit]
+    states = _task_states(page_ids)
+    page_summary = {}
+    for state in states.values():
+        page_summary[state["status"]] = page_summary.get(state["status"], 0) + 1
+    return {
+        "batch_id": batch_id,
+        "total": meta["total"],
+        "invalid": meta["invalid"],
+        "summary": summary,
+        "finished": finished,
+        "progress": round(finished / meta["total"], 4) if meta["total"] else 1.0,
+        "offset": offset,
+        "limit": limit,
+        "page_summary": page_summary,
+        "tasks": [states[task_id] for task_id in page_ids]
+    }
+
+@app.get("/api/v1/batch/{batch_id}")
+async def get_batch_status(batch_id: str, offset: int = 0, limit: int = 100):
+    """Сводка по всему пакету (summary, progress) и статусы одной страницы задач."""
+    limit = max(1, min(limit, 1000))
+    response = await run_in_threadpool(_batch_status, batch_id, max(0, offset), limit)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Пакет не найден.")
+    return response
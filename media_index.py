@@ -0,0 +1,294 @@
+# media_index.py
+import hashlib
+import os
+import threading
+import time
+import redis
+
+
+def shard_path(base_dir: str, file_name: str, create: bool = True) -> str:
+    """
+    Путь файла в шардированной папке: base_dir/<2 hex от sha1(имени)>/имя.
+    256 подпапок вместо одной плоской — листинг и поиск не деградируют с ростом числа файлов.
+    Шард вычисляется из имени, поэтому путь восстанавливается без обращения к индексу.
+    """
+    shard = hashlib.sha1(file_name.encode("utf-8")).hexdigest()[:2]
+    directory = os.path.join(base_dir, shard)
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, file_name)
+
+
+class MediaIndex:
+    """
+    Индекс файлов generated_media в Redis и сборщик мусора по нему.
+
+    media:access        — zset: относительный путь -> время последнего доступа;
+    media:access:error  — то же для заглушек с ошибкой (удаляются первыми);
+    media:meta:<путь>   — hash: job, kind, size, created;
+    media:bytes         — суммарный размер проиндексированных файлов;
+    media:live          — zset: job_id -> срок аренды; файлы живых задач не удаляются.
+
+    Кэш ImageCache (cache_*.png в корне) сюда не входит — у него свой бюджет.
+    """
+
+    KEY_PREFIX = "media"
+    ERROR_KINDS = ("error", "placeholder")
+    TMP_SUFFIX = ".tmp"
+    # Папки с шардами: собственно медиа и уменьшенные копии MediaStore
+    SHARDED_SUBDIRS = ("", "variants")
+    # Сколько шардов обходит один проход GC в поисках временных и неучтенных файлов
+    SWEEP_DIRS_PER_RUN = 16
+
+    def __init__(self, media_dir: str = "generated_media", max_bytes: int = None, ttl: float = None,
+                 error_ttl: float = None, live_ttl: float = None, tmp_max_age: float = None, client=None):
+        self.media_dir = media_dir
+        # Бюджет на диске (по умолчанию 5 ГБ) и время жизни без обращений (по умолчанию 7 дней)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("MEDIA_MAX_BYTES", str(5 * 1024 ** 3)))
+        if ttl is None:
+            ttl = float(os.environ.get("MEDIA_TTL", str(7 * 24 * 3600)))
+        if error_ttl is None:
+            error_ttl = float(os.environ.get("MEDIA_ERROR_TTL", "3600"))
+        if live_ttl is None:
+            live_ttl = float(os.environ.get("MEDIA_LIVE_TTL", "3600"))
+        if tmp_max_age is None:
+            tmp_max_age = float(os.environ.get("MEDIA_TMP_MAX_AGE", "3600"))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.live_ttl = live_ttl
+        self.tmp_max_age = tmp_max_age
+        self._client = client
+        self._gc_thread = None
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("MEDIA_INDEX_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать генерацию
+                retry=None,
+            )
+        return self._client
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(path, self.media_dir)
+
+    def _access_key(self, kind: str) -> str:
+        if kind in self.ERROR_KINDS:
+            return f"{self.KEY_PREFIX}:access:error"
+        return f"{self.KEY_PREFIX}:access"
+
+    def _meta_key(self, rel: str) -> str:
+        return f"{self.KEY_PREFIX}:meta:{rel}"
+
+    @property
+    def _bytes_key(self) -> str:
+        return f"{self.KEY_PREFIX}:bytes"
+
+    @property
+    def _live_key(self) -> str:
+        return f"{self.KEY_PREFIX}:live"
+
+    # ------------------------------------------------------------------
+    # Запись в индекс
+    # ------------------------------------------------------------------
+
+    def register(self, path: str, job_id: str = None, kind: str = "banner", accessed: float = None):
+        """Учитывает новый файл. Ошибки Redis не должны ронять генерацию."""
+        rel = self._rel(path)
+        now = time.time()
+        try:
+            size = os.path.getsize(path)
+            previous = self.client.hget(self._meta_key(rel), "size")
+            pipe = self.client.pipeline()
+            pipe.hset(self._meta_key(rel), mapping={
+                "job": job_id or "", "kind": kind, "size": size, "created": now,
+            })
+            pipe.zadd(self._access_key(kind), {rel: accessed or now})
+            pipe.incrby(self._bytes_key, size - int(previous or 0))
+            pipe.execute()
+        except (OSError, redis.RedisError) as e:
+            print(f"--- Не удалось добавить {rel} в индекс медиа: {e} ---")
+
+    def touch(self, path: str):
+        """Отмечает обращение к файлу (раздача через API) — отодвигает его удаление."""
+        try:
+            # XX: обновляем только уже известные файлы, чужие пути в индекс не попадают
+            self.client.zadd(self._access_key("banner"), {self._rel(path): time.time()}, xx=True)
+        except redis.RedisError:
+            pass
+
+    def mark_live(self, job_id: str):
+        """Аренда на файлы задачи, пока она выполняется (продлевается повторным вызовом)."""
+        if not job_id:
+            return
+        try:
+            self.client.zadd(self._live_key, {job_id: time.time() + self.live_ttl})
+        except redis.RedisError as e:
+            print(f"--- Не удалось отметить задачу {job_id} живой: {e} ---")
+
+    def release(self, job_id: str):
+        if not job_id:
+            return
+        try:
+            self.client.zrem(self._live_key, job_id)
+        except redis.RedisError as e:
+            print(f"--- Не удалось снять аренду задачи {job_id}: {e} ---")
+
+    # ------------------------------------------------------------------
+    # Сборка мусора
+    # ------------------------------------------------------------------
+
+    def _live_jobs(self, now: float) -> set:
+        # Истекшие аренды (упавшие задачи) убираем заодно
+        self.client.zremrangebyscore(self._live_key, "-inf", now)
+        return set(self.client.zrange(self._live_key, 0, -1))
+
+    def _delete(self, entries: list, live_jobs: set) -> tuple:
+        """Удаляет (rel, access_key) кроме файлов живых задач. Возвращает (число, байты)."""
+        if not entries:
+            return 0, 0
+        pipe = self.client.pipeline()
+        for rel, _ in entries:
+            pipe.hmget(self._meta_key(rel), "job", "size")
+        metas = pipe.execute()
+
+        deleted, freed = 0, 0
+        pipe = self.client.pipeline()
+        for (rel, access_key), (job, size) in zip(entries, metas):
+            if job and job in live_jobs:
+                continue
+            try:
+                os.remove(os.path.join(self.media_dir, rel))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"--- GC: не удалось удалить {rel}: {e} ---")
+                continue
+            size = int(size or 0)
+            pipe.zrem(access_key, rel)
+            pipe.delete(self._meta_key(rel))
+            pipe.decrby(self._bytes_key, size)
+            deleted += 1
+            freed += size
+        pipe.execute()
+        return deleted, freed
+
+    def _sweep(self, now: float) -> dict:
+        """
+        Обходит несколько шардов за проход (курсор в Redis): удаляет брошенные
+        временные файлы, а неучтенные (в т.ч. из старой плоской папки) добавляет в индекс.
+        """
+        directories = [""] + [os.path.join(subdir, f"{i:02x}") for subdir in self.SHARDED_SUBDIRS for i in range(256)]
+        cursor = int(self.client.incr(f"{self.KEY_PREFIX}:gc:cursor")) - 1
+        stats = {"tmp_deleted": 0, "adopted": 0}
+        for step in range(self.SWEEP_DIRS_PER_RUN):
+            directory = os.path.join(self.media_dir, directories[(cursor * self.SWEEP_DIRS_PER_RUN + step) % len(directories)])
+            try:
+                entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                name = entry.name
+                # Файлы ImageCache живут по своему бюджету
+                if name.startswith("cache_") and not name.endswith(self.TMP_SUFFIX):
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                # Свежие файлы могут принадлежать задаче, которая еще не успела их учесть
+                if now - mtime < self.tmp_max_age:
+                    continue
+                if name.endswith(self.TMP_SUFFIX):
+                    try:
+                        os.remove(entry.path)
+                        stats["tmp_deleted"] += 1
+                    except FileNotFoundError:
+                        pass
+                    continue
+                rel = self._rel(entry.path)
+                if self.client.exists(self._meta_key(rel)):
+                    continue
+                # Заглушки и ошибки удаляются первыми, остальное (в т.ч. старая плоская папка) — по LRU
+                if name.startswith(("error_", "placeholder_")):
+                    kind = "error"
+                elif rel.startswith("variants" + os.sep):
+                    kind = "variant"
+                else:
+                    kind = "legacy"
+                self.register(entry.path, kind=kind, accessed=mtime)
+                stats["adopted"] += 1
+        return stats
+
+    def gc(self) -> dict:
+        """
+        Один проход сборки мусора:
+        1) брошенные *.tmp и неучтенные файлы (часть шардов за проход);
+        2) заглушки с ошибками старше error_ttl;
+        3) файлы без обращений дольше ttl;
+        4) если бюджет превышен — сначала заглушки, затем самые давно открытые файлы.
+        Файлы задач из media:live не удаляются.
+        """
+        now = time.time()
+        stats = self._sweep(now)
+        live_jobs = self._live_jobs(now)
+        error_key, access_key = self._access_key("error"), self._access_key("banner")
+        deleted, freed = 0, 0
+
+        for key, ttl in ((error_key, self.error_ttl), (access_key, self.ttl)):
+            expired = self.client.zrangebyscore(key, "-inf", now - ttl, start=0, num=1000)
+            d, f = self._delete([(rel, key) for rel in expired], live_jobs)
+            deleted, freed = deleted + d, freed + f
+
+        for key in (error_key, access_key):
+            offset = 0
+            while int(self.client.get(self._bytes_key) or 0) > self.max_bytes:
+                oldest = self.client.zrange(key, offset, offset + 99)
+                if not oldest:
+                    break
+                d, f = self._delete([(rel, key) for rel in oldest], live_jobs)
+                deleted, freed = deleted + d, freed + f
+                # Пропускаем оставшиеся (живые) записи, чтобы не крутиться на них
+                offset += len(oldest) - d
+
+        stats.update({
+            "deleted": deleted,
+            "freed_bytes": freed,
+            "bytes": int(self.client.get(self._bytes_key) or 0),
+            "max_bytes": self.max_bytes,
+        })
+        return stats
+
+    def try_gc(self, interval: float) -> dict:
+        """GC, если за последние interval секунд его не запускал ни один процесс."""
+        if not self.client.set(f"{self.KEY_PREFIX}:gc:lock", os.getpid(), nx=True, ex=max(1, int(interval))):
+            return None
+        return self.gc()
+
+    def start_background_gc(self, interval: float = None):
+        """Фоновый поток GC. Безопасно запускать в нескольких процессах: проход берет один."""
+        if interval is None:
+            interval = float(os.environ.get("MEDIA_GC_INTERVAL", "300"))
+        if self._gc_thread is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    stats = self.try_gc(interval)
+                    if stats and (stats["deleted"] or stats["tmp_deleted"]):
+                        print(f"--- GC generated_media: {stats} ---")
+                except (OSError, redis.RedisError) as e:
+                    print(f"--- GC generated_media не выполнен: {e} ---")
+                time.sleep(interval)
+
+        self._gc_thread = threading.Thread(target=loop, name="media-gc", daemon=True)
+        self._gc_thread.start()
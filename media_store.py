@@ -0,0 +1,164 @@
+# media_store.py
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from PIL import Image, features
+from media_index import shard_path
+
+
+class MediaStore:
+    """
+    Раздача сгенерированных баннеров по неизменяемым URL.
+
+    URL содержит хэш содержимого файла: /api/v1/media/<digest>/<имя файла>,
+    поэтому ответ можно кэшировать навсегда (Cache-Control: immutable).
+    Уменьшенные копии (?w=) в WebP/AVIF по заголовку Accept создаются
+    при первом запросе и лежат на диске в generated_media/variants/<шард>.
+    """
+
+    URL_PREFIX = "/api/v1/media"
+    VARIANTS_SUBDIR = "variants"
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+    # Форматы, которые клиент может запросить через Accept, в порядке предпочтения
+    NEGOTIATED_FORMATS = (("image/avif", "AVIF"), ("image/webp", "WEBP"))
+    FORMAT_EXTENSIONS = {"PNG": "png", "WEBP": "webp", "AVIF": "avif", "JPEG": "jpg"}
+    MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "avif": "image/avif", "jpg": "image/jpeg"}
+    SAVE_OPTIONS = {
+        "WEBP": {"quality": 80, "method": 4},
+        "AVIF": {"quality": 60, "speed": 8},
+        "PNG": {"optimize": False},
+        "JPEG": {"quality": 85},
+    }
+
+    def __init__(self, media_dir: str = "generated_media", widths: list = None, index=None):
+        self.media_dir = media_dir
+        # MediaIndex: копии учитываются в бюджете generated_media, обращения продлевают жизнь файлам
+        self.index = index
+        self.variants_dir = os.path.join(media_dir, self.VARIANTS_SUBDIR)
+        # Разрешенные ширины: произвольный ?w= округляется вверх, чтобы число копий было ограничено
+        if widths is None:
+            widths = [int(w) for w in os.environ.get("MEDIA_WIDTHS", "320,480,640,960,1280,1920").split(",")]
+        self.widths = sorted(widths)
+        os.makedirs(self.variants_dir, exist_ok=True)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+        # Ключ кэша включает размер и mtime: перезаписанный файл получит новый хэш
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()[:20]
+
+    def resolve(self, file_name: str):
+        """Путь к исходному файлу в media_dir или None (нет файла / попытка выйти из папки)."""
+        if not file_name or os.path.basename(file_name) != file_name or file_name.startswith("."):
+            return None
+        # Сначала шард, затем старая плоская папка
+        for path in (shard_path(self.media_dir, file_name, create=False), os.path.join(self.media_dir, file_name)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def digest(self, path: str) -> str:
+        st = os.stat(path)
+        return self._file_digest(path, st.st_size, st.st_mtime_ns)
+
+    def url_for(self, path: str):
+        """Неизменяемый URL для пути из результата задачи (или None, если файла нет)."""
+        if not path:
+            return None
+        file_name = os.path.basename(path)
+        source = self.resolve(file_name)
+        if source is None:
+            return None
+        return f"{self.URL_PREFIX}/{self.digest(source)}/{file_name}"
+
+    def snap_width(self, width: int):
+        """Ближайшая разрешенная ширина не меньше запрошенной (None — без ресайза)."""
+        if not width or width <= 0:
+            return None
+        for allowed in self.widths:
+            if allowed >= width:
+                return allowed
+        return self.widths[-1]
+
+    @classmethod
+    def negotiate_format(cls, accept: str):
+        """Лучший из поддерживаемых форматов по заголовку Accept (None — оставить исходный)."""
+        accepted = set()
+        for part in (accept or "").split(","):
+            media_type, *params = [p.strip() for p in part.split(";")]
+            quality = 1.0
+            for param in params:
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        pass
+            # q=0 означает явный отказ от формата
+            if quality > 0:
+                accepted.add(media_type.lower())
+        for media_type, fmt in cls.NEGOTIATED_FORMATS:
+            if media_type in accepted and features.check(fmt.lower()):
+                return fmt
+        return None
+
+    def variant(self, source: str, digest: str, width: int = None, fmt: str = None):
+        """
+        Путь к файлу для отдачи: исходник, если преобразование не нужно,
+        иначе закэшированная на диске копия (создается при первом запросе).
+        """
+        with Image.open(source) as img:
+            src_width, src_format = img.width, img.format or "PNG"
+            # Не увеличиваем: ширина больше исходной означает "как есть"
+            if width is not None and width >= src_width:
+                width = None
+            if width is None and fmt in (None, src_format):
+                return source
+
+            fmt = fmt or src_format
+            ext = self.FORMAT_EXTENSIONS[fmt]
+            path = shard_path(self.variants_dir, f"{digest}_{width or src_width}.{ext}")
+            if os.path.exists(path):
+                if self.index is not None:
+                    self.index.touch(path)
+                return path
+
+            if width is not None:
+                height = max(1, round(img.height * width / src_width))
+                # reducing_gap: сначала быстрое целочисленное reduce(), затем точный ресайз
+                out = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            else:
+                out = img.copy()
+
+        if fmt == "JPEG" and out.mode != "RGB":
+            out = out.convert("RGB")
+        # Пишем во временный файл и атомарно переименовываем: параллельные запросы не увидят недописанный файл
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        out.save(tmp_path, format=fmt, **self.SAVE_OPTIONS.get(fmt, {}))
+        os.replace(tmp_path, path)
+        if self.index is not None:
+            self.index.register(path, kind="variant")
+        return path
+
+    @staticmethod
+    def etag(digest: str, width: int = None, fmt: str = None) -> str:
+        # Сильный ETag из параметров запроса: считается без открытия файла, поэтому 304 почти бесплатен
+        return f'"{digest}-{width or 0}-{(fmt or "orig").lower()}"'
+
+    @staticmethod
+    def etag_matches(if_none_match: str, etag: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # If-None-Match сравнивается слабо: W/"x" совпадает с "x"
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in candidates
+
+    def media_type(self, path: str) -> str:
+        return self.MEDIA_TYPES.get(path.rsplit(".", 1)[-1].lower(), "application/octet-stream")
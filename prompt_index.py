@@ -0,0 +1,237 @@
+# prompt_index.py
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+import uuid
+import redis
+from prompt_manager import PromptManager
+
+
+class PromptIndex:
+    """
+    Индекс похожих промптов (MinHash + LSH в Redis): почти одинаковый запрос получает
+    уже готовые заголовок и баннеры вместо новой генерации.
+
+    Корзину (точное совпадение) задают сами стиль и пропорции запроса. Текст пользователя
+    канонизируется через PromptManager.create_optimized_prompt: остаются слова без пунктуации,
+    регистра, порядка и служебных слов. Похожесть — коэффициент Жаккара по символьным 3-граммам.
+
+    prompt_index:entry:<id>  — hash: bucket, text, title, image_paths (JSON), bands, created;
+    prompt_index:band:<i>    — hash: "<корзина>:<хэш полосы i сигнатуры>" -> id записи;
+    prompt_index:created     — zset: id -> время добавления (по нему удаляются старые записи).
+
+    Поиск — два обращения к Redis независимо от размера индекса: полосы кандидатов и их записи.
+    """
+
+    KEY_PREFIX = "prompt_index"
+    # 32 хэш-функции MinHash = 8 полос по 4 строки: при сходстве 0.8 кандидат находится с вероятностью ~98.5%
+    NUM_HASHES = 32
+    BANDS = 8
+    # Все 32 значения шингла — один дайджест blake2b (32 x uint16): в разы быстрее 32 хэш-функций в Python
+    _DIGEST = struct.Struct(f"<{NUM_HASHES}H")
+    SHINGLE = 3
+    # Слова-наполнители не меняют смысл рекламного запроса
+    STOP_WORDS = frozenset(
+        "a an the in on at of for to with and or by from into your our my this that "
+        "в во на для и или с со по к от за из у о об под над при ваш ваша ваше вашего вашей ваших "
+        "наш наша наше нашего нашей наших это этот эта".split()
+    )
+    # Сколько устаревших записей удаляется за одно добавление
+    PRUNE_BATCH = 100
+
+    def __init__(self, threshold: float = None, ttl: float = None, client=None):
+        if threshold is None:
+            threshold = float(os.environ.get("PROMPT_REUSE_THRESHOLD", "0.8"))
+        if ttl is None:
+            # По умолчанию столько же, сколько живут баннеры без обращений (MEDIA_TTL)
+            ttl = float(os.environ.get("PROMPT_INDEX_TTL", os.environ.get("MEDIA_TTL", str(7 * 24 * 3600))))
+        self.threshold = threshold
+        self.ttl = ttl
+        self.enabled = os.environ.get("PROMPT_REUSE_ENABLED", "1") == "1"
+        self._client = client
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("PROMPT_INDEX_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать постановку задачи
+                retry=None,
+            )
+        return self._client
+
+    def _entry_key(self, entry_id: str) -> str:
+        return f"{self.KEY_PREFIX}:entry:{entry_id}"
+
+    def _band_key(self, band: int) -> str:
+        return f"{self.KEY_PREFIX}:band:{band}"
+
+    @property
+    def _created_key(self) -> str:
+        return f"{self.KEY_PREFIX}:created"
+
+    # ------------------------------------------------------------------
+    # Канонизация и сигнатуры
+    # ------------------------------------------------------------------
+
+    def canonicalize(self, prompt: str, style: str, aspect_ratio: str) -> tuple:
+        """(корзина стиля и пропорций, канонический текст запроса)."""
+        optimized = PromptManager.create_optimized_prompt(prompt, style, aspect_ratio)["prompt"]
+        # Хвост, который PromptManager добавляет к любому запросу этого стиля и пропорций
+        suffix = PromptManager.create_optimized_prompt("", style, aspect_ratio)["prompt"]
+        subject = optimized[:-len(suffix)] if suffix and optimized.endswith(suffix) else optimized
+        words = {word for word in re.findall(r"\w+", subject) if word not in self.STOP_WORDS}
+        # Корзина — по исходному стилю, а не по хвосту: незнакомые PromptManager стили
+        # получают хвост Default, но картинка рисуется по самому стилю (см. ImageGenerator)
+        key = f"{self._normalize(style)}|{self._normalize(aspect_ratio)}"
+        bucket = hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
+        return bucket, " ".join(sorted(words))
+
+    @staticmethod
+    def _normalize(value: str) -> str:
+        return " ".join((value or "").lower().split())
+
+    def _shingles(self, text: str) -> set:
+        padded = f" {text} "
+        return {padded[i:i + self.SHINGLE] for i in range(max(1, len(padded) - self.SHINGLE + 1))}
+
+    def similarity(self, text_a: str, text_b: str) -> float:
+        a, b = self._shingles(text_a), self._shingles(text_b)
+        return len(a & b) / len(a | b) if a or b else 0.0
+
+    def _band_fields(self, bucket: str, text: str) -> list:
+        """Поле LSH для каждой полосы: одинаковые полосы сигнатуры -> одинаковое поле."""
+        # blake2b стабилен между процессами, в отличие от встроенного hash()
+        digests = [
+            self._DIGEST.unpack(hashlib.blake2b(shingle.encode("utf-8"), digest_size=self._DIGEST.size).digest())
+            for shingle in self._shingles(text)
+        ]
+        signature = struct.pack(f">{self.NUM_HASHES}H", *map(min, zip(*digests))).hex()
+        width = len(signature) // self.BANDS
+        return [f"{bucket}:{signature[band * width:(band + 1) * width]}" for band in range(self.BANDS)]
+
+    # ------------------------------------------------------------------
+    # Запись (воркер) и поиск (API)
+    # ------------------------------------------------------------------
+
+    def add(self, prompt: str, style: str, aspect_ratio: str, title: str, image_paths: list):
+        """Запоминает готовый результат. Ошибки Redis не должны ронять генерацию."""
+        if not self.enabled or not image_paths:
+            return
+        bucket, text = self.canonicalize(prompt, style, aspect_ratio)
+        if not text:
+            return
+        entry_id = uuid.uuid4().hex[:16]
+        now = time.time()
+        fields = self._band_fields(bucket, text)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(self._entry_key(entry_id), mapping={
+                "bucket": bucket, "text": text, "title": title or "",
+                "image_paths": json.dumps(image_paths, ensure_ascii=False),
+                "bands": ",".join(fields), "created": now,
+            })
+            # В каждой полосе остается самая свежая запись: совпавшие полосы и так почти одинаковы
+            for band, field in enumerate(fields):
+                pipe.hset(self._band_key(band), field, entry_id)
+            pipe.zadd(self._created_key, {entry_id: now})
+            pipe.execute()
+            self.prune()
+        except redis.RedisError as e:
+            print(f"--- Не удалось добавить промпт в индекс похожих: {e} ---")
+
+    def lookup(self, prompt: str, style: str, aspect_ratio: str, n_images: int = 1):
+        """
+        Самый похожий готовый результат не ниже threshold:
+        {"entry_id", "similarity", "title", "image_paths"} или None.
+        Записи, чьи файлы уже удалил GC generated_media, удаляются из индекса.
+        """
+        if not self.enabled:
+            return None
+        bucket, text = self.canonicalize(prompt, style, aspect_ratio)
+        if not text:
+            return None
+        fields = self._band_fields(bucket, text)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for band, field in enumerate(fields):
+                pipe.hget(self._band_key(band), field)
+            candidates = list(dict.fromkeys(entry_id for entry_id in pipe.execute() if entry_id))
+            if not candidates:
+                return None
+            pipe = self.client.pipeline(transaction=False)
+            for entry_id in candidates:
+                pipe.hmget(self._entry_key(entry_id), "bucket", "text", "title", "image_paths", "created")
+            records = pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Индекс похожих промптов недоступен: {e} ---")
+            return None
+
+        best = None
+        now = time.time()
+        for entry_id, (entry_bucket, entry_text, title, paths, created) in zip(candidates, records):
+            if entry_bucket != bucket or created is None or now - float(created) > self.ttl:
+                continue
+            score = self.similarity(text, entry_text)
+            if score < self.threshold or (best is not None and score <= best["similarity"]):
+                continue
+            image_paths = json.loads(paths)
+            if len(image_paths) < n_images:
+                continue
+            # API и воркер делят том generated_media: файл мог удалить его GC
+            if not all(os.path.isfile(path) for path in image_paths[:n_images]):
+                self.remove(entry_id)
+                continue
+            best = {"entry_id": entry_id, "similarity": round(score, 4), "title": title,
+                    "image_paths": image_paths[:n_images]}
+        return best
+
+    # ------------------------------------------------------------------
+    # Удаление
+    # ------------------------------------------------------------------
+
+    def remove(self, entry_id: str):
+        try:
+            self._remove_many([entry_id])
+        except redis.RedisError as e:
+            print(f"--- Не удалось удалить запись индекса {entry_id}: {e} ---")
+
+    def _remove_many(self, entry_ids: list):
+        pipe = self.client.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.hget(self._entry_key(entry_id), "bands")
+        bands = pipe.execute()
+
+        # Поле полосы удаляем, только если оно еще указывает на эту запись
+        pipe = self.client.pipeline(transaction=False)
+        owned = []
+        for entry_id, entry_bands in zip(entry_ids, bands):
+            for band, field in enumerate((entry_bands or "").split(",") if entry_bands else []):
+                pipe.hget(self._band_key(band), field)
+                owned.append((entry_id, band, field))
+        current = pipe.execute()
+
+        pipe = self.client.pipeline(transaction=False)
+        for (entry_id, band, field), value in zip(owned, current):
+            if value == entry_id:
+                pipe.hdel(self._band_key(band), field)
+        for entry_id in entry_ids:
+            pipe.delete(self._entry_key(entry_id))
+            pipe.zrem(self._created_key, entry_id)
+        pipe.execute()
+
+    def prune(self) -> int:
+        """Удаляет до PRUNE_BATCH записей старше ttl (вызывается при каждом добавлении)."""
+        expired = self.client.zrangebyscore(self._created_key, "-inf", time.time() - self.ttl,
+                                            start=0, num=self.PRUNE_BATCH)
+        if expired:
+            self._remove_many(expired)
+        return len(expired)
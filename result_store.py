@@ -0,0 +1,141 @@
+# result_store.py
+import json
+import os
+import time
+import redis
+
+
+class ResultStore:
+    """
+    Компактные записи результатов задач в Redis вместо конверта Celery.
+
+    result:<task_id> — hash только с нужными полями: status, title, image_paths (JSON),
+    error, preview (пока идет генерация) и отметки времени queued_at / started_at / finished_at.
+    У каждой записи TTL RESULT_TTL; запись многих задач читается одним пайплайном.
+    """
+
+    KEY_PREFIX = "result"
+
+    def __init__(self, ttl: int = None, client=None):
+        if ttl is None:
+            ttl = int(os.environ.get("RESULT_TTL", str(24 * 3600)))
+        self.ttl = ttl
+        self._client = client
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("RESULT_DB", "1")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать генерацию
+                retry=None,
+            )
+        return self._client
+
+    def _key(self, task_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{task_id}"
+
+    def _write(self, task_id: str, fields: dict, drop: tuple = ()):
+        """Обновляет поля записи и продлевает TTL. Ошибки Redis не должны ронять генерацию."""
+        if not task_id:
+            return
+        key = self._key(task_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(key, mapping={name: value for name, value in fields.items() if value is not None})
+            if drop:
+                pipe.hdel(key, *drop)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Не удалось сохранить результат {task_id}: {e} ---")
+
+    def mark_queued(self, task_id: str):
+        self._write(task_id, {"status": "PENDING", "queued_at": round(time.time(), 3)})
+
+    def mark_queued_many(self, task_ids: list):
+        """Отметка постановки в очередь для чанка пакетной загрузки одним пайплайном."""
+        now = round(time.time(), 3)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for task_id in task_ids:
+                pipe.hset(self._key(task_id), mapping={"status": "PENDING", "queued_at": now})
+                pipe.expire(self._key(task_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Не удалось сохранить статусы пакета: {e} ---")
+
+    def mark_started(self, task_id: str):
+        self._write(task_id, {"status": "STARTED", "started_at": round(time.time(), 3)})
+
+    def set_title(self, task_id: str, title: str):
+        self._write(task_id, {"title": title})
+
+    def set_preview(self, task_id: str, preview: str, index: int = 0):
+        # Превью (data URI ~10 КБ) хранится только до готового результата
+        self._write(task_id, {"status": "PREVIEW", "preview": preview, "preview_index": index})
+
+    def complete(self, task_id: str, title: str = None, image_paths: list = None):
+        fields = {"status": "SUCCESS", "title": title, "finished_at": round(time.time(), 3)}
+        if image_paths is not None:
+            fields["image_paths"] = json.dumps(image_paths, ensure_ascii=False)
+        self._write(task_id, fields, drop=("preview", "preview_index"))
+
+    def fail(self, task_id: str, error: str):
+        self._write(task_id, {"status": "FAILURE", "error": error, "finished_at": round(time.time(), 3)},
+                    drop=("preview", "preview_index"))
+
+    @staticmethod
+    def _decode(raw: dict):
+        if not raw:
+            return None
+        record = {"status": raw.get("status", "PENDING")}
+        result = {}
+        if "title" in raw:
+            result["title"] = raw["title"]
+        if "image_paths" in raw:
+            paths = json.loads(raw["image_paths"])
+            result["image_path"] = paths[0] if paths else None
+            result["image_paths"] = paths
+        if "error" in raw:
+            result["error"] = raw["error"]
+
+        timings = {name: float(raw[name]) for name in ("queued_at", "started_at", "finished_at") if name in raw}
+        if "queued_at" in timings and "started_at" in timings:
+            timings["queue_wait"] = round(timings["started_at"] - timings["queued_at"], 3)
+        if "started_at" in timings and "finished_at" in timings:
+            timings["run_time"] = round(timings["finished_at"] - timings["started_at"], 3)
+        result["timings"] = timings
+
+        if record["status"] == "PREVIEW":
+            record["preview"] = {"title": raw.get("title"), "index": int(raw.get("preview_index", 0)),
+                                 "preview": raw.get("preview")}
+        record["result"] = result
+        return record
+
+    def get(self, task_id: str):
+        """Запись задачи {"status", "result", ["preview"]} или None, если записи нет."""
+        return self._decode(self.client.hgetall(self._key(task_id)))
+
+    def get_statuses(self, task_ids: list) -> list:
+        """Только статусы многих задач (None — записи нет) одним пайплайном: для сводки по пакету."""
+        if not task_ids:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hget(self._key(task_id), "status")
+        return pipe.execute()
+
+    def get_many(self, task_ids: list) -> dict:
+        """Записи многих задач за один пайплайн (один сетевой round trip)."""
+        if not task_ids:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self._key(task_id))
+        return {task_id: self._decode(raw) for task_id, raw in zip(task_ids, pipe.execute())}
@@ -0,0 +1,146 @@
+# singleflight.py
+import hashlib
+import json
+import os
+import uuid
+import redis
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых запросов на генерацию (singleflight) и ключи идемпотентности.
+
+    singleflight:<kind>:req:<hash>   — задача для нормализованного запроса, пока она выполняется;
+    singleflight:<kind>:idem:<hash>  — задача для Idempotency-Key клиента (живет idempotency_ttl);
+    singleflight:task:<task_id>      — обратная ссылка, чтобы воркер снял аренду по id задачи;
+    singleflight:stats               — hash счетчиков <kind>:requests / <kind>:coalesced.
+
+    Значение ключа — "<task_id> <отпечаток запроса>": повтор Idempotency-Key
+    с другим телом запроса распознается как конфликт.
+    """
+
+    KEY_PREFIX = "singleflight"
+
+    def __init__(self, lease: int = None, idempotency_ttl: int = None, client=None):
+        # Аренда на время выполнения: если воркер упал и не снял ее, ключ истечет сам
+        if lease is None:
+            lease = int(os.environ.get("SINGLEFLIGHT_LEASE", "600"))
+        if idempotency_ttl is None:
+            idempotency_ttl = int(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+        self.lease = lease
+        self.idempotency_ttl = idempotency_ttl
+        self._client = client
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("SINGLEFLIGHT_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать постановку задачи
+                retry=None,
+            )
+        return self._client
+
+    @staticmethod
+    def fingerprint(**request) -> str:
+        """Хэш нормализованного запроса: регистр и лишние пробелы промпта не важны."""
+        normalized = {
+            key: " ".join(value.lower().split()) if isinstance(value, str) else value
+            for key, value in request.items()
+        }
+        canonical = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _key(self, kind: str, fingerprint: str, idempotency_key: str = None) -> str:
+        if idempotency_key:
+            digest = hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest()
+            return f"{self.KEY_PREFIX}:{kind}:idem:{digest}"
+        return f"{self.KEY_PREFIX}:{kind}:req:{fingerprint}"
+
+    def _task_key(self, task_id: str) -> str:
+        return f"{self.KEY_PREFIX}:task:{task_id}"
+
+    @property
+    def _stats_key(self) -> str:
+        return f"{self.KEY_PREFIX}:stats"
+
+    def _existing(self, kind: str, fingerprint: str, value: str) -> dict:
+        task_id, _, stored_fingerprint = value.partition(" ")
+        conflict = stored_fingerprint != fingerprint
+        if not conflict:
+            self.client.hincrby(self._stats_key, f"{kind}:coalesced", 1)
+        return {"task_id": task_id, "coalesced": True, "conflict": conflict}
+
+    def lookup(self, kind: str, fingerprint: str, idempotency_key: str = None):
+        """Уже выполняющаяся задача для такого запроса или None. Учитывается в статистике."""
+        try:
+            self.client.hincrby(self._stats_key, f"{kind}:requests", 1)
+            value = self.client.get(self._key(kind, fingerprint, idempotency_key))
+            return self._existing(kind, fingerprint, value) if value else None
+        except redis.RedisError as e:
+            print(f"--- Singleflight недоступен: {e} ---")
+            return None
+
+    def claim(self, kind: str, fingerprint: str, idempotency_key: str = None) -> dict:
+        """
+        Атомарно (SET NX) закрепляет запрос за новым task_id.
+        {"task_id", "coalesced": False} — ставьте задачу с этим id;
+        {"task_id", "coalesced": True, "conflict"} — параллельный дубль успел раньше.
+        """
+        task_id = str(uuid.uuid4())
+        key = self._key(kind, fingerprint, idempotency_key)
+        ttl = self.idempotency_ttl if idempotency_key else self.lease
+        try:
+            if self.client.set(key, f"{task_id} {fingerprint}", nx=True, ex=ttl):
+                self.client.set(self._task_key(task_id), key, ex=ttl)
+                return {"task_id": task_id, "coalesced": False}
+            value = self.client.get(key)
+            if value:
+                return self._existing(kind, fingerprint, value)
+        except redis.RedisError as e:
+            print(f"--- Singleflight недоступен, задача ставится без склейки: {e} ---")
+        return {"task_id": task_id, "coalesced": False}
+
+    def release(self, task_id: str):
+        """
+        Снимает аренду нормализованного запроса после завершения задачи:
+        следующий такой же запрос сгенерирует новый результат.
+        Ключи идемпотентности живут до конца своего TTL — повтор клиента получит тот же task_id.
+        """
+        if not task_id:
+            return
+        try:
+            key = self.client.get(self._task_key(task_id))
+            if not key:
+                return
+            if ":idem:" not in key:
+                # Удаляем, только если ключ все еще принадлежит этой задаче
+                with self.client.pipeline() as pipe:
+                    pipe.watch(key)
+                    value = pipe.get(key)
+                    if value and value.partition(" ")[0] == task_id:
+                        pipe.multi()
+                        pipe.delete(key)
+                        pipe.execute()
+            self.client.delete(self._task_key(task_id))
+        except redis.WatchError:
+            pass
+        except redis.RedisError as e:
+            print(f"--- Не удалось снять аренду singleflight {task_id}: {e} ---")
+
+    def stats(self) -> dict:
+        """Счетчики по видам задач: сколько запросов пришло и сколько склеено с уже идущими."""
+        raw = self.client.hgetall(self._stats_key)
+        stats = {}
+        for field, value in raw.items():
+            kind, _, counter = field.partition(":")
+            stats.setdefault(kind, {"requests": 0, "coalesced": 0})[counter] = int(value)
+        for kind_stats in stats.values():
+            requests = kind_stats["requests"]
+            kind_stats["coalesced_ratio"] = round(kind_stats["coalesced"] / requests, 4) if requests else 0.0
+        return stats
@@ -0,0 +1,63 @@
+# task_queues.py
+"""
+Очереди Celery и маршрутизация задач по ним.
+
+titles  — короткие задачи заголовков; отдельный prefork-воркер, пачка баннеров их не задерживает;
+banners — оркестрация баннера (заголовок + chord) и финальная агрегация;
+images  — скачивание изображений (ожидание сети до минуты) и композиция.
+
+banners и images обслуживает gevent-воркер с высокой concurrency, см. docker-compose.yml.
+"""
+
+TITLES_QUEUE = "titles"
+BANNERS_QUEUE = "banners"
+IMAGES_QUEUE = "images"
+QUEUES = (TITLES_QUEUE, BANNERS_QUEUE, IMAGES_QUEUE)
+
+# Приоритеты транспорта Redis: 0 — самый высокий, 9 — самый низкий.
+# Внутри воркера banners/images уже начатые задачи (картинки, агрегация) идут раньше новых баннеров.
+PRIORITY_STEPS = list(range(10))
+PRIORITY_SEP = ":"
+
+TASK_ROUTES = {
+    "celery_worker.generate_title_task": {"queue": TITLES_QUEUE, "priority": 0},
+    "celery_worker.generate_image_task": {"queue": IMAGES_QUEUE, "priority": 3},
+    "celery_worker.aggregate_images_task": {"queue": BANNERS_QUEUE, "priority": 3},
+    "celery_worker.placeholder_generation_task": {"queue": BANNERS_QUEUE, "priority": 6},
+}
+
+
+def configure(celery_app):
+    """Подключает маршруты, очереди и приоритеты к приложению Celery."""
+    celery_app.conf.update(
+        task_routes=TASK_ROUTES,
+        task_default_queue=BANNERS_QUEUE,
+        task_default_priority=5,
+        broker_transport_options={
+            "priority_steps": PRIORITY_STEPS,
+            "sep": PRIORITY_SEP,
+            # Очереди опрашиваются в порядке -Q, а не по кругу
+            "queue_order_strategy": "priority",
+        },
+        # Длинные задачи: воркер не забирает сообщения впрок, пока свободные процессы ждут
+        worker_prefetch_multiplier=1,
+    )
+
+
+def queue_depths(celery_app) -> dict:
+    """
+    Число ожидающих сообщений в каждой очереди (по всем уровням приоритета).
+    Транспорт Redis хранит уровень p очереди q в списке "q:p" (для p=0 — просто "q").
+    """
+    keys = {
+        queue: [queue] + [f"{queue}{PRIORITY_SEP}{step}" for step in PRIORITY_STEPS if step]
+        for queue in QUEUES
+    }
+    with celery_app.connection_for_read() as connection:
+        client = connection.default_channel.client
+        pipe = client.pipeline()
+        for queue in QUEUES:
+            for key in keys[queue]:
+                pipe.llen(key)
+        lengths = iter(pipe.execute())
+    return {queue: sum(next(lengths) for _ in keys[queue]) for queue in QUEUES}
@@ -0,0 +1,329 @@
+# telemetry.py
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import redis
+
+
+class Telemetry:
+    """
+    Метрики по стадиям генерации и трассировка задачи от API до воркера.
+
+    Метрики общие для всех процессов (API, prefork- и gevent-воркеры) и живут в Redis,
+    а /metrics API отдает их в текстовом формате Prometheus:
+    metrics:counter         — hash: name{labels} -> значение счетчика;
+    metrics:hist:<name>     — hash: "<labels>\\t<номер корзины|sum|count>" -> значение гистограммы.
+
+    Трассировка: контекст W3C traceparent передается в заголовках сообщений Celery,
+    спаны (name, span_id, parent_id, start, duration, attrs) пишутся в список trace:<trace_id> с TTL.
+    """
+
+    KEY_PREFIX = "metrics"
+    TRACE_PREFIX = "trace"
+    TRACEPARENT_HEADER = "traceparent"
+    # Время публикации сообщения: по нему воркер считает ожидание в очереди
+    PUBLISHED_HEADER = "published_at"
+    # Границы корзин гистограмм, секунды: от записи на диск до скачивания в минуту
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    # Не больше стольких спанов на трассу (пакет из тысяч задач не раздувает один список)
+    MAX_SPANS = 1000
+
+    COUNTERS = {
+        "banner_tasks_total": "Завершенные задачи Celery по имени и итоговому состоянию.",
+        "banner_title_requests_total": "Запросы к моделям заголовков по результату (ok, empty, error).",
+        "banner_title_cache_total": "Обращения к кэшу заголовков (hit, miss).",
+        "banner_title_fallback_total": "Заголовки-заглушки: ни одна модель не ответила.",
+        "banner_image_errors_total": "Картинки-заглушки вместо изображения Pollinations по причине.",
+        "banner_prompt_reuse_total": "Запросы баннера, отданные из индекса похожих промптов без генерации.",
+    }
+    HISTOGRAMS = {
+        "banner_queue_wait_seconds": "Ожидание задачи в очереди Celery от публикации до старта.",
+        "banner_task_seconds": "Время выполнения задач Celery.",
+        "banner_stage_seconds": "Время стадий: title, title_model, download, composition, disk_write.",
+    }
+
+    def __init__(self, trace_ttl: int = None, client=None):
+        if trace_ttl is None:
+            trace_ttl = int(os.environ.get("TRACE_TTL", "3600"))
+        self.trace_ttl = trace_ttl
+        self.enabled = os.environ.get("TELEMETRY_ENABLED", "1") == "1"
+        self._client = client
+        # Текущий спан: свой у каждого потока, гринлета gevent и корутины
+        self._current = contextvars.ContextVar("telemetry_span", default=None)
+        # Открытые спаны задач между task_prerun и task_postrun
+        self._task_spans = {}
+        self._lock = threading.Lock()
+        self._instrumented = False
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("METRICS_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать генерацию
+                retry=None,
+            )
+        return self._client
+
+    @staticmethod
+    def _labels(labels: dict) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in sorted(labels.items())
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def _bucket(self, value: float) -> int:
+        for index, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                return index
+        return len(self.BUCKETS)
+
+    def _observe(self, pipe, name: str, value: float, labels: dict):
+        key = f"{self.KEY_PREFIX}:hist:{name}"
+        series = self._labels(labels)
+        # Храним попадания в отдельные корзины, накопительные суммы считаются при выдаче
+        pipe.hincrby(key, f"{series}\t{self._bucket(value)}", 1)
+        pipe.hincrbyfloat(key, f"{series}\tsum", value)
+        pipe.hincrby(key, f"{series}\tcount", 1)
+
+    def _execute(self, pipe):
+        # Ошибки Redis не должны ронять генерацию: метрика теряется, задача идет дальше
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Не удалось записать метрики: {e} ---")
+
+    # ------------------------------------------------------------------
+    # Метрики
+    # ------------------------------------------------------------------
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        if not self.enabled:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hincrby(f"{self.KEY_PREFIX}:counter", f"{name}{self._labels(labels)}", amount)
+        self._execute(pipe)
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        self._observe(pipe, name, value, labels)
+        self._execute(pipe)
+
+    def render(self, gauges: dict = None) -> str:
+        """
+        Все метрики в текстовом формате Prometheus 0.0.4.
+        gauges — {имя: (описание, [(метки, значение), ...])}, снимаются в момент запроса (глубина очередей).
+        """
+        lines = []
+        counters = self.client.hgetall(f"{self.KEY_PREFIX}:counter")
+        for name, help_text in self.COUNTERS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for series, value in sorted(counters.items()):
+                if series == name or series.startswith(name + "{"):
+                    lines.append(f"{series} {value}")
+
+        pipe = self.client.pipeline(transaction=False)
+        for name in self.HISTOGRAMS:
+            pipe.hgetall(f"{self.KEY_PREFIX}:hist:{name}")
+        for (name, help_text), raw in zip(self.HISTOGRAMS.items(), pipe.execute()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            series_fields = {}
+            for field, value in raw.items():
+                series, _, part = field.rpartition("\t")
+                series_fields.setdefault(series, {})[part] = value
+            for series, fields in sorted(series_fields.items()):
+                labels = series[1:-1]
+                cumulative = 0
+                for index, bound in enumerate(self.BUCKETS + ("+Inf",)):
+                    cumulative += int(fields.get(str(index), 0))
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{{{labels + ',' if labels else ''}{le}}} {cumulative}")
+                lines.append(f"{name}_sum{series} {float(fields.get('sum', 0))}")
+                lines.append(f"{name}_count{series} {int(fields.get('count', 0))}")
+
+        for name, (help_text, values) in (gauges or {}).items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for labels, value in values:
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # ------------------------------------------------------------------
+    # Трассировка
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def parse_traceparent(value: str):
+        """(trace_id, span_id) из заголовка W3C traceparent или None, если он некорректен."""
+        if not value:
+            return None
+        parts = value.strip().split("-")
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+        try:
+            int(parts[1], 16), int(parts[2], 16)
+        except ValueError:
+            return None
+        return parts[1], parts[2]
+
+    def traceparent(self):
+        """Заголовок traceparent текущего спана (None вне трассы)."""
+        span = self._current.get()
+        if span is None:
+            return None
+        return f"00-{span['trace_id']}-{span['span_id']}-01"
+
+    def start_span(self, name: str, parent=None, **attrs) -> dict:
+        """
+        Открывает спан и делает его текущим. parent — (trace_id, span_id) из traceparent;
+        без него спан продолжает текущую трассу или начинает новую.
+        """
+        current = self._current.get()
+        if parent is not None:
+            trace_id, parent_id = parent
+        elif current is not None:
+            trace_id, parent_id = current["trace_id"], current["span_id"]
+        else:
+            trace_id, parent_id = uuid.uuid4().hex, None
+        span = {
+            "trace_id": trace_id,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent_id,
+            "name": name,
+            "start": time.time(),
+            "attrs": {key: value for key, value in attrs.items() if value is not None},
+            "_started": time.perf_counter(),
+        }
+        span["_token"] = self._current.set(span)
+        return span
+
+    def end_span(self, span: dict, stage: str = None, **attrs) -> float:
+        """Закрывает спан, пишет его в трассу и (если задана stage) в гистограмму стадий."""
+        duration = self.close_span(span)
+        self.record_span(span, duration, stage=stage, **attrs)
+        return duration
+
+    def close_span(self, span: dict) -> float:
+        """
+        Снимает спан с текущего контекста без записи в Redis. В async-обработчиках запись
+        (record_span) уходит в поток, а контекст спана меняется только в цикле событий.
+        """
+        duration = time.perf_counter() - span["_started"]
+        try:
+            self._current.reset(span["_token"])
+        except ValueError:
+            # Спан закрыт в другом контексте (другой гринлет) — просто снимаем его
+            self._current.set(None)
+        return duration
+
+    def record_span(self, span: dict, duration: float, stage: str = None, **attrs):
+        """Пишет закрытый спан в трассу и (если задана stage) в гистограмму стадий."""
+        if not self.enabled:
+            return
+
+        span["attrs"].update({key: value for key, value in attrs.items() if value is not None})
+        record = {key: value for key, value in span.items() if not key.startswith("_")}
+        record["duration"] = round(duration, 6)
+        key = f"{self.TRACE_PREFIX}:{span['trace_id']}"
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(key, json.dumps(record, ensure_ascii=False))
+        pipe.ltrim(key, 0, self.MAX_SPANS - 1)
+        pipe.expire(key, self.trace_ttl)
+        if stage:
+            self._observe(pipe, "banner_stage_seconds", duration, {"stage": stage})
+        self._execute(pipe)
+
+    @contextmanager
+    def span(self, name: str, stage: str = None, parent=None, **attrs):
+        """with telemetry.span("download", stage="download"): ... — спан трассы и метрика стадии."""
+        span = self.start_span(name, parent=parent, **attrs)
+        error = None
+        try:
+            yield span
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.end_span(span, stage=stage, error=error)
+
+    def get_trace(self, trace_id: str) -> list:
+        """Спаны трассы в порядке начала."""
+        spans = [json.loads(raw) for raw in self.client.lrange(f"{self.TRACE_PREFIX}:{trace_id}", 0, -1)]
+        return sorted(spans, key=lambda span: span["start"])
+
+    # ------------------------------------------------------------------
+    # Celery: контекст в заголовках сообщений
+    # ------------------------------------------------------------------
+
+    def inject_headers(self, headers: dict):
+        """Добавляет в заголовки сообщения текущий traceparent и время публикации."""
+        traceparent = self.traceparent()
+        if traceparent and self.TRACEPARENT_HEADER not in headers:
+            headers[self.TRACEPARENT_HEADER] = traceparent
+        headers.setdefault(self.PUBLISHED_HEADER, time.time())
+
+    def task_started(self, task):
+        """task_prerun: ожидание в очереди и спан задачи, продолжающий трассу из заголовков."""
+        request = task.request
+        published_at = request.get(self.PUBLISHED_HEADER)
+        queue = (request.delivery_info or {}).get("routing_key") or "unknown"
+        queue_wait = None
+        if published_at is not None:
+            queue_wait = max(0.0, time.time() - float(published_at))
+            self.observe("banner_queue_wait_seconds", queue_wait, queue=queue)
+        parent = self.parse_traceparent(request.get(self.TRACEPARENT_HEADER))
+        span = self.start_span(task.name, parent=parent, task_id=request.id, queue=queue,
+                               queue_wait=round(queue_wait, 6) if queue_wait is not None else None)
+        with self._lock:
+            self._task_spans[request.id] = span
+
+    def task_finished(self, task, task_id: str, state: str):
+        """task_postrun: закрывает спан задачи, длительность и итог — в метрики."""
+        with self._lock:
+            span = self._task_spans.pop(task_id, None)
+        if span is None:
+            return
+        duration = self.end_span(span, state=state)
+        if self.enabled:
+            pipe = self.client.pipeline(transaction=False)
+            self._observe(pipe, "banner_task_seconds", duration, {"task": task.name})
+            pipe.hincrby(f"{self.KEY_PREFIX}:counter",
+                         f"banner_tasks_total{self._labels({'task': task.name, 'state': state})}", 1)
+            self._execute(pipe)
+
+    def instrument_celery(self):
+        """Подключает обработчики сигналов Celery (публикация и выполнение задач). Повторный вызов ничего не делает."""
+        if self._instrumented:
+            return
+        self._instrumented = True
+        from celery.signals import before_task_publish, task_prerun, task_postrun
+
+        @before_task_publish.connect(weak=False)
+        def _inject(headers=None, **kwargs):
+            if headers is not None:
+                self.inject_headers(headers)
+
+        @task_prerun.connect(weak=False)
+        def _started(task=None, **kwargs):
+            self.task_started(task)
+
+        @task_postrun.connect(weak=False)
+        def _finished(task=None, task_id=None, state=None, **kwargs):
+            self.task_finished(task, task_id, state)
+
+
+# Один экземпляр на процесс: стадии отмечаются из генераторов и композиции без передачи объекта
+telemetry = Telemetry()
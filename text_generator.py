@@ -1,35 +1,347 @@
 <<<<<<< HEAD
 import g4f
+import contextvars
+import os
+import requests
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from title_cache import TitleCache
+from telemetry import telemetry
+
+
+class ModelStats:
+    """Скользящее окно задержек и ошибок по каждой модели (в пределах процесса)."""
+
+    def __init__(self, window: int = 50, default_latency: float = 2.0):
+        self.window = window
+        # Оценка задержки для модели, по которой еще нет данных
+        self.default_latency = default_latency
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, latency: float, ok: bool):
+        with self._lock:
+            samples = self._samples.setdefault(model_name, deque(maxlen=self.window))
+            samples.append((latency, ok))
+
+    def _snapshot(self, model_name: str) -> list:
+        with self._lock:
+            return list(self._samples.get(model_name, ()))
+
+    def p95(self, model_name: str) -> float:
+        """p95 задержки успешных ответов модели."""
+        latencies = sorted(lat for lat, ok in self._snapshot(model_name) if ok)
+        if not latencies:
+            return self.default_latency
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self, model_name: str) -> float:
+        samples = self._snapshot(model_name)
+        if not samples:
+            return 0.0
+        return sum(1 for _, ok in samples if not ok) / len(samples)
+
+    def score(self, model_name: str) -> float:
+        """Ожидаемое время до успешного ответа: p95 / доля успехов."""
+        return self.p95(model_name) / max(1.0 - self.error_rate(model_name), 0.05)
+
+    def ranked(self, models: list) -> list:
+        # sorted стабилен: без статистики сохраняется исходный порядок
+        return sorted(models, key=self.score)
+
+    def summary(self, models: list) -> dict:
+        return {
+            (m or "default"): {"p95": round(self.p95(m), 3), "error_rate": round(self.error_rate(m), 3)}
+            for m in models
+        }
+
 
 class TextGenerator:
-    def generate_title(self, prompt: str) -> str:
-        # Используем строковые названия моделей — это самый надежный способ в g4f
-        models = ["gpt-3.5-turbo", "gpt-4", "gpt-4o", ""]
-        
+    # Используем строковые названия моделей — это самый надежный способ в g4f
+    MODELS = ["gpt-3.5-turbo", "gpt-4", "gpt-4o", ""]
+
+    # Хеджирование: если лидер не ответил за его p95, параллельно запускаем следующую модель
+    HEDGED = os.environ.get("TITLE_HEDGED_REQUESTS", "1") == "1"
+    HEDGE_MIN_DELAY = float(os.environ.get("TITLE_HEDGE_MIN_DELAY", "0.5"))
+    HEDGE_MAX_DELAY = float(os.environ.get("TITLE_HEDGE_MAX_DELAY", "10"))
+    # Общий предел ожидания ответа от всех моделей
+    TOTAL_TIMEOUT = float(os.environ.get("TITLE_TOTAL_TIMEOUT", "60"))
+    # Потоки гонки моделей общие на процесс: зависшие запросы не копятся без предела
+    HEDGE_MAX_THREADS = int(os.environ.get("TITLE_HEDGE_MAX_THREADS", "16"))
+    _executor = None
+    _executor_lock = threading.Lock()
+    # OpenAI-совместимый API вместо g4f (например, локальный стенд benchmarks/bench_load.py)
+    LLM_API_URL = os.environ.get("LLM_API_URL", "")
+
+    def __init__(self, cache: TitleCache = None, stats: ModelStats = None):
+        self.cache = cache if cache is not None else TitleCache()
+        self.stats = stats if stats is not None else ModelStats()
+        self.session = requests.Session() if self.LLM_API_URL else None
+
+    @property
+    def model_key(self) -> str:
+        """Идентификатор набора моделей для ключа кэша."""
+        return ",".join(m or "default" for m in self.MODELS)
+
+    @classmethod
+    def _hedge_executor(cls) -> ThreadPoolExecutor:
+        # Создается лениво, в том процессе, где используется (после fork prefork-воркера)
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.HEDGE_MAX_THREADS,
+                                                   thread_name_prefix="title-hedge")
+            return cls._executor
+
+    def _ask_model(self, model_name: str, prompt: str, timeout: float = None):
+        """
+        Один запрос к g4f. Возвращает заголовок или None; задержка пишется в статистику.
+        timeout — предел самого запроса (по умолчанию TOTAL_TIMEOUT).
+        """
+        print(f"--- Попытка генерации текста моделью: {model_name or 'default'} ---")
+        started = time.monotonic()
+        span = telemetry.start_span("title_model", model=model_name or "default")
+        try:
+            response = self._complete(
+                model_name,
+                [{"role": "user", "content": f"Придумай 1 короткий рекламный заголовок для: {prompt}. Только текст."}],
+                timeout=timeout if timeout is not None else self.TOTAL_TIMEOUT,
+            )
+        except Exception as e:
+            self.stats.record(model_name, time.monotonic() - started, ok=False)
+            telemetry.end_span(span, stage="title_model", error=type(e).__name__)
+            telemetry.inc("banner_title_requests_total", model=model_name or "default", outcome="error")
+            print(f"Ошибка с моделью {model_name}: {e}")
+            return None
+
+        ok = bool(response) and len(response) > 2
+        self.stats.record(model_name, time.monotonic() - started, ok=ok)
+        telemetry.end_span(span, stage="title_model")
+        telemetry.inc("banner_title_requests_total", model=model_name or "default", outcome="ok" if ok else "empty")
+        if ok:
+            return response.strip().replace('"', '')
+        return None
+
+    def _complete(self, model_name: str, messages: list, timeout: float) -> str:
+        if self.LLM_API_URL:
+            response = self.session.post(
+                f"{self.LLM_API_URL}/v1/chat/completions",
+                json={"model": model_name or "default", "messages": messages},
+                timeout=timeout,
+            )
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+        # Если model_name пустой, g4f выберет модель по умолчанию.
+        # timeout g4f передает провайдеру: зависший провайдер освобождает поток пула
+        kwargs = {"model": model_name} if model_name else {}
+        return g4f.ChatCompletion.create(**kwargs, messages=messages, timeout=timeout)
+
+    def _hedge_delay(self, model_name: str) -> float:
+        return min(max(self.stats.p95(model_name), self.HEDGE_MIN_DELAY), self.HEDGE_MAX_DELAY)
+
+    def _generate_sequential(self, prompt: str, models: list):
         for model_name in models:
-            try:
-                print(f"--- Попытка генерации текста моделью: {model_name or 'default'} ---")
-                
-                # Если model_name пустой, g4f выберет модель по умолчанию
-                kwargs = {"model": model_name} if model_name else {}
-                
-                response = g4f.ChatCompletion.create(
-                    **kwargs,
-                    messages=[{"role": "user", "content": f"Придумай 1 короткий рекламный заголовок для: {prompt}. Только текст."}],
-                )
-                
-                if response and len(response) > 2:
-                    return response.strip().replace('"', '')
-            except Exception as e:
-                print(f"Ошибка с моделью {model_name}: {e}")
-                continue
+            title = self._ask_model(model_name, prompt)
+            if title:
+                return title
+        return None
+
+    def _submit_ask(self, executor, model_name: str, prompt: str, timeout: float = None):
+        # Запрос уходит в поток пула вместе с контекстом: спан модели попадает в трассу задачи
+        return executor.submit(contextvars.copy_context().run, self._ask_model, model_name, prompt, timeout)
+
+    def _generate_hedged(self, prompt: str, models: list):
+        """Гонка моделей: берем первый хороший ответ, запасную модель стартуем по p95 лидера."""
+        deadline = time.monotonic() + self.TOTAL_TIMEOUT
+        executor = self._hedge_executor()
+        pending = {}
+        queue = list(models)
+        try:
+            while queue or pending:
+                if queue and not pending:
+                    # Нечего ждать (старт или все запущенные упали) — запускаем следующую сразу
+                    model_name = queue.pop(0)
+                    pending[self._submit_ask(executor, model_name, prompt, deadline - time.monotonic())] = model_name
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("--- Истекло время ожидания ответа от моделей ---")
+                    return None
+                timeout = remaining
+                if queue:
+                    last_model = list(pending.values())[-1]
+                    timeout = min(timeout, self._hedge_delay(last_model))
+
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+                    title = future.result()
+                    if title:
+                        return title
+                # Лидер не успел за свой p95 или одна из моделей упала — добавляем следующую
+                if queue:
+                    model_name = queue.pop(0)
+                    print(f"--- Хедж: запускаем запасную модель {model_name or 'default'} ---")
+                    pending[self._submit_ask(executor, model_name, prompt, deadline - time.monotonic())] = model_name
+            return None
+        finally:
+            # Проигравшие запросы не ждем: еще не начатые отменяются, начатые
+            # освободят поток пула не позже своего таймаута
+            for future in pending:
+                future.cancel()
+
+    def generate_title(self, prompt: str) -> str:
+        # Сначала общий кэш в Redis: попадание экономит весь запрос к LLM
+        cached = self.cache.get(prompt, self.model_key)
+        if cached:
+            print("--- Заголовок взят из кэша ---")
+            telemetry.inc("banner_title_cache_total", result="hit")
+            return cached
+        telemetry.inc("banner_title_cache_total", result="miss")
+
+        # Порядок моделей пересчитывается по скользящей статистике задержек и ошибок
+        models = self.stats.ranked(self.MODELS)
+        if self.HEDGED:
+            title = self._generate_hedged(prompt, models)
+        else:
+            title = self._generate_sequential(prompt, models)
+
+        if title:
+            self.cache.put(prompt, self.model_key, title)
+            return title
         
-        # Финальный запасной вариант, если интернет/API совсем лежат
+        # Финальный запасной вариант, если интернет/API совсем лежат (в кэш не кладем)
+        telemetry.inc("banner_title_fallback_total")
         return f"Спецпредложение: {prompt[:30]}"
 =======
 from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from threading import Thread, Lock
+from concurrent.futures import Future
+import os
+import queue
+import time
 import torch
 import random # Добавляем random для заглушки
+from telemetry import telemetry
+
+
+class StopOnNewline(StoppingCriteria):
+    """Останавливает генерацию на первом переводе строки после непустого текста."""
+
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # generate_title все равно отбрасывает все после split('\n')[0].
+        # Проверяем каждую строку батча отдельно: закончившие строки generate дальше не растит
+        generated = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        done = ["\n" in text.lstrip() for text in generated]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Раздает новые токены батча по строкам: on_text[i](кусок текста) для строк,
+    которые ждут поток (generate_title_stream). TextIteratorStreamer умеет только батч 1.
+    """
+
+    def __init__(self, tokenizer, on_text: list):
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.tokens = [[] for _ in on_text]
+        self.sent = [0] * len(on_text)
+        self.prompt_skipped = False
+
+    def put(self, value):
+        # Первым вызовом generate передает сам промпт
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        for row, new_tokens in enumerate(value.reshape(len(self.on_text), -1).tolist()):
+            if self.on_text[row] is None:
+                continue
+            self.tokens[row].extend(new_tokens)
+            # Закончившие строки дополняются pad (= eos), skip_special_tokens их убирает
+            text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+            # Незаконченный многобайтовый символ дождется следующего токена
+            if text.endswith("\ufffd") or len(text) <= self.sent[row]:
+                continue
+            self.on_text[row](text[self.sent[row]:])
+            self.sent[row] = len(text)
+
+    def end(self):
+        pass
+
+
+class TitleBatcher:
+    """
+    Микро-батчинг запросов заголовков внутри одного процесса воркера.
+
+    Параллельные вызовы submit() (потоки пула threads/gevent) копятся до
+    max_batch_size штук или max_wait_ms миллисекунд и уходят в модель
+    одним вызовом generate с паддингом. С on_text запрос получает свои
+    куски текста по мере генерации батча (потоковая выдача заголовка).
+    """
+
+    def __init__(self, generate_batch, max_batch_size: int, max_wait_ms: float):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Поток создается лениво и заново после fork: у каждого процесса свой батчер
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def submit(self, prompt: str) -> str:
+        return self.submit_async(prompt).result()
+
+    def submit_async(self, prompt: str, on_text=None) -> Future:
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((prompt, on_text, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            prompts = [prompt for prompt, _, _ in batch]
+            on_text = [callback for _, callback, _ in batch]
+            try:
+                results = self.generate_batch(prompts, on_text)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
 
 class TextGenerator:
     _generator = None
@@ -38,6 +350,21 @@ class TextGenerator:
     # Указываем путь к папке с моделью, которую вы скачали вручную
     LOCAL_MODEL_PATH = "./my_llm_manual"
 
+    # Микро-батчинг: размер батча поднимает пропускную способность,
+    # время ожидания ограничивает добавку к p99. Размер 1 отключает батчинг.
+    BATCH_MAX_SIZE = int(os.environ.get("TITLE_BATCH_MAX_SIZE", "8"))
+    BATCH_MAX_WAIT_MS = float(os.environ.get("TITLE_BATCH_MAX_WAIT_MS", "20"))
+    _batcher = None
+
+    # Параметры семплирования (общие для обычного и потокового режима)
+    GENERATION_KWARGS = dict(
+        max_new_tokens=60,
+        do_sample=True,
+        top_k=50,
+        temperature=0.7,
+        top_p=0.95,
+    )
+
     @classmethod
     def initialize(cls):
         """Загрузка модели с локального диска."""
@@ -46,20 +373,35 @@ class TextGenerator:
 
         print(f"--- Загрузка LLM с локального диска: {cls.LOCAL_MODEL_PATH} ---")
         try:
+            # safetensors читаются через mmap: после форка воркера дети делят одну копию весов
+            model_kwargs = {"low_cpu_mem_usage": True}
+            if cls._has_safetensors():
+                model_kwargs["use_safetensors"] = True
+
             # Загружаем модель и токенизатор, указывая путь к локальной папке
             cls._generator = pipeline(
                 "text-generation",
                 model=cls.LOCAL_MODEL_PATH,
                 tokenizer=cls.LOCAL_MODEL_PATH,
                 # Указываем устройство: -1 для CPU (для совместимости)
-                device=-1
+                device=-1,
+                model_kwargs=model_kwargs
             )
+            # Веса только читаются: без градиентов никто не пишет в общие страницы
+            cls._generator.model.eval()
+            cls._generator.model.requires_grad_(False)
             print("--- LLM успешно загружена с диска! ---")
         except Exception as e:
             # Если что-то пойдет не так (например, отсутствует файл), вернемся к заглушке
             print(f"--- Ошибка загрузки LLM с диска: {e}. Переключение на заглушку. ---")
             cls._generator = True # Используем True как флаг для заглушки
 
+    @classmethod
+    def _has_safetensors(cls) -> bool:
+        if not os.path.isdir(cls.LOCAL_MODEL_PATH):
+            return False
+        return any(name.endswith(".safetensors") for name in os.listdir(cls.LOCAL_MODEL_PATH))
+
     @classmethod
     def generate_title(cls, user_prompt: str) -> str:
         """
@@ -73,19 +415,24 @@ class TextGenerator:
             return cls._dynamic_fallback_title(user_prompt)
 
         # --- ИСПОЛЬЗОВАНИЕ НАСТОЯЩЕЙ LLM ---
+        if cls.BATCH_MAX_SIZE > 1:
+            try:
+                # Параллельные запросы процесса объединяются в один вызов generate
+                return cls.finalize_title(user_prompt, cls._get_batcher().submit(user_prompt))
+            except Exception as e:
+                print(f"Ошибка генерации: {e}. Возврат к заглушке.")
+                return cls._dynamic_fallback_title(user_prompt)
+
         try:
             # Расширяем промпт, чтобы модель понимала, что нужно сделать
-            prompt_template = f"Напиши продающий рекламный заголовок по теме: {user_prompt}. Заголовок должен быть коротким и привлекательным."
+            prompt_template = cls._prompt_template(user_prompt)
             
             # --- ИСПРАВЛЕННЫЙ БЛОК ГЕНЕРАЦИИ ---
             result = cls._generator(
                 prompt_template,  # <--- Оборачиваем промпт в список, чтобы pipeline знал, что это один вход!
-                max_new_tokens=60,
-                do_sample=True,
-                top_k=50,
-                temperature=0.7,
-                top_p=0.95,
                 num_return_sequences=1,
+                stopping_criteria=cls._stopping_criteria(prompt_template),
+                **cls.GENERATION_KWARGS,
             )
             
             # Извлекаем и очищаем сгенерированный текст
@@ -108,9 +455,125 @@ class TextGenerator:
             print(f"Ошибка генерации: {e}. Возврат к заглушке.")
             return cls._dynamic_fallback_title(user_prompt)
 
+    @staticmethod
+    def _prompt_template(user_prompt: str) -> str:
+        return f"Напиши продающий рекламный заголовок по теме: {user_prompt}. Заголовок должен быть коротким и привлекательным."
+
+    @classmethod
+    def _get_batcher(cls) -> TitleBatcher:
+        if cls._batcher is None:
+            cls._batcher = TitleBatcher(cls.generate_raw_batch, cls.BATCH_MAX_SIZE, cls.BATCH_MAX_WAIT_MS)
+        return cls._batcher
+
+    @classmethod
+    def generate_raw_batch(cls, user_prompts: list, on_text: list = None) -> list:
+        """
+        Один вызов generate на несколько промптов (паддинг слева). Возвращает сырой текст.
+        on_text[i] (или None) получает куски текста i-го промпта по мере генерации.
+        """
+        tokenizer = cls._generator.tokenizer
+        model = cls._generator.model
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        # У decoder-only моделей продолжение идет справа, поэтому паддинг — слева
+        tokenizer.padding_side = "left"
+
+        inputs = tokenizer([cls._prompt_template(p) for p in user_prompts], return_tensors="pt", padding=True)
+        prompt_length = inputs["input_ids"].shape[1]
+        streamer = BatchStreamer(tokenizer, on_text) if on_text and any(on_text) else None
+        with torch.inference_mode():
+            output_ids = model.generate(
+                **inputs,
+                stopping_criteria=StoppingCriteriaList([StopOnNewline(tokenizer, prompt_length)]),
+                pad_token_id=tokenizer.pad_token_id,
+                streamer=streamer,
+                **cls.GENERATION_KWARGS,
+            )
+        return tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens=True)
+
+    @classmethod
+    def _stopping_criteria(cls, prompt_template: str) -> StoppingCriteriaList:
+        """Ранняя остановка на первой строке: остальные токены все равно отбрасываются."""
+        tokenizer = cls._generator.tokenizer
+        prompt_length = len(tokenizer(prompt_template)["input_ids"])
+        return StoppingCriteriaList([StopOnNewline(tokenizer, prompt_length)])
+
+    @classmethod
+    def generate_title_stream(cls, user_prompt: str):
+        """
+        Потоковая генерация: отдает куски заголовка по мере появления токенов.
+        Поток заканчивается на первом переводе строки после текста.
+        При BATCH_MAX_SIZE > 1 запрос идет через TitleBatcher вместе с параллельными
+        запросами процесса, куски своей строки батча приходят через on_text.
+        """
+        cls.initialize()
+
+        if cls._generator is True:
+            yield cls._dynamic_fallback_title(user_prompt)
+            return
+
+        if cls.BATCH_MAX_SIZE > 1:
+            chunks = queue.Queue()
+            future = cls._get_batcher().submit_async(user_prompt, on_text=chunks.put)
+            # None — конец батча (в том числе с ошибкой: ее поднимет future.result())
+            future.add_done_callback(lambda _: chunks.put(None))
+            # timeout — чтобы не зависнуть навсегда, если поток батчера умер
+            yield from cls._first_line(iter(lambda: chunks.get(timeout=60), None))
+            future.result()
+            return
+
+        prompt_template = cls._prompt_template(user_prompt)
+        tokenizer = cls._generator.tokenizer
+        inputs = tokenizer(prompt_template, return_tensors="pt")
+        # timeout — чтобы не зависнуть навсегда, если generate упал в фоновом потоке
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=60)
+
+        # model.generate блокирует поток, поэтому запускаем его в фоне и читаем streamer
+        thread = Thread(
+            target=cls._generator.model.generate,
+            kwargs=dict(
+                **inputs,
+                streamer=streamer,
+                stopping_criteria=cls._stopping_criteria(prompt_template),
+                pad_token_id=tokenizer.eos_token_id,
+                **cls.GENERATION_KWARGS,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        yield from cls._first_line(streamer)
+        thread.join()
+
+    @staticmethod
+    def _first_line(chunks):
+        """Куски текста до первого перевода строки, без ведущих пробелов."""
+        started = False
+        for text in chunks:
+            if not started:
+                # Ведущие пробелы и переводы строк генерация тоже отбрасывает
+                text = text.lstrip()
+                if not text:
+                    continue
+                started = True
+            if "\n" in text:
+                text = text.split("\n")[0]
+                if text:
+                    yield text
+                break
+            yield text
+
+    @classmethod
+    def finalize_title(cls, user_prompt: str, streamed_text: str) -> str:
+        """Та же очистка, что и в generate_title, для собранного из потока текста."""
+        final_title = streamed_text.strip().split('\n')[0].strip()
+        if not final_title:
+            return cls._dynamic_fallback_title(user_prompt)
+        return final_title.capitalize()
+
     # --- Код заглушки (на случай сбоя генерации) ---
     @classmethod
     def _dynamic_fallback_title(cls, user_prompt: str) -> str:
+        telemetry.inc("banner_title_fallback_total")
         # Убедимся, что keywords всегда имеет значение
         keywords = [w.strip(',').strip() for w in user_prompt.lower().split() if len(w) > 3]
         k1 = keywords[0] if keywords else "успех"
@@ -0,0 +1,80 @@
+# title_cache.py
+import hashlib
+import os
+import random
+import redis
+
+
+class TitleCache:
+    """
+    Общий для всех воркеров кэш заголовков в Redis.
+
+    Для каждого (нормализованный промпт, модель) хранится список из
+    нескольких вариантов заголовка с общим TTL. Пока вариантов меньше
+    заданного числа, get() возвращает промах, и кэш пополняется.
+    """
+
+    KEY_PREFIX = "title_cache"
+
+    def __init__(self, ttl: int = None, variants: int = None, client=None):
+        if ttl is None:
+            ttl = int(os.environ.get("TITLE_CACHE_TTL", "3600"))
+        if variants is None:
+            variants = int(os.environ.get("TITLE_CACHE_VARIANTS", "1"))
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self._client = client
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @property
+    def client(self):
+        # Соединение создаем лениво, чтобы импорт модуля не требовал Redis
+        if self._client is None:
+            self._client = redis.Redis(
+                host=os.environ.get("REDIS_HOST", "localhost"),
+                port=6379,
+                db=int(os.environ.get("TITLE_CACHE_DB", "2")),
+                decode_responses=True,
+                socket_timeout=1,
+                # Без повторов: недоступный Redis не должен задерживать генерацию
+                retry=None,
+            )
+        return self._client
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return " ".join(prompt.lower().split())
+
+    def _key(self, prompt: str, model: str) -> str:
+        digest = hashlib.sha1(self.normalize(prompt).encode("utf-8")).hexdigest()
+        return f"{self.KEY_PREFIX}:{model or 'default'}:{digest}"
+
+    def get(self, prompt: str, model: str):
+        """Случайный из сохраненных вариантов или None (промах / Redis недоступен)."""
+        if not self.enabled:
+            return None
+        try:
+            titles = self.client.lrange(self._key(prompt, model), 0, -1)
+        except redis.RedisError as e:
+            print(f"--- Кэш заголовков недоступен: {e} ---")
+            return None
+        if len(titles) < self.variants:
+            return None
+        return random.choice(titles)
+
+    def put(self, prompt: str, model: str, title: str):
+        """Добавляет вариант, оставляя не больше self.variants последних."""
+        if not self.enabled or not title:
+            return
+        key = self._key(prompt, model)
+        try:
+            pipe = self.client.pipeline()
+            pipe.lpush(key, title)
+            pipe.ltrim(key, 0, self.variants - 1)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"--- Не удалось сохранить заголовок в кэш: {e} ---")